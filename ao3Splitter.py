@@ -0,0 +1,182 @@
+"""
+Splits an Archive of Our Own html download into its parts while reading it, without building the full soup.
+
+Only the part currently being read is held in memory, so the memory used depends on the largest chapter and not on
+the size of the work.
+"""
+
+# IMPORTS ##############################################################################################################
+from html.parser import HTMLParser
+
+from bs4.builder import HTMLTreeBuilder
+
+# GLOBAL VARIABLES #####################################################################################################
+# Tags that never have an end tag, the same tags Beautiful Soup treats as empty
+void_tags = HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS
+
+# The size of each read from the html file
+chunk_size = 64 * 1024
+
+
+# MAIN CLASS ###########################################################################################################
+class AO3Splitter(HTMLParser):
+    """
+    An html parser that collects the top level parts of an ao3 download as they are read.
+
+    Each finished part is added to the parts list as a tuple of (part type, tag name, classes, html):
+        * preface - The <div id="preface">
+        * chapters - Each tag directly inside <div id="chapters">. Meta groups, userstuff and end notes
+        * afterword - The <div id="afterword">
+
+    The html of a part is rebuilt from the parsed pieces exactly as it was in the file, so it parses to the same soup.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self):
+        """
+        The init function.
+        """
+        super().__init__(convert_charrefs=False)  # Keep entities as they are in the file
+
+        self.parts: list = []  # Finished parts not yet collected
+
+        self.open_tags: list = []  # Names of all open tags
+        self.chapters_depth: int | None = None  # Depth of the open <div id="chapters">, None when not in it
+
+        self.part_type: str | None = None  # The type of the part being collected, None when not collecting
+        self.part_depth: int = 0  # The depth the part being collected started at
+        self.part_name: str | None = None  # The tag name of the part being collected
+        self.part_classes: list = []  # The classes of the part being collected
+        self.part_html: list = []  # The html pieces of the part being collected
+
+    # PART MANAGEMENT ##################################################################################################
+    def start_part(self, part_type, tag, attrs):
+        """
+        Starts collecting a new part.
+
+        :param str part_type: The type of the part, preface, chapters or afterword
+        :param str tag: The tag name the part starts with
+        :param list attrs: The attributes of the start tag
+
+        :return: Void
+        """
+        self.part_type = part_type
+        self.part_depth = len(self.open_tags)
+        self.part_name = tag
+        self.part_classes = (dict(attrs).get("class") or "").split()
+        self.part_html = []
+
+    def end_part(self):
+        """
+        Finishes the part being collected and adds it to the parts list.
+
+        :return: Void
+        """
+        self.parts.append((self.part_type, self.part_name, self.part_classes, "".join(self.part_html)))
+
+        self.part_type = None
+        self.part_html = []
+
+    def add_html(self, html):
+        """
+        Adds html to the part being collected. Ignored when no part is being collected.
+
+        :param str html: The html to add
+
+        :return: Void
+        """
+        if self.part_type is not None:
+            self.part_html.append(html)
+
+    # PARSER EVENTS ####################################################################################################
+    def handle_starttag(self, tag, attrs):
+        if self.part_type is None:
+            attr_dict = dict(attrs)
+            if tag == "div" and attr_dict.get("id") in ("preface", "afterword"):
+                self.start_part(attr_dict["id"], tag, attrs)
+            elif self.chapters_depth is not None and len(self.open_tags) == self.chapters_depth + 1:
+                self.start_part("chapters", tag, attrs)
+
+        self.add_html(self.get_starttag_text())
+
+        if tag in void_tags:  # NO END TAG COMING
+            if self.part_type is not None and len(self.open_tags) == self.part_depth:
+                self.end_part()
+            return
+
+        self.open_tags.append(tag)
+
+        if tag == "div" and self.chapters_depth is None and dict(attrs).get("id") == "chapters":
+            self.chapters_depth = len(self.open_tags) - 1
+
+    def handle_startendtag(self, tag, attrs):
+        if self.part_type is None and self.chapters_depth is not None \
+                and len(self.open_tags) == self.chapters_depth + 1:
+            self.start_part("chapters", tag, attrs)
+
+        self.add_html(self.get_starttag_text())
+
+        if self.part_type is not None and len(self.open_tags) == self.part_depth:
+            self.end_part()
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:  # Stray end tag, ignored the same as Beautiful Soup
+            return
+
+        self.add_html("</" + tag + ">")
+
+        # CLOSE EVERYTHING UP TO THE MATCHING TAG
+        while self.open_tags.pop() != tag:
+            pass
+
+        if self.part_type is not None and len(self.open_tags) <= self.part_depth:
+            self.end_part()
+
+        if self.chapters_depth is not None and len(self.open_tags) <= self.chapters_depth:
+            self.chapters_depth = None
+
+    def handle_data(self, data):
+        self.add_html(data)
+
+    def handle_entityref(self, name):
+        self.add_html("&" + name + ";")
+
+    def handle_charref(self, name):
+        self.add_html("&#" + name + ";")
+
+    def handle_comment(self, data):
+        self.add_html("<!--" + data + "-->")
+
+    def handle_decl(self, decl):
+        self.add_html("<!" + decl + ">")
+
+    def unknown_decl(self, data):
+        self.add_html("<![" + data + "]>")
+
+    def handle_pi(self, data):
+        self.add_html("<?" + data + ">")
+
+
+# SPLITTING ############################################################################################################
+def split_ao3(file):
+    """
+    Reads an ao3 html file in chunks and yields each part as soon as it has been read.
+
+    See AO3Splitter for the parts that are yielded.
+
+    :param file file: The open html file
+
+    :return: Iterator of (part type, tag name, classes, html) tuples
+    """
+    splitter = AO3Splitter()
+
+    chunk = file.read(chunk_size)
+    while chunk:
+        splitter.feed(chunk)
+
+        yield from splitter.parts
+        splitter.parts = []
+
+        chunk = file.read(chunk_size)
+
+    splitter.close()
+    yield from splitter.parts
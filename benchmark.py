@@ -0,0 +1,1610 @@
+"""
+Benchmarks for HTML Cleaner.
+
+Generates synthetic html so the cleaning functions can be timed without any source files.
+
+Run with:
+    python3 benchmark.py clean-tree
+    python3 benchmark.py parsers
+    python3 benchmark.py ao3-stream
+    python3 benchmark.py serialize
+    python3 benchmark.py skeleton
+    python3 benchmark.py suite --output results.json
+    python3 benchmark.py rules
+    python3 benchmark.py pipeline --latency 5
+    python3 benchmark.py watch
+    python3 benchmark.py fragments --works 50
+    python3 benchmark.py series --works 8
+    python3 benchmark.py ao3-memory --chapters 200
+    python3 benchmark.py lo-memory --chapters 100 --jobs 2
+    python3 benchmark.py prepass
+    python3 benchmark.py import-time
+    python3 benchmark.py formats --loads 2000
+"""
+
+# IMPORTS ##############################################################################################################
+import argparse  # Command line arguments
+from concurrent.futures import ProcessPoolExecutor  # A new process for each suite case
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess  # A new interpreter for each import timing
+import sys
+import tempfile
+import time
+import tracemalloc  # Peak memory of the python heap
+
+import bs4
+from bs4 import BeautifulSoup
+from bs4 import Comment
+
+# Custom classes
+import book
+import bookCleaner
+import ebookClean
+import fragmentCache
+import htmlManager
+import markupPrepass
+import memoryGuard
+import stageTimings
+import styleRules
+from book import Book
+from folderWatcher import FolderWatcher
+from styleRules import RuleTable
+
+# GLOBAL VARIABLES #####################################################################################################
+# The styles and section break used for the synthetic LibreOffice chapters. Matches format/example-lo.json
+benchmark_styles = {"h1": "chapHeading", "body": "chapter"}
+benchmark_sectionbreak = "###"
+benchmark_rule_table = RuleTable(benchmark_styles, benchmark_sectionbreak)
+
+# The folder of the example format files
+format_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "format")
+
+# The command lines timed by import-time, and whether they may load Beautiful Soup
+import_cases = {
+    "import": (["-c", "import ebookClean"], False),
+    "check": (["ebookClean.py", "--check", "example-lo"], False),
+    "bookCleaner": (["-c", "import bookCleaner"], True),
+}
+
+# The cases of the benchmark suite
+suite_cases = ["libreOffice", "ao3", "ao3-oneshot"]
+
+# Bodies the pre-pass must leave as clean_tree would clean them. Some are rewritten, some are parsed as they are
+prepass_edge_cases = [
+    "<p><span>###</span><span></span></p>",
+    "<p>###<font></font></p>",
+    "<p><span>&amp;nbsp;</span>###</p>",
+    "<p><span>a</span>&amp;nbsp;<span>b</span></p>",
+    "<p><span>&nbsp;</span>a</p>",
+    "<p><!--###--></p><p><span><!-- note --></span></p>",
+    "<pre align=\"left\"><span><font>POV one</font></span></pre>",
+    "<p>&am<span>p;</span> and \r<span>\n</span></p>",
+    "<center><p>block in center</p><font>inline</font></center>",
+    "<p><center>inside a paragraph</center></p>",
+    "<b><center>inside an inline tag</center></b>",
+    "<font><p>block in junk</p></font>",
+    "<ul>\n<font><li>item</li></font>\n</ul>",
+    "<table> <tr><td> <span>cell</span></td></tr></table>",
+    "<div align=\"center\"><span class=\"x\" align=left>kept span</span><span class>empty class</span></div>",
+    "<p>x < y <span>z</span><br/><SPAN>upper</SPAN><FONT SIZE=2>case</FONT></p>",
+    "<p>unclosed <span>span</p>",
+    "<p align='center'>###</p><h1 ALIGN=\"left\"><font>Heading</font></h1>",
+    "<p><span>x&amp;y</span>\n\n</p><span>a</span>\n\n<p>after a span</p>",
+    "<p><span>&amp;nbsp;<span>\n</span> </span><br></p>",
+    "<p><span>class</span> and <span class=\"c\">class</span> or <span class=\"c\">text</span></p>",
+]
+
+
+# SYNTHETIC HTML #######################################################################################################
+########################################################################################################################
+
+def generate_libreOffice_chapter(paragraphs, seed=0, junk=1.0):
+    """
+    Creates the html of a LibreOffice style chapter.
+
+    Includes the junk LibreOffice adds: spans, font tags, align attributes, centered text and lone &nbsp; paragraphs,
+    along with section breaks and <pre> POV notes.
+
+    :param int paragraphs: The number of paragraphs in the chapter
+    :param int seed: The random seed, the same seed gives the same chapter
+    :param float junk: The share of text paragraphs wrapped in span and font tags, from 0 to 1
+
+    :return: str
+    """
+    generator = random.Random(seed)
+
+    body = ["<h1 align=\"center\">Chapter {}</h1>".format(seed)]
+    for count in range(paragraphs):
+        roll = generator.random()
+        if roll < 0.05:
+            body.append("<p class=\"western\" align=\"center\">{}</p>".format(benchmark_sectionbreak))
+        elif roll < 0.1:
+            body.append("<p class=\"western\">&nbsp;</p>")
+        elif roll < 0.13:
+            body.append("<center><p>Centered paragraph {}</p></center>".format(count))
+        elif roll < 0.15:
+            body.append("<pre>POV: Character {}</pre>".format(count))
+        elif junk < 1 and generator.random() >= junk:
+            body.append("<p class=\"western\" align=\"justify\">Paragraph {} with some <i>styled</i> text and "
+                        "more words.</p>".format(count))
+        else:
+            body.append("<p class=\"western\" align=\"justify\"><span lang=\"en-GB\">Paragraph {} with "
+                        "<font face=\"Liberation Serif\">some <i>styled</i> text</font> and "
+                        "<span>&nbsp;more</span> words.</span></p>".format(count))
+
+    return ("<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0 Transitional//EN\">\n<html><head>"
+            "<meta http-equiv=\"content-type\" content=\"text/html; charset=utf-8\"/><title></title>"
+            "<style type=\"text/css\">p { margin-bottom: 0.25cm }</style></head>"
+            "<body lang=\"en-GB\" dir=\"ltr\">\n" + "\n".join(body) + "\n</body></html>")
+
+
+def generate_ao3_work(chapters, paragraphs, seed=0, notes=0.5, links=0.1):
+    """
+    Creates the html of an Archive of Our Own download.
+
+    Has a preface with tags, summary and notes, chapters with summaries and end notes, and an afterword. A single
+    chapter creates a oneshot.
+
+    :param int chapters: The number of chapters in the work
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int seed: The random seed, the same seed gives the same work
+    :param float notes: The share of chapters with a chapter summary, from 0 to 1
+    :param float links: The share of paragraphs with a link, from 0 to 1
+
+    :return: str
+    """
+    generator = random.Random(seed)
+
+    def chapter_text(chapter):
+        text = []
+        for count in range(paragraphs):
+            if generator.random() < links:
+                text.append("<p>Chapter {} paragraph {} <a href=\"https://example.org/{}\">linked</a>.</p>"
+                            .format(chapter, count, count))
+            else:
+                text.append("<p>Chapter {} paragraph {} with <em>some</em> text &amp; more.</p>"
+                            .format(chapter, count))
+        return "<div class=\"userstuff\">\n" + "\n".join(text) + "\n</div>\n"
+
+    html = ["<!DOCTYPE html>\n<html><head><meta charset=\"UTF-8\"/><title>Synthetic Work</title></head><body>\n"
+            "<div id=\"preface\">\n<p class=\"message\"><b>Archive of Our Own</b><br/>Posted originally on the "
+            "<a href=\"http://archiveofourown.org/\">Archive of Our Own</a> at "
+            "<a href=\"http://archiveofourown.org/works/{0}\">http://archiveofourown.org/works/{0}</a>.</p>\n"
+            "<div class=\"meta\"><dl class=\"tags\">\n"
+            "<dt>Rating:</dt>\n<dd><a href=\"http://archiveofourown.org/tags/General\">General</a></dd>\n"
+            "<dt>Fandom:</dt>\n<dd><a href=\"http://archiveofourown.org/tags/Fandom\">Fandom</a></dd>\n"
+            "<dt>Stats:</dt>\n<dd>Chapters: {1}/{1}</dd>\n</dl>\n"
+            "<h1>Synthetic Work {0}</h1>\n<div class=\"byline\">by <a rel=\"author\" "
+            "href=\"http://archiveofourown.org/users/author\">author</a></div>\n"
+            "<p>Summary</p>\n<blockquote class=\"userstuff\"><p>A synthetic summary.</p></blockquote>\n"
+            "<p>Notes</p>\n<blockquote class=\"userstuff\"><p>Some <span>work</span> notes.</p></blockquote>\n"
+            "</div>\n</div>\n<div id=\"chapters\" class=\"userstuff\">\n".format(seed, chapters)]
+
+    if chapters == 1:  # ONESHOT
+        html.append("<h2 class=\"toc-heading\">Synthetic Work {}</h2>\n".format(seed))
+        html.append(chapter_text(1))
+    else:
+        for chapter in range(1, chapters + 1):
+            html.append("<div class=\"meta group\">\n<h2 class=\"heading\">Chapter {}</h2>\n".format(chapter))
+            if generator.random() < notes:
+                html.append("<p>Chapter Summary</p>\n<blockquote class=\"userstuff\"><p>Summary of chapter {}."
+                            "</p></blockquote>\n".format(chapter))
+            html.append("</div>\n")
+            html.append(chapter_text(chapter))
+            html.append("<div class=\"meta group\">\n<p>Chapter End Notes</p>\n<blockquote class=\"userstuff\">"
+                        "<p>End notes of chapter {}.</p></blockquote>\n</div>\n".format(chapter))
+
+    html.append("</div>\n<div id=\"afterword\">\n<div id=\"endnotes\">\n<p>End Notes</p>\n"
+                "<blockquote class=\"userstuff\"><p>Thanks for reading.</p></blockquote>\n</div>\n</div>\n"
+                "</body></html>")
+
+    return "".join(html)
+
+
+def load_example_book(format_name, primary_path):
+    """
+    Loads an example format file with its source path pointed at synthetic html.
+
+    :param str format_name: The name of the example format, e.g. example-lo
+    :param str primary_path: The folder (LibreOffice) or file without extension (ao3) of the synthetic html
+
+    :return: Book
+    """
+    format_file = open(os.path.join(format_folder, format_name + ".json"), "r")
+    file_book = Book(0, format_file)
+    format_file.close()
+
+    file_book.primary_path = primary_path
+
+    return file_book
+
+
+def build_libreOffice_soup(chapter_html):
+    """
+    Creates the skeleton soup with the chapter contents, as build_libreOffice does before cleaning.
+
+    :param str chapter_html: The chapter html
+
+    :return: BeautifulSoup
+    """
+    file_soup = BeautifulSoup(chapter_html, "html.parser")
+
+    soup = htmlManager.create_base_xhtml({"epub:type": "chapter", "role": "doc-chapter"}, "Benchmark")
+    soup.section.append(file_soup.body)
+    soup.section.body.unwrap()
+
+    return soup
+
+
+def legacy_soup_to_file(soup, file_name):
+    """
+    Saves a soup the way soup_to_file used to, a thrown away html encode then a second serialization written as text.
+
+    :param BeautifulSoup soup: The soup to be saved to file
+    :param str file_name: The file name to save the soup under
+
+    :return: Void
+    """
+    output = open(file_name, "w")
+
+    soup.encode(formatter="html")
+    output.write(str(soup))
+
+    output.close()
+
+
+def save_parts(parts, file_book, show_progress=True):
+    """
+    Saves each built part of a book to the output folder of the book.
+
+    :param Iterator parts: The (file name, BeautifulSoup) tuples of the parts
+    :param Book file_book: The book details object
+    :param bool show_progress: Print the completed line as each file is saved
+    :return: list - The names of the saved files
+    """
+    saved_files = []  # names of all saved files
+    for part_name, soup in parts:
+        saved_files.append(htmlManager.soup_to_file(soup, file_book.output_folder + "/" + part_name, show_progress,
+                                                    file_book.formatter, file_book.atomic))
+
+    return saved_files
+
+
+def clean_ao3(main_soup, file_book, show_progress=True):
+    """
+    Cleans a generated html file from Archive of Our Own from a soup of the full work and saves the parts.
+
+    :param BeautifulSoup main_soup: The soup made from the generated html.
+    :param Book file_book: The book details object
+    :param bool show_progress: Print the completed line as each file is saved
+    :return: list - The names of the saved files
+    """
+    return save_parts(htmlManager.build_ao3(main_soup, file_book), file_book, show_progress)
+
+
+def clean_ao3_stream(file, file_book, show_progress=True):
+    """
+    Cleans a generated html file from Archive of Our Own while it is read, instead of from a soup of the full work.
+
+    Saves the same files as clean_ao3, see htmlManager.build_ao3_stream.
+
+    :param file file: The open html file
+    :param Book file_book: The book details object
+    :param bool show_progress: Print the completed line as each file is saved
+    :return: list - The names of the saved files
+    """
+    return save_parts(htmlManager.build_ao3_stream(file, file_book), file_book, show_progress)
+
+
+# REFERENCE CLEANING ###################################################################################################
+########################################################################################################################
+
+def sweep_clean(soup, styles, sectionbreak):
+    """
+    Cleans a soup with a separate find_all sweep for every rule, the way build_libreOffice used to.
+
+    Kept as the reference clean_tree is compared against.
+
+    :param BeautifulSoup soup: The soup to clean
+    :param dict styles: The style rules, tag name to css class
+    :param str sectionbreak: The section break symbol
+
+    :return: int - The number of sweeps through the soup
+    """
+    sweeps = 0
+
+    for tag_type in styles:
+        sweeps += 1
+        for styled_tag in soup.find_all(tag_type):
+            styled_tag["class"] = styles[tag_type]
+
+    sweeps += 1
+    for linebreak in soup.find_all("p", string=sectionbreak):
+        linebreak_tag = soup.new_tag("hr")
+        linebreak_tag["class"] = "linebreak"
+        linebreak.replace_with(linebreak_tag)
+
+    htmlManager.clear_span(soup)
+    htmlManager.clear_font(soup)
+    htmlManager.clear_lone_nbsp(soup)
+    htmlManager.remove_dissallowed_attributes(soup)
+    sweeps += 5
+
+    sweeps += 1
+    for tag in soup.find_all("pre"):
+        tag.replace_with(Comment(tag.string))
+
+    return sweeps
+
+
+# BENCHMARKS ###########################################################################################################
+########################################################################################################################
+
+def benchmark_clean_tree(paragraphs, chapters):
+    """
+    Compares the single walk of clean_tree against the separate find_all sweeps.
+
+    Every chapter is checked to give the same output with both.
+
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int chapters: The number of chapters to time
+
+    :return: dict - The results
+    """
+    sweep_time = 0.0
+    walk_time = 0.0
+    sweeps = 0
+
+    for seed in range(chapters):
+        chapter_html = generate_libreOffice_chapter(paragraphs, seed)
+
+        sweep_soup = build_libreOffice_soup(chapter_html)
+        start = time.perf_counter()
+        sweeps = sweep_clean(sweep_soup, benchmark_styles, benchmark_sectionbreak)
+        sweep_time += time.perf_counter() - start
+
+        walk_soup = build_libreOffice_soup(chapter_html)
+        start = time.perf_counter()
+        htmlManager.clean_tree(walk_soup, benchmark_rule_table, True)
+        walk_time += time.perf_counter() - start
+
+        if str(sweep_soup) != str(walk_soup):
+            raise AssertionError("clean_tree output differs from the sweeps for chapter seed {}".format(seed))
+
+    return {
+        "chapters": chapters,
+        "paragraphs": paragraphs,
+        "sweeps": {"traversals": sweeps, "ms_per_chapter": sweep_time * 1000 / chapters},
+        "clean_tree": {"traversals": 1, "ms_per_chapter": walk_time * 1000 / chapters},
+    }
+
+
+def clean_example_formats(folder, parser, chapters, paragraphs):
+    """
+    Writes synthetic html for the example formats into a folder and cleans it with a parser engine.
+
+    The LibreOffice example is a folder of chapters and the ao3 example is both a multi-chapter work and a oneshot.
+
+    :param str folder: An empty folder to write the html and the final files to
+    :param str parser: The parser engine to use
+    :param int chapters: The number of chapters
+    :param int paragraphs: The number of paragraphs per chapter
+
+    :return: tuple - A dict of the final file name to its contents and the seconds spent cleaning
+    """
+    working_folder = os.getcwd()
+    os.chdir(folder)  # Final files are saved relative to the working folder
+    try:
+        os.makedirs("final", exist_ok=True)
+        os.makedirs("libreOffice", exist_ok=True)
+
+        lo_book = load_example_book("example-lo", "libreOffice")
+        for count in range(1, chapters + 1):
+            with open("libreOffice/" + lo_book.file_name.format(count) + ".html", "w") as file:
+                file.write(generate_libreOffice_chapter(paragraphs, count))
+        for file_name in lo_book.additional_paths:
+            with open("libreOffice/" + file_name + ".html", "w") as file:
+                file.write(generate_libreOffice_chapter(paragraphs, chapters + len(file_name)))
+
+        for work_chapters in (chapters, 1):
+            with open("work-{}.html".format(work_chapters), "w") as file:
+                file.write(generate_ao3_work(work_chapters, paragraphs, work_chapters))
+
+        outputs = {}
+        elapsed = 0.0
+
+        # LIBREOFFICE
+        lo_book.parser = parser
+        start = time.perf_counter()
+        for count in range(1, chapters + 1):
+            htmlManager.clean_libreOffice_file("libreOffice/" + lo_book.file_name.format(count) + ".html", lo_book,
+                                               count, False)
+        for file_name in lo_book.additional_paths:
+            htmlManager.clean_libreOffice_file("libreOffice/" + file_name + ".html", lo_book, file_name, False)
+        elapsed += time.perf_counter() - start
+        outputs.update(read_final_files("libreOffice-"))
+
+        # AO3 - MULTI-CHAPTER AND ONESHOT
+        for work_chapters in (chapters, 1):
+            ao3_book = load_example_book("example-ao3", "work-{}".format(work_chapters))
+            ao3_book.rules["oneshot"] = work_chapters == 1
+
+            start = time.perf_counter()
+            with open(ao3_book.primary_path + ".html", "r") as file:
+                clean_ao3(BeautifulSoup(file, parser), ao3_book, False)
+            elapsed += time.perf_counter() - start
+            outputs.update(read_final_files("ao3-{}-".format(work_chapters)))
+    finally:
+        os.chdir(working_folder)
+
+    return outputs, elapsed
+
+
+def read_final_files(prefix):
+    """
+    Reads and removes every file in the final folder.
+
+    :param str prefix: Added to the start of each file name
+
+    :return: dict - File name to contents
+    """
+    outputs = {}
+    for file_name in sorted(os.listdir("final")):
+        with open("final/" + file_name, "rb") as file:
+            outputs[prefix + file_name] = file.read()
+        os.remove("final/" + file_name)
+
+    return outputs
+
+
+def benchmark_parsers(chapters, paragraphs):
+    """
+    Cleans the example formats with every installed parser engine and checks they all give the same xhtml.
+
+    :param int chapters: The number of chapters
+    :param int paragraphs: The number of paragraphs per chapter
+
+    :return: dict - The results
+    """
+    results = {}
+    reference = None
+
+    for parser in htmlManager.parser_engines:
+        if htmlManager.get_parser(parser) != parser:  # NOT INSTALLED
+            continue
+
+        with tempfile.TemporaryDirectory() as folder:
+            outputs, elapsed = clean_example_formats(folder, parser, chapters, paragraphs)
+
+        if reference is None:
+            reference = (parser, outputs)
+        elif outputs != reference[1]:
+            different = [name for name in reference[1] if outputs.get(name) != reference[1][name]]
+            raise AssertionError("{} output differs from {}: {}".format(parser, reference[0], ", ".join(different)))
+
+        results[parser] = {"files": len(outputs), "seconds": elapsed}
+
+    return results
+
+
+def benchmark_ao3_stream(chapters, paragraphs):
+    """
+    Compares the time and peak memory of clean_ao3 on the full soup against clean_ao3_stream.
+
+    Both must save the same files.
+
+    :param int chapters: The number of chapters in the work
+    :param int paragraphs: The number of paragraphs per chapter
+
+    :return: dict - The results
+    """
+    results = {}
+    reference = None
+
+    with tempfile.TemporaryDirectory() as folder:
+        working_folder = os.getcwd()
+        os.chdir(folder)  # Final files are saved relative to the working folder
+        try:
+            os.makedirs("final")
+            with open("work.html", "w") as file:
+                file.write(generate_ao3_work(chapters, paragraphs))
+            source_size = os.path.getsize("work.html")
+
+            for mode in ("full", "stream"):
+                file_book = load_example_book("example-ao3", "work")
+                file_book.rules["oneshot"] = chapters == 1
+
+                gc.collect()  # Don't count garbage left by the last mode
+                tracemalloc.start()
+                start = time.perf_counter()
+                with open("work.html", "r") as file:
+                    if mode == "full":
+                        clean_ao3(BeautifulSoup(file, htmlManager.get_parser(file_book.parser)), file_book, False)
+                    else:
+                        clean_ao3_stream(file, file_book, False)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                outputs = read_final_files("")
+                if reference is None:
+                    reference = outputs
+                elif outputs != reference:
+                    raise AssertionError("clean_ao3_stream output differs from clean_ao3")
+
+                results[mode] = {"seconds": elapsed, "peak_mb": peak / 1024 / 1024}
+        finally:
+            os.chdir(working_folder)
+
+    results["source_mb"] = source_size / 1024 / 1024
+    return results
+
+
+def benchmark_ao3_memory(chapters, paragraphs, samples=5):
+    """
+    Follows the memory held while the parts of an ao3 work are built from the full soup. The python heap and the
+    resident memory are sampled after the work is parsed and as the parts are given out.
+
+    :param int chapters: The number of chapters in the work
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int samples: How many times the memory is sampled while the parts are given out
+
+    :return: dict - The results
+    """
+    file_book = load_example_book("example-ao3", "")
+    file_book.rules["oneshot"] = chapters == 1
+    source = generate_ao3_work(chapters, paragraphs)
+
+    gc.collect()
+    tracemalloc.start()
+    main_soup = htmlManager.parse_html(source, htmlManager.get_parser(file_book.parser))
+    del source
+
+    def sample(label):
+        gc.collect()
+        return {"part": label, "heap_mb": tracemalloc.get_traced_memory()[0] / 1024 / 1024,
+                "rss_mb": stageTimings.get_rss()}
+
+    parts = chapters + 2  # The preface and the afterword
+    sample_every = max(parts // samples, 1)
+    memory = [sample("parsed")]
+    for count, (part_name, soup) in enumerate(htmlManager.build_ao3(main_soup, file_book), 1):
+        htmlManager.soup_to_bytes(soup)
+        if count % sample_every == 0:
+            memory.append(sample(part_name))
+
+    main_soup.decompose()
+    memory.append(sample("released"))
+
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"memory": memory, "peak_heap_mb": peak / 1024 / 1024, "peak_rss_mb": stageTimings.get_peak_rss()}
+
+
+def benchmark_lo_memory(chapters, paragraphs, jobs=2, samples=5):
+    """
+    Follows the memory held while a LibreOffice book is cleaned one chapter at a time, then checks that worker processes
+    throttled by the memory guard save the same files.
+
+    The python heap is sampled as the chapters are given out, it should stay flat as each chapter is released once it
+    is encoded. The guarded run uses a 1 MB limit so the workers are throttled from the first file.
+
+    :param int chapters: The number of chapters
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int jobs: The number of worker processes for the guarded run
+    :param int samples: How many times the memory is sampled while the chapters are given out
+
+    :return: dict - The results
+    """
+    corpus = {"chapters": chapters, "paragraphs": paragraphs, "junk": 1.0}
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_book = write_suite_corpus("libreOffice", folder, corpus)
+        file_book.parser = htmlManager.get_parser(file_book.parser)
+
+        def sample(label):
+            gc.collect()
+            return {"part": label, "heap_mb": tracemalloc.get_traced_memory()[0] / 1024 / 1024,
+                    "rss_mb": stageTimings.get_rss()}
+
+        # ONE CHAPTER AT A TIME IN THIS PROCESS
+        gc.collect()
+        tracemalloc.start()
+        sample_every = max(chapters // samples, 1)
+        memory = [sample("start")]
+        for count, (part_name, xhtml) in enumerate(bookCleaner.clean_book(file_book), 1):
+            if count % sample_every == 0:
+                memory.append(sample(part_name))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # WORKERS WITH AND WITHOUT THE GUARD
+        throttles = []
+
+        def record_throttle(name, status):
+            if status == bookCleaner.throttled:
+                throttles.append(name)
+
+        outputs = {}
+        for name, limit in (("unguarded", None), ("guarded", 1)):
+            file_book.output_folder = folder + "/" + name
+            os.makedirs(file_book.output_folder)
+
+            memoryGuard.memory_limit = limit
+            try:
+                start = time.perf_counter()
+                saved_files = bookCleaner.save_book(file_book, record_throttle, jobs=jobs)
+                elapsed = time.perf_counter() - start
+            finally:
+                memoryGuard.memory_limit = None
+
+            outputs[name] = []
+            for file_name in saved_files:
+                with open(file_name, "rb") as file:
+                    outputs[name].append(file.read())
+            memory.append({"part": "{} {:.2f} s".format(name, elapsed), "heap_mb": None,
+                           "rss_mb": stageTimings.get_rss()})
+
+    if outputs["unguarded"] != outputs["guarded"]:
+        raise AssertionError("The guarded output differs from the unguarded output")
+    if not throttles:
+        raise AssertionError("The guarded run was never throttled")
+
+    return {"memory": memory, "peak_heap_mb": peak / 1024 / 1024, "throttles": len(throttles)}
+
+
+def benchmark_serialize(chapters, paragraphs, repeats=5):
+    """
+    Compares the throughput of saving cleaned chapters with the old soup_to_file against each soup_to_file option.
+
+    The minimal formatter must save the same bytes as the old path.
+
+    :param int chapters: The number of chapters to save
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int repeats: How many times every chapter is saved by each mode
+
+    :return: dict - The results
+    """
+    soups = []
+    for seed in range(chapters):
+        soup = build_libreOffice_soup(generate_libreOffice_chapter(paragraphs, seed))
+        htmlManager.clean_tree(soup, benchmark_rule_table, True)
+        soups.append(soup)
+
+    modes = {
+        "legacy": legacy_soup_to_file,
+        "minimal": lambda soup, file_name: htmlManager.soup_to_file(soup, file_name, False, "minimal"),
+        "atomic": lambda soup, file_name: htmlManager.soup_to_file(soup, file_name, False, "minimal", True),
+        "html": lambda soup, file_name: htmlManager.soup_to_file(soup, file_name, False, "html"),
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for mode, save in modes.items():
+            written = 0
+            start = time.perf_counter()
+            for run in range(repeats):
+                for count, soup in enumerate(soups):
+                    file_name = "{}/{}-{}.xhtml".format(folder, mode, count)
+                    save(soup, file_name)
+                    written += os.path.getsize(file_name)
+            elapsed = time.perf_counter() - start
+
+            results[mode] = {"seconds": elapsed, "mb_per_second": written / 1024 / 1024 / elapsed}
+
+        for count in range(chapters):
+            with open("{}/legacy-{}.xhtml".format(folder, count), "rb") as legacy_file, \
+                    open("{}/minimal-{}.xhtml".format(folder, count), "rb") as minimal_file:
+                if legacy_file.read() != minimal_file.read():
+                    raise AssertionError("soup_to_file output differs from the old path for chapter {}".format(count))
+
+    return results
+
+
+def benchmark_skeleton(documents):
+    """
+    Compares the setup of each new document, building the skeleton from scratch against copying the cached template,
+    and creating a throwaway soup for a new tag against the shared tag factory.
+
+    The copied skeletons must give the same xhtml as the built ones.
+
+    :param int documents: The number of documents to set up
+
+    :return: dict - The results, in microseconds per document
+    """
+    epub_roles = {"epub:type": "chapter", "role": "doc-chapter"}
+
+    def build_skeleton(count):
+        soup = htmlManager.build_base_xhtml(epub_roles)
+        soup.title.string = "Chapter {}".format(count)
+        return soup
+
+    def copy_skeleton(count):
+        return htmlManager.create_base_xhtml(epub_roles, "Chapter {}".format(count))
+
+    for count in range(3):
+        if str(build_skeleton(count)) != str(copy_skeleton(count)):
+            raise AssertionError("The copied skeleton differs from the built skeleton")
+
+    modes = {
+        "build": build_skeleton,
+        "template": copy_skeleton,
+        "new soup tag": lambda count: BeautifulSoup("", "html.parser").new_tag("i"),
+        "factory tag": lambda count: htmlManager.tag_factory.new_tag("i"),
+    }
+
+    results = {}
+    for mode, setup in modes.items():
+        start = time.perf_counter()
+        for count in range(documents):
+            setup(count)
+        results[mode] = (time.perf_counter() - start) * 1000000 / documents
+
+    return results
+
+
+# SUITE ################################################################################################################
+########################################################################################################################
+
+def write_suite_corpus(case, folder, corpus):
+    """
+    Writes the synthetic source html of a suite case into a folder.
+
+    :param str case: The suite case, libreOffice, ao3 or ao3-oneshot
+    :param str folder: The folder to write the html to
+    :param dict corpus: The corpus settings, chapters, paragraphs, junk, notes and links
+
+    :return: Book - The book of the case, pointed at the html
+    """
+    if case == "libreOffice":
+        file_book = load_example_book("example-lo", folder + "/libreOffice")
+        os.makedirs(file_book.primary_path, exist_ok=True)
+
+        for count in range(1, corpus["chapters"] + 1):
+            with open(file_book.primary_path + "/" + file_book.file_name.format(count) + ".html", "w") as file:
+                file.write(generate_libreOffice_chapter(corpus["paragraphs"], count, corpus["junk"]))
+        for file_name in file_book.additional_paths:
+            with open(file_book.primary_path + "/" + file_name + ".html", "w") as file:
+                file.write(generate_libreOffice_chapter(corpus["paragraphs"], corpus["chapters"] + len(file_name),
+                                                        corpus["junk"]))
+    else:
+        chapters = 1 if case == "ao3-oneshot" else corpus["chapters"]
+
+        file_book = load_example_book("example-ao3", folder + "/work")
+        file_book.rules["oneshot"] = chapters == 1
+
+        with open(file_book.primary_path + ".html", "w") as file:
+            file.write(generate_ao3_work(chapters, corpus["paragraphs"], chapters, corpus["notes"], corpus["links"]))
+
+    return file_book
+
+
+def get_source_files(file_book):
+    """
+    Gets the source html files of a suite book.
+
+    :param Book file_book: The book details object
+
+    :return: list - The file paths
+    """
+    if file_book.type == "ao3":
+        return [file_book.primary_path + ".html"]
+
+    return [file_book.primary_path + "/" + file_name for file_name in sorted(os.listdir(file_book.primary_path))]
+
+
+def time_stages(file_book):
+    """
+    Cleans a suite book again with each stage timed on its own.
+
+    The stages are parse (source html to soup), clean (building and cleaning the xhtml soups) and serialize (saving
+    the xhtml).
+
+    :param Book file_book: The book details object, already cleaned once
+
+    :return: dict - The seconds spent in each stage
+    """
+    stages = {"parse": 0.0, "clean": 0.0, "serialize": 0.0}
+    parser = htmlManager.get_parser(file_book.parser)
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        stages[stage] += time.perf_counter() - start
+        return result
+
+    def parse_file(file_path):
+        with open(file_path, "r") as file:
+            return BeautifulSoup(file, parser)
+
+    if file_book.type == "ao3":
+        main_soup = timed("parse", parse_file, file_book.primary_path + ".html")
+
+        parts = htmlManager.build_ao3(main_soup, file_book)
+        part = timed("clean", next, parts, None)
+        while part is not None:
+            timed("serialize", htmlManager.soup_to_file, part[1], file_book.output_folder + "/" + part[0], False)
+            part = timed("clean", next, parts, None)
+    else:
+        chapters, additional = bookCleaner.find_libreOffice_parts(file_book)
+        for part_path, count in chapters + additional:
+            file_soup = timed("parse", parse_file, part_path)
+            soup = timed("clean", htmlManager.build_libreOffice, file_soup, file_book, count)
+            timed("serialize", htmlManager.soup_to_file, soup, htmlManager.libreOffice_final_name(file_book, count),
+                  False)
+
+    return stages
+
+
+def run_suite_case(case, corpus, parser, repeats=3):
+    """
+    Runs one suite case end to end. Runs in its own process so the peak RSS only covers this case.
+
+    The end to end time and the stage times are the fastest of the repeats.
+
+    :param str case: The suite case, libreOffice, ao3 or ao3-oneshot
+    :param dict corpus: The corpus settings, chapters, paragraphs, junk, notes and links
+    :param str parser: The parser engine to use
+    :param int repeats: How many times the case is run
+
+    :return: dict - The results of the case
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        file_book = write_suite_corpus(case, folder, corpus)
+        file_book.parser = htmlManager.get_parser(parser)
+        file_book.output_folder = folder + "/final"
+        os.makedirs(file_book.output_folder)
+
+        source_bytes = sum(os.path.getsize(path) for path in get_source_files(file_book))
+
+        # END TO END
+        elapsed = None
+        for run in range(repeats):
+            gc.collect()
+            start = time.perf_counter()
+            saved_files = bookCleaner.save_book(file_book)
+            run_time = time.perf_counter() - start
+            elapsed = run_time if elapsed is None else min(elapsed, run_time)
+        peak_rss = stageTimings.get_peak_rss()
+
+        output_bytes = sum(os.path.getsize(path) for path in saved_files)
+
+        # EACH STAGE
+        stages = None
+        for run in range(repeats):
+            run_stages = time_stages(file_book)
+            stages = run_stages if stages is None else {stage: min(stages[stage], run_stages[stage])
+                                                        for stage in stages}
+
+    return {
+        "parser": file_book.parser,
+        "files": len(saved_files),
+        "source_mb": source_bytes / 1024 / 1024,
+        "output_mb": output_bytes / 1024 / 1024,
+        "seconds": elapsed,
+        "chapters_per_second": len(saved_files) / elapsed,
+        "mb_per_second": source_bytes / 1024 / 1024 / elapsed,
+        "peak_rss_mb": peak_rss,
+        "stages": stages,
+    }
+
+
+def benchmark_suite(corpus, parser, repeats=3, cases=suite_cases):
+    """
+    Runs every suite case, each in a new process, and collects the results.
+
+    :param dict corpus: The corpus settings, chapters, paragraphs, junk, notes and links
+    :param str parser: The parser engine to use
+    :param int repeats: How many times each case is run, the fastest run is kept
+    :param list cases: The suite cases to run
+
+    :return: dict - The results, with the settings and versions they were run with
+    """
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "beautifulsoup": bs4.__version__,
+        "corpus": corpus,
+        "repeats": repeats,
+        "cases": {},
+    }
+
+    for case in cases:
+        # A NEW PROCESS FOR EACH CASE, THE PEAK RSS OF THIS PROCESS INCLUDES THE CASES BEFORE IT
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results["cases"][case] = executor.submit(run_suite_case, case, corpus, parser, repeats).result()
+
+    return results
+
+
+def compare_suite(results, baseline):
+    """
+    Prints the change of each suite case against an earlier run.
+
+    :param dict results: The results of this run
+    :param dict baseline: The results of the earlier run
+
+    :return: Void
+    """
+    for case, case_results in results["cases"].items():
+        if case not in baseline["cases"]:
+            continue
+        old_results = baseline["cases"][case]
+
+        changes = []
+        for measure in ("chapters_per_second", "mb_per_second", "peak_rss_mb"):
+            if case_results[measure] and old_results.get(measure):
+                change = (case_results[measure] / old_results[measure] - 1) * 100
+                changes.append("{} {:+.1f}%".format(measure, change))
+        print("{:<12} {}".format(case, "   ".join(changes)))
+
+
+def benchmark_rules(paragraphs, chapters, rules):
+    """
+    Times clean_tree with a large table of style rules, with the selectors kept by tag name against every selector
+    tried on every tag.
+
+    Half the rules are tag names and half are CSS selectors. Both tables must give the same output.
+
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int chapters: The number of chapters to time
+    :param int rules: The number of style rules
+
+    :return: dict - The results
+    """
+    styles = dict(benchmark_styles)
+    for count in range(rules // 2):
+        styles["h{}x".format(count)] = "tag-{}".format(count)  # Tag names that are never found
+        styles["div.part-{} > p".format(count)] = "selector-{}".format(count)
+    styles["p.western + p"] = "after-western"
+
+    bucketed_table = RuleTable(styles, benchmark_sectionbreak)
+
+    # THE SAME RULES WITHOUT BUCKETS - EVERY SELECTOR IS TRIED ON EVERY TAG
+    flat_table = RuleTable(styles, benchmark_sectionbreak)
+    flat_table.selector_classes = {styleRules.any_tag: [rule for bucket in bucketed_table.selector_classes.values()
+                                                        for rule in bucket]}
+
+    results = {"chapters": chapters, "rules": len(styles)}
+    for name, rule_table in (("flat", flat_table), ("bucketed", bucketed_table)):
+        outputs = []
+        elapsed = 0.0
+        for seed in range(chapters):
+            soup = build_libreOffice_soup(generate_libreOffice_chapter(paragraphs, seed))
+            start = time.perf_counter()
+            htmlManager.clean_tree(soup, rule_table, True)
+            elapsed += time.perf_counter() - start
+            outputs.append(str(soup))
+
+        results[name] = {"ms_per_chapter": elapsed * 1000 / chapters, "outputs": outputs}
+
+    if results["flat"].pop("outputs") != results["bucketed"].pop("outputs"):
+        raise AssertionError("The bucketed rule table output differs from the flat table")
+
+    return results
+
+
+def build_libreOffice_bytes(markup, file_book, parser, prepass):
+    """
+    Cleans the html of a LibreOffice chapter as save_book does, with or without the pre-pass.
+
+    :param str markup: The chapter html
+    :param Book file_book: The book details object
+    :param str parser: The parser engine
+    :param bool prepass: Remove the junk from the text before it is parsed
+
+    :return: bytes - The xhtml
+    """
+    if prepass:
+        markup = markupPrepass.prepass_markup(markup, file_book.rule_table)
+
+    soup = htmlManager.build_libreOffice(htmlManager.parse_html(markup, parser), file_book, 1)
+
+    return htmlManager.soup_to_bytes(soup, file_book.formatter)
+
+
+def benchmark_prepass(chapters, paragraphs, junk, repeats=3):
+    """
+    Checks the pre-pass against the cleaning without it, then times both.
+
+    Every synthetic chapter and edge case is cleaned with every installed parser, with and without the pre-pass, and
+    the xhtml must be the same. The edge cases cover what the pre-pass must not rewrite, or rewrite with care.
+
+    :param int chapters: The number of synthetic chapters
+    :param int paragraphs: The number of paragraphs per chapter
+    :param float junk: The share of text paragraphs wrapped in span and font tags
+    :param int repeats: Runs of each timing, the fastest is kept
+
+    :return: dict - The results
+    """
+    file_book = load_example_book("example-lo", "")
+    file_book.chapter_title = "Chapter {}"
+
+    skeleton = generate_libreOffice_chapter(0)
+    corpus = [generate_libreOffice_chapter(paragraphs, seed, junk) for seed in range(chapters)]
+    edge_cases = [skeleton.replace("\n</body>", "\n" + body + "\n</body>") for body in prepass_edge_cases]
+
+    # DIFFERENTIAL CHECK
+    rewritten = sum(markupPrepass.prepass_markup(markup, file_book.rule_table) != markup
+                    for markup in corpus + edge_cases)
+    parsers = [parser for parser in htmlManager.parser_engines if htmlManager.get_parser(parser) == parser]
+    for parser in parsers:
+        for markup in corpus + edge_cases:
+            if build_libreOffice_bytes(markup, file_book, parser, False) != \
+                    build_libreOffice_bytes(markup, file_book, parser, True):
+                raise AssertionError("The pre-pass changed the output with " + parser + ":\n" + markup)
+
+    # TIMINGS
+    results = {"documents": len(corpus) + len(edge_cases), "rewritten": rewritten, "parsers": parsers}
+    for name, prepass in (("dom", False), ("prepass", True)):
+        seconds = []
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            for markup in corpus:
+                build_libreOffice_bytes(markup, file_book, htmlManager.get_parser(), prepass)
+            seconds.append(time.perf_counter() - start)
+
+        results[name] = {"ms_per_chapter": min(seconds) * 1000 / chapters}
+
+    start = time.perf_counter()
+    for markup in corpus:
+        markupPrepass.prepass_markup(markup, file_book.rule_table)
+    results["prepass"]["rewrite_ms_per_chapter"] = (time.perf_counter() - start) * 1000 / chapters
+
+    return results
+
+
+def benchmark_formats(loads):
+    """
+    Times loading the example formats again and again, parsing and validating each time against the cached load.
+
+    :param int loads: The number of loads of each format
+
+    :return: dict - The results
+    """
+    format_paths = [os.path.join(format_folder, file_name) for file_name in sorted(os.listdir(format_folder))
+                    if file_name.endswith(".json")]
+
+    def load_uncached(format_path):
+        with open(format_path, "r") as format_file:
+            return Book(0, format_file)
+
+    results = {"formats": len(format_paths), "loads": loads}
+    for name, load in (("parsed", load_uncached), ("cached", book.load_book)):
+        book.format_cache.clear()
+        start = time.perf_counter()
+        for repeat in range(loads):
+            for format_path in format_paths:
+                load(format_path)
+        results[name] = {"us_per_load": (time.perf_counter() - start) * 1000000 / (loads * len(format_paths))}
+
+    return results
+
+
+def time_imports(arguments):
+    """
+    Runs python with -X importtime in a new interpreter, from the folder of the tool.
+
+    :param list arguments: The arguments after the interpreter options
+
+    :return: dict - The wall seconds, the total import microseconds and the cumulative microseconds of each module
+    """
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime"] + arguments, capture_output=True, text=True,
+                               cwd=os.path.dirname(format_folder))
+    seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError("The import timing failed:\n" + completed.stderr)
+
+    modules = {}
+    total = 0
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():  # The header
+            continue
+
+        modules[name.strip()] = int(cumulative)
+        if not name[1:].startswith(" "):  # Top level imports, the others are inside them
+            total += int(cumulative)
+
+    return {"seconds": seconds, "import_us": total, "modules": modules}
+
+
+def benchmark_import_time(repeats=5):
+    """
+    Times the start up of the command line tool in new interpreters, and checks the paths that must not load Beautiful
+    Soup do not. The fastest run of each case is kept.
+
+    :param int repeats: Runs of each case
+
+    :return: dict - The results of each case
+    """
+    results = {}
+    for name, (arguments, loads_bs4) in import_cases.items():
+        runs = [time_imports(arguments) for repeat in range(repeats)]
+        fastest = min(runs, key=lambda run: run["seconds"])
+
+        bs4_loaded = "bs4" in fastest["modules"]
+        if bs4_loaded and not loads_bs4:
+            slowest = sorted(fastest["modules"].items(), key=lambda module: module[1], reverse=True)[:5]
+            raise AssertionError("'{}' loads Beautiful Soup, the slowest imports are {}".format(name, slowest))
+
+        results[name] = {"ms": fastest["seconds"] * 1000, "import_ms": min(run["import_us"] for run in runs) / 1000,
+                         "bs4": bs4_loaded}
+
+    return results
+
+
+def add_latency(function, latency):
+    """
+    Wraps a file function so each call waits first, like a read or write on network storage.
+
+    :param function function: The function to wrap
+    :param float latency: The seconds to wait before each call
+
+    :return: function
+    """
+    def slow_function(*args, **kwargs):
+        time.sleep(latency)
+        return function(*args, **kwargs)
+
+    return slow_function
+
+
+def benchmark_pipeline(chapters, paragraphs, prefetch, latency=0.0, repeats=3):
+    """
+    Times saving a LibreOffice book one file at a time against the filePipeline, which overlaps the reads and writes
+    with the cleaning.
+
+    Slow storage is simulated by waiting before every read and write.
+
+    :param int chapters: The number of chapters
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int prefetch: The prefetch of the pipeline
+    :param float latency: The seconds added to every read and write
+    :param int repeats: Runs of each, the fastest is kept
+
+    :return: dict - The results
+    """
+    corpus = {"chapters": chapters, "paragraphs": paragraphs, "junk": 1.0}
+    read_html = htmlManager.read_html
+    write_bytes = htmlManager.write_bytes
+
+    results = {"chapters": chapters, "latency_ms": latency * 1000}
+    with tempfile.TemporaryDirectory() as folder:
+        file_book = write_suite_corpus("libreOffice", folder, corpus)
+        file_book.parser = htmlManager.get_parser(file_book.parser)
+
+        htmlManager.read_html = add_latency(read_html, latency)
+        htmlManager.write_bytes = add_latency(write_bytes, latency)
+        try:
+            outputs = {}
+            for name, run_prefetch in (("sequential", 0), ("pipeline", prefetch)):
+                file_book.output_folder = folder + "/" + name
+                os.makedirs(file_book.output_folder)
+
+                elapsed = None
+                for run in range(repeats):
+                    start = time.perf_counter()
+                    saved_files = bookCleaner.save_book(file_book, prefetch=run_prefetch)
+                    run_time = time.perf_counter() - start
+                    elapsed = run_time if elapsed is None else min(elapsed, run_time)
+
+                outputs[name] = []
+                for file_name in saved_files:
+                    with open(file_name, "rb") as file:
+                        outputs[name].append(file.read())
+                results[name] = {"seconds": elapsed, "chapters_per_second": len(saved_files) / elapsed}
+        finally:
+            htmlManager.read_html = read_html
+            htmlManager.write_bytes = write_bytes
+
+    if outputs["sequential"] != outputs["pipeline"]:
+        raise AssertionError("The pipeline output differs from the sequential output")
+
+    return results
+
+
+def write_watched_file(watcher, file_path, markup):
+    """
+    Saves a source file in a watched folder and polls until the watcher reports it.
+
+    :param FolderWatcher watcher: The watcher of the folder
+    :param str file_path: The path of the file
+    :param str markup: The html to save
+
+    :return: list - The changed paths reported with the file
+    """
+    with open(file_path, "w") as file:
+        file.write(markup)
+
+    for poll in range(100):
+        changed = watcher.poll()
+        if file_path in changed:
+            return changed
+        time.sleep(0.01)
+
+    raise AssertionError("The watcher never reported " + file_path)
+
+
+def benchmark_watch(paragraphs, repeats=3):
+    """
+    Times cleaning a changed chapter while a LibreOffice book is watched, from the change being reported to the chapter
+    being saved.
+
+    Before each change a broken chapter and a chapter removed before it is read are saved. Each must be reported as
+    failed, and the watch must carry on and save the next change.
+
+    :param int paragraphs: The number of paragraphs of the chapter
+    :param int repeats: Changes timed, the fastest is kept
+
+    :return: dict - The results
+    """
+    markup = generate_libreOffice_chapter(paragraphs, 1)
+    broken = markup.replace("</body>", "<pre><br></pre>\n</body>")  # Two strings in a <pre> can't be a comment
+
+    results = {"paragraphs": paragraphs}
+    with tempfile.TemporaryDirectory() as folder:
+        file_book = write_suite_corpus("libreOffice", folder, {"chapters": 3, "paragraphs": paragraphs, "junk": 1.0})
+        file_book.parser = htmlManager.get_parser(file_book.parser)
+        file_book.output_folder = folder + "/final"
+        os.makedirs(file_book.output_folder)
+
+        watcher = FolderWatcher(bookCleaner.get_source_folder(file_book))
+        bookCleaner.save_book(file_book)
+        chapter_path = file_book.primary_path + "/" + file_book.file_name.format(1) + ".html"
+
+        output = io.StringIO()
+        elapsed = None
+        with contextlib.redirect_stdout(output):
+            for run in range(repeats):
+                # BROKEN HTML
+                if ebookClean.save_watched(file_book, write_watched_file(watcher, chapter_path, broken)):
+                    raise AssertionError("The broken chapter was saved")
+
+                # REMOVED BETWEEN THE POLL AND THE READ
+                changed = write_watched_file(watcher, chapter_path, markup)
+                os.remove(chapter_path)
+                if ebookClean.save_watched(file_book, changed):
+                    raise AssertionError("The removed chapter was saved")
+
+                # THE WATCH CARRIES ON
+                changed = write_watched_file(watcher, chapter_path, markup)
+                start = time.perf_counter()
+                saved_files = ebookClean.save_watched(file_book, changed)
+                run_time = time.perf_counter() - start
+                elapsed = run_time if elapsed is None else min(elapsed, run_time)
+
+                if saved_files != [htmlManager.libreOffice_final_name(file_book, 1)]:
+                    raise AssertionError("The watch stopped saving after a failed chapter")
+
+    results["failed"] = output.getvalue().count(bookCleaner.failed + ":")
+    if results["failed"] != 2 * repeats:
+        raise AssertionError("{} failed chapters reported, {} expected".format(results["failed"], 2 * repeats))
+    results["ms_per_change"] = elapsed * 1000
+
+    return results
+
+
+def benchmark_fragments(works, chapters, paragraphs, repeats=3):
+    """
+    Times building a series of ao3 works by the same author without the fragment cache, with an empty cache and with
+    the cache filled by an earlier run.
+
+    Only the preface, chapter notes and afterword use the cache, so the works are timed with build_ao3 alone. All three
+    runs must give the same output.
+
+    :param int works: The number of works in the series
+    :param int chapters: The number of chapters per work
+    :param int paragraphs: The number of paragraphs per chapter
+    :param int repeats: Runs of each, the fastest is kept
+
+    :return: dict - The results
+    """
+    file_book = load_example_book("example-ao3", "")
+    file_book.rules["oneshot"] = chapters == 1
+    parser = htmlManager.get_parser(file_book.parser)
+    sources = [generate_ao3_work(chapters, paragraphs, seed) for seed in range(works)]
+
+    results = {"works": works}
+    outputs = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name in ("off", "cold", "warm"):
+            elapsed = None
+            for run in range(repeats):
+                if name == "cold":  # A new empty folder for each run
+                    fragmentCache.start_cache(os.path.join(folder, str(run)))
+                elif name == "warm":  # The filled folder of the first cold run
+                    fragmentCache.start_cache(os.path.join(folder, "0"))
+
+                soups = [htmlManager.parse_html(source, parser) for source in sources]
+                htmlManager.parse_fragment.cache_clear()
+
+                start = time.perf_counter()
+                run_outputs = [htmlManager.soup_to_bytes(soup) for main_soup in soups
+                               for part_name, soup in htmlManager.build_ao3(main_soup, file_book)]
+                run_time = time.perf_counter() - start
+                elapsed = run_time if elapsed is None else min(elapsed, run_time)
+
+                cache = fragmentCache.stop_cache()
+                outputs[name] = run_outputs
+
+            results[name] = {"seconds": elapsed, "ms_per_work": elapsed * 1000 / works,
+                             "hits": cache.hits if cache else 0, "misses": cache.misses if cache else 0}
+
+    if not outputs["off"] == outputs["cold"] == outputs["warm"]:
+        raise AssertionError("The cached fragments give a different output")
+
+    return results
+
+
+def write_series_corpus(folder, works, chapters, paragraphs):
+    """
+    Writes a synthetic series, alternating LibreOffice and ao3 works, with a format file for each work and the series.
+
+    :param str folder: The folder to write the series to
+    :param int works: The number of works
+    :param int chapters: The number of chapters per work
+    :param int paragraphs: The number of paragraphs per chapter
+
+    :return: str - The path of the series format file
+    """
+    work_names = []
+    for work in range(works):
+        work_name = "work-{}".format(work)
+        work_folder = os.path.join(folder, work_name)
+        os.makedirs(work_folder)
+
+        if work % 2 == 0:
+            work_format = {"version": 0, "file_type": "LibreOffice", "title": "Work {}".format(work),
+                           "origin_folder": work_folder, "chapter_files": "Chapter {}", "chapter_format": "Chapter {}",
+                           "additional_files": {}, "sectionbreak_symbol": benchmark_sectionbreak,
+                           "style_rules": benchmark_styles}
+            for count in range(1, chapters + 1):
+                with open(os.path.join(work_folder, "Chapter {}.html".format(count)), "w") as file:
+                    file.write(generate_libreOffice_chapter(paragraphs, work * chapters + count))
+        else:
+            work_format = {"version": 0, "file_type": "ao3", "title": "Work {}".format(work),
+                           "main_file": os.path.join(work_folder, "work"), "oneshot": chapters == 1,
+                           "no-links": False, "chapter_format": "Chapter {}"}
+            with open(os.path.join(work_folder, "work.html"), "w") as file:
+                file.write(generate_ao3_work(chapters, paragraphs, work))
+
+        with open(os.path.join(folder, work_name + ".json"), "w") as format_file:
+            json.dump(work_format, format_file)
+        work_names.append(work_name)
+
+    series_path = os.path.join(folder, "series.json")
+    with open(series_path, "w") as format_file:
+        json.dump({"version": 0, "file_type": "Series", "title": "Synthetic Series", "works": work_names}, format_file)
+
+    return series_path
+
+
+def benchmark_series(works, chapters, paragraphs, jobs_counts):
+    """
+    Times cleaning a whole series with different numbers of worker processes, and checks they all save the same files.
+
+    :param int works: The number of works in the series
+    :param int chapters: The number of chapters per work
+    :param int paragraphs: The number of paragraphs per chapter
+    :param list jobs_counts: The numbers of worker processes to time
+
+    :return: dict - The results of each number of workers
+    """
+    results = {}
+    outputs = {}
+    with tempfile.TemporaryDirectory() as folder:
+        file_book = bookCleaner.load_book(write_series_corpus(folder, works, chapters, paragraphs))
+        file_book.parser = htmlManager.get_parser(file_book.parser)
+
+        for jobs in jobs_counts:
+            file_book.output_folder = os.path.join(folder, "final-{}".format(jobs))
+            os.makedirs(file_book.output_folder)
+
+            start = time.perf_counter()
+            saved_files = bookCleaner.save_book(file_book, jobs=jobs)
+            elapsed = time.perf_counter() - start
+
+            outputs[jobs] = {}
+            for file_name in saved_files:
+                with open(file_name, "rb") as file:
+                    outputs[jobs][os.path.relpath(file_name, file_book.output_folder)] = file.read()
+
+            results[jobs] = {"seconds": elapsed, "files": len(saved_files),
+                             "speedup": results[jobs_counts[0]]["seconds"] / elapsed if results else 1.0}
+
+    if any(output != outputs[jobs_counts[0]] for output in outputs.values()):
+        raise AssertionError("The series output differs between numbers of workers")
+
+    return results
+
+
+# CMD LINE #############################################################################################################
+########################################################################################################################
+
+def main():
+    """
+    Runs the requested benchmark and prints the results.
+
+    :return: Void
+    """
+    cmd_parser = argparse.ArgumentParser()
+    cmd_parser.add_argument("benchmark",
+                            choices=["clean-tree", "parsers", "ao3-stream", "serialize", "skeleton", "suite", "rules",
+                                     "pipeline", "watch", "fragments", "series", "ao3-memory", "lo-memory",
+                                     "prepass", "import-time", "formats"],
+                            help="The benchmark to run.")
+    cmd_parser.add_argument("--paragraphs", type=int, default=500, help="Paragraphs per synthetic chapter.")
+    cmd_parser.add_argument("--chapters", type=int, default=20, help="Number of synthetic chapters.")
+    cmd_parser.add_argument("--documents", type=int, default=5000, help="Number of documents for skeleton.")
+    cmd_parser.add_argument("--loads", type=int, default=2000, help="Loads of each format file for formats.")
+    cmd_parser.add_argument("--rules", type=int, default=200, help="Number of style rules for rules.")
+    cmd_parser.add_argument("--works", type=int, default=50,
+                            help="Number of works in the series for fragments and series.")
+    cmd_parser.add_argument("--jobs", type=int, nargs="+",
+                            help="The numbers of worker processes to time for series, the first is used for "
+                                 "lo-memory. Defaults to 1 up to the CPU count, doubling.")
+    cmd_parser.add_argument("--prefetch", type=int, default=4, help="The prefetch of the pipeline for pipeline.")
+    cmd_parser.add_argument("--latency", type=float, default=0.0,
+                            help="Milliseconds added to every file read and write for pipeline, to act like slow "
+                                 "storage.")
+    cmd_parser.add_argument("--junk", type=float, default=1.0,
+                            help="Share of LibreOffice paragraphs with span and font tags, 0 to 1, for suite.")
+    cmd_parser.add_argument("--notes", type=float, default=0.5,
+                            help="Share of ao3 chapters with a chapter summary, 0 to 1, for suite.")
+    cmd_parser.add_argument("--links", type=float, default=0.1,
+                            help="Share of ao3 paragraphs with a link, 0 to 1, for suite.")
+    cmd_parser.add_argument("--parser", default="auto", help="The parser engine for suite.")
+    cmd_parser.add_argument("--repeats", type=int, default=3, help="Runs of each suite case, the fastest is kept.")
+    cmd_parser.add_argument("--output", help="Save the suite results to this JSON file.")
+    cmd_parser.add_argument("--compare", help="A JSON file of earlier suite results to compare against.")
+    cmd_args = cmd_parser.parse_args()
+
+    match cmd_args.benchmark:
+        case "clean-tree":
+            results = benchmark_clean_tree(cmd_args.paragraphs, cmd_args.chapters)
+
+            print("{} chapters of {} paragraphs, output identical".format(results["chapters"], results["paragraphs"]))
+            for name in ("sweeps", "clean_tree"):
+                print("{:<12} traversals: {:>3}   {:8.2f} ms/chapter".format(
+                    name, results[name]["traversals"], results[name]["ms_per_chapter"]))
+        case "parsers":
+            results = benchmark_parsers(cmd_args.chapters, cmd_args.paragraphs)
+
+            print("{} parser engines, output identical".format(len(results)))
+            for name in results:
+                print("{:<12} files: {:>3}   {:8.2f} s".format(name, results[name]["files"], results[name]["seconds"]))
+        case "ao3-stream":
+            results = benchmark_ao3_stream(cmd_args.chapters, cmd_args.paragraphs)
+
+            print("{} chapters, {:.2f} MB source, output identical".format(cmd_args.chapters, results["source_mb"]))
+            for name in ("full", "stream"):
+                print("{:<12} peak memory: {:8.2f} MB   {:8.2f} s".format(
+                    name, results[name]["peak_mb"], results[name]["seconds"]))
+        case "ao3-memory":
+            results = benchmark_ao3_memory(cmd_args.chapters, cmd_args.paragraphs)
+
+            print("{} chapters, peak heap: {:.2f} MB".format(cmd_args.chapters, results["peak_heap_mb"]))
+            for memory in results["memory"]:
+                print("{:<22} heap: {:8.2f} MB   RSS: {} MB".format(
+                    memory["part"], memory["heap_mb"],
+                    "-" if memory["rss_mb"] is None else "{:.1f}".format(memory["rss_mb"])))
+        case "lo-memory":
+            results = benchmark_lo_memory(cmd_args.chapters, cmd_args.paragraphs, (cmd_args.jobs or [2])[0])
+
+            print("{} chapters, peak heap: {:.2f} MB, guarded output identical, throttled {} times".format(
+                cmd_args.chapters, results["peak_heap_mb"], results["throttles"]))
+            for memory in results["memory"]:
+                print("{:<22} heap: {:>8} MB   RSS: {} MB".format(
+                    memory["part"], "-" if memory["heap_mb"] is None else "{:.2f}".format(memory["heap_mb"]),
+                    "-" if memory["rss_mb"] is None else "{:.1f}".format(memory["rss_mb"])))
+        case "prepass":
+            results = benchmark_prepass(cmd_args.chapters, cmd_args.paragraphs, cmd_args.junk, cmd_args.repeats)
+
+            print("{} documents, {} rewritten, output identical with {}".format(
+                results["documents"], results["rewritten"], ", ".join(results["parsers"])))
+            print("{:<12} {:8.2f} ms/chapter".format("dom", results["dom"]["ms_per_chapter"]))
+            print("{:<12} {:8.2f} ms/chapter   rewrite: {:.2f} ms/chapter".format(
+                "prepass", results["prepass"]["ms_per_chapter"], results["prepass"]["rewrite_ms_per_chapter"]))
+        case "formats":
+            results = benchmark_formats(cmd_args.loads)
+
+            print("{} formats loaded {} times each".format(results["formats"], results["loads"]))
+            for name in ("parsed", "cached"):
+                print("{:<12} {:8.2f} us/load".format(name, results[name]["us_per_load"]))
+        case "import-time":
+            results = benchmark_import_time(cmd_args.repeats)
+
+            print("{} cases, Beautiful Soup only loaded where expected".format(len(results)))
+            for name, case_results in results.items():
+                print("{:<12} {:8.2f} ms   imports: {:8.2f} ms   bs4: {}".format(
+                    name, case_results["ms"], case_results["import_ms"], "yes" if case_results["bs4"] else "no"))
+        case "serialize":
+            results = benchmark_serialize(cmd_args.chapters, cmd_args.paragraphs)
+
+            print("{} chapters of {} paragraphs, minimal output identical to legacy".format(cmd_args.chapters,
+                                                                                       cmd_args.paragraphs))
+            for name in results:
+                print("{:<12} {:8.2f} MB/s   {:8.2f} s".format(name, results[name]["mb_per_second"],
+                                                              results[name]["seconds"]))
+        case "skeleton":
+            results = benchmark_skeleton(cmd_args.documents)
+
+            print("{} documents, template output identical".format(cmd_args.documents))
+            for name in results:
+                print("{:<14} {:8.2f} us/document".format(name, results[name]))
+        case "rules":
+            results = benchmark_rules(cmd_args.paragraphs, cmd_args.chapters, cmd_args.rules)
+
+            print("{} chapters, {} style rules, output identical".format(results["chapters"], results["rules"]))
+            for name in ("flat", "bucketed"):
+                print("{:<12} {:8.2f} ms/chapter".format(name, results[name]["ms_per_chapter"]))
+        case "pipeline":
+            results = benchmark_pipeline(cmd_args.chapters, cmd_args.paragraphs, cmd_args.prefetch,
+                                         cmd_args.latency / 1000, cmd_args.repeats)
+
+            print("{} chapters, {:.1f} ms per read and write, output identical".format(results["chapters"],
+                                                                                      results["latency_ms"]))
+            for name in ("sequential", "pipeline"):
+                print("{:<12} {:8.2f} chapters/s   {:8.2f} s".format(name, results[name]["chapters_per_second"],
+                                                                     results[name]["seconds"]))
+        case "watch":
+            results = benchmark_watch(cmd_args.paragraphs, cmd_args.repeats)
+
+            print("{} paragraphs, {} failed chapters reported, the watch carried on".format(results["paragraphs"],
+                                                                                       results["failed"]))
+            print("{:<12} {:8.2f} ms/change".format("watch", results["ms_per_change"]))
+        case "fragments":
+            results = benchmark_fragments(cmd_args.works, cmd_args.chapters, cmd_args.paragraphs, cmd_args.repeats)
+
+            print("{} works, output identical".format(results["works"]))
+            for name in ("off", "cold", "warm"):
+                print("{:<12} {:8.2f} ms/work   hits: {:>6}   misses: {:>6}".format(
+                    name, results[name]["ms_per_work"], results[name]["hits"], results[name]["misses"]))
+        case "series":
+            jobs_counts = cmd_args.jobs
+            if not jobs_counts:
+                jobs_counts = [1]
+                while jobs_counts[-1] * 2 <= (os.cpu_count() or 1):
+                    jobs_counts.append(jobs_counts[-1] * 2)
+
+            results = benchmark_series(cmd_args.works, cmd_args.chapters, cmd_args.paragraphs, jobs_counts)
+
+            print("{} works of {} chapters, output identical".format(cmd_args.works, cmd_args.chapters))
+            for jobs, jobs_results in results.items():
+                print("jobs {:<7} {:8.2f} s   speedup: {:5.2f}x".format(jobs, jobs_results["seconds"],
+                                                                     jobs_results["speedup"]))
+        case "suite":
+            corpus = {"chapters": cmd_args.chapters, "paragraphs": cmd_args.paragraphs, "junk": cmd_args.junk,
+                      "notes": cmd_args.notes, "links": cmd_args.links}
+            results = benchmark_suite(corpus, cmd_args.parser, cmd_args.repeats)
+
+            print("{} chapters of {} paragraphs".format(cmd_args.chapters, cmd_args.paragraphs))
+            for name, case_results in results["cases"].items():
+                print("{:<12} {:8.2f} chapters/s {:8.2f} MB/s   peak RSS: {} MB".format(
+                    name, case_results["chapters_per_second"], case_results["mb_per_second"],
+                    "-" if case_results["peak_rss_mb"] is None else "{:.1f}".format(case_results["peak_rss_mb"])))
+                print("{:<12} {}".format("", "   ".join("{}: {:.2f} s".format(stage, seconds)
+                                                        for stage, seconds in case_results["stages"].items())))
+
+            if cmd_args.output:
+                with open(cmd_args.output, "w") as output_file:
+                    json.dump(results, output_file, indent=4)
+            if cmd_args.compare:
+                with open(cmd_args.compare, "r") as baseline_file:
+                    compare_suite(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,48 @@ Manages all information about processed book including file paths and formatting
 """
 
 # IMPORTS ##############################################################################################################
-import json
 import enum
+import hashlib
+import io
+import json
+import os
+
+from styleRules import RuleTable
+
+# GLOBAL VARIABLES #####################################################################################################
+# Formatters for the saved xhtml. minimal only escapes &, < and >, html also turns characters into named entities
+output_formatters = ["minimal", "html"]
+
+# The rule table of a book without styles or a section break
+empty_rule_table = RuleTable()
+
+# Loaded format files, the path to ((modified time, size), hash of the contents, Book). See load_book
+format_cache = {}
+
+
+# EXCEPTIONS ###########################################################################################################
+class CleanError(Exception):
+    """
+    The base of all errors raised while cleaning a book. The message explains the problem.
+    """
+
+
+class FormatError(CleanError):
+    """
+    Raised when a format file can't be used. The message explains the problem.
+
+    The problems found in the values of the format are also kept in issues, one dict for each with the "field" (the key
+    in the JSON, None for the whole file) and the "message", so a program can report them without reading the message.
+    """
+    def __init__(self, message, issues=None):
+        """
+        The init function.
+
+        :param str message: The explanation of the problem
+        :param list|None issues: The {"field", "message"} dicts of each problem in the values of the format
+        """
+        super().__init__(message)
+        self.issues: list = issues or []
 
 
 # ENUM #################################################################################################################
@@ -19,97 +59,267 @@ class FileType(str, enum.Enum):
     SERIES = "Series"
 
 
+# SCHEMA ###############################################################################################################
+class FormatField:
+    """
+    Class to describe one value of a format file, for the format schema.
+    """
+    __slots__ = ("key", "types", "file_types", "attribute", "check")
+
+    def __init__(self, key, types, file_types=(), attribute=None, check=None):
+        """
+        The init function.
+
+        :param str key: The key of the value in the JSON
+        :param type|tuple types: The python types the JSON value can be
+        :param tuple file_types: The file types that need the value, the value is not used by other file types. Empty
+            if it is optional for every file type
+        :param str|None attribute: The Book attribute the value is saved to, "rules." first for a rule. None to only
+            check it
+        :param function|None check: Gets the problem with a value of the right type as a str, None if it is valid
+        """
+        self.key: str = key
+        self.types: tuple = types if isinstance(types, tuple) else (types,)
+        self.file_types: tuple = file_types
+        self.attribute: str | None = attribute
+        self.check = check
+
+    def get_problem(self, value):
+        """
+        Gets the problem with a value of this field.
+
+        :param value: The value from the JSON
+
+        :return: str|None - The problem, None if the value is valid
+        """
+        if not isinstance(value, self.types) or (isinstance(value, bool) and bool not in self.types):
+            return "must be " + " or ".join(type_names[value_type] for value_type in self.types)
+
+        return self.check(value) if self.check else None
+
+    def is_used_by(self, file_type):
+        """
+        Checks if books of a file type use this field.
+
+        :param str file_type: The file type of the book
+
+        :return: bool
+        """
+        return not self.file_types or file_type in self.file_types
+
+
+class FormatSchema:
+    """
+    Class to validate a format file against its fields. The fields are sorted by file type once, when it is built.
+    """
+    __slots__ = ("fields", "required")
+
+    def __init__(self, fields):
+        """
+        The init function. Compiles the fields.
+
+        :param list fields: The FormatField of each value a format file can have
+        """
+        self.fields: dict = {field.key: field for field in fields}  # Key to field
+        self.required: dict = {file_type: tuple(field.key for field in fields if file_type in field.file_types)
+                               for file_type in FileType}  # File type to the keys it needs
+        self.required[None] = tuple(field.key for field in fields  # Needed whatever the file type
+                                    if all(file_type in field.file_types for file_type in FileType))
+
+    def validate(self, format_dict, version):
+        """
+        Finds every problem in the values of a format file. Keys the schema does not know are ignored.
+
+        :param dict format_dict: The loaded JSON of the format file
+        :param int version: The version the format file must have
+
+        :return: list - The {"field", "message"} dict of each problem, empty if the format is valid
+        """
+        if not isinstance(format_dict, dict):
+            return [{"field": None, "message": "The format file must hold a JSON object"}]
+
+        issues = []
+        for key, value in format_dict.items():
+            field = self.fields.get(key)
+            problem = field.get_problem(value) if field else None
+            if problem:
+                issues.append({"field": key, "message": "'" + key + "' " + problem})
+
+        # REQUIRED VALUES - THE FILE TYPE DECIDES WHICH
+        file_type = format_dict.get("file_type")
+        required = self.required[FileType(file_type)] if file_type in file_type_names else self.required[None]
+        for key in required:
+            if key not in format_dict:
+                issues.append({"field": key, "message": "'" + key + "' is missing"})
+
+        if format_dict.get("version", version) != version:
+            issues.append({"field": "version", "message": "The format file is version {}, version {} is needed".format(
+                format_dict["version"], version)})
+
+        return issues
+
+
+# VALUE CHECKS ---------------------------------------------------------------------------------------------------------
+def check_file_type(value):
+    """
+    :param str value: The file_type of a format
+    :return: str|None - The problem, None if the value is valid
+    """
+    return None if value in file_type_names else "must be one of " + ", ".join(file_type_names)
+
+
+def check_works(value):
+    """
+    :param list value: The works of a series
+    :return: str|None - The problem, None if the value is valid
+    """
+    if not value or not all(isinstance(work, str) for work in value):
+        return "must list the format names of the works of the series"
+    return None
+
+
+def check_additional_files(value):
+    """
+    :param dict value: The additional_files of a LibreOffice format
+    :return: str|None - The problem, None if the value is valid
+    """
+    for file_name, part in value.items():
+        if not isinstance(part, dict) or not isinstance(part.get("title"), str) or \
+                not isinstance(part.get("final_name"), str):
+            return "needs a title and a final_name for '" + file_name + "'"
+    return None
+
+
+def check_style_rules(value):
+    """
+    :param dict value: The style_rules of a format
+    :return: str|None - The problem, None if the value is valid
+    """
+    if not all(isinstance(css_class, str) for css_class in value.values()):
+        return "must give a css class name for each rule"
+    return None
+
+
+def check_formatter(value):
+    """
+    :param str value: The formatter of a format
+    :return: str|None - The problem, None if the value is valid
+    """
+    return None if value in output_formatters else "must be one of " + ", ".join(output_formatters)
+
+
 # MAIN CLASS ###########################################################################################################
 class Book:
     """
     Class to contain information about the book being processed.
+
+    Uses slots, a book is loaded once for each format file and copied for each use, see load_book.
     """
+    __slots__ = ("version", "type", "primary_path", "additional_paths", "file_name", "works", "title", "language",
+                 "chapter_title", "rules", "styles", "rule_table", "parser", "output_folder", "formatter", "atomic",
+                 "prepass")
+
     # CONSTRUCTORS #####################################################################################################
-    def __init__(self, file_version, json_file):
+    def __init__(self, file_version, json_file=None):
         """
         The init function.
 
         :param int file_version: A file version to compare against
-        :param file json_file: The JSON file to parse
+        :param file|None json_file: The JSON file to parse. None for an empty book
         """
         self.version: int = file_version  # The version in order to check for compatibility issues
         self.type: str | None = None  # Where the html files where generated, LibreOffice as default
 
         self.primary_path: str | None = None  # The main path of the book,
-        # LibreOffice - main folder, ao3 - single file
+        # LibreOffice - main folder, ao3 - single file, Series - folder of the work formats, set by load_book
         self.additional_paths: dict = {}  # A dict of any additional paths
         self.file_name: str | None = None  # The file naming convention for numbered parts
+        self.works: list = []  # Series - the format names of the member works, in reading order
 
         self.title: str | None = None  # The title of the book
+        self.language: str = "en"  # The language of the book, for the EPUB metadata
         self.chapter_title: str | None = None  # The title of the chapters. Will be formatted
 
         self.rules: dict = {}  # A dictionary with all the specific rules for each book. AKA no_links and such
         self.styles: dict = {}  # All style replacements
+        self.rule_table: RuleTable = empty_rule_table  # The styles and section break compiled for clean_tree
 
-        try:
+        self.parser: str = "auto"  # The parser engine for the source html, auto picks the fastest installed
+        self.output_folder: str = "final"  # The folder the cleaned files are saved in
+        self.formatter: str = "minimal"  # How text is escaped in the saved xhtml, minimal or html
+        self.atomic: bool = False  # Save each file through a temporary file and a rename
+        self.prepass: bool = False  # Remove the LibreOffice junk from the html text before it is parsed
+
+        if json_file is not None:
             self.read_format(json_file)  # Get information from JSON file
-        except KeyError as error:
-            print("The provided JSON file is missing the value: " + str(error))
-            exit()
-        except Exception as error:
-            print("There is an error with the JSON file provided.")
-            print("Error: " + str(error))
-            exit()
 
     def read_format(self, file):
         """
         Read the JSON file into the class. Called from __init__
 
         :param file file: A JSON file to parse
+        :raises FormatError: If the JSON file is not valid for this version
         :return: Void
         """
-        # SET UP -------------------------------------------------------------------------------------------------------
-        format_dict: dict = json.load(file)  # Load JSON fil
-
-        # Check file version matches
-        if format_dict["version"] != self.version:
-            print("The JSON file has a different version then the program provided.")
-            exit()
-
-        # BUILD BOOK FORMAT --------------------------------------------------------------------------------------------
-        # FILE TYPE
-        if format_dict["file_type"] in FileType:
-            # If there is a file_type in file AND if it is a valid (found in enum)
-            self.type = format_dict["file_type"]
-        else:
-            print("No valid file_type provided.")
-            exit()
-
-        # GET FILE PATHS
-        match self.type:
-            case FileType.LIBREOFFICE:
-                self.primary_path = format_dict["origin_folder"]
-                self.additional_paths = format_dict["additional_files"]
-
-                self.file_name = format_dict["chapter_files"]
-            case FileType.AO3:
-                self.primary_path = format_dict["main_file"]
-
-                # AO3 RULES
-                self.rules["oneshot"] = format_dict["oneshot"]
-                self.rules["no-links"] = format_dict["no-links"]
-            case FileType.SERIES:
-                pass
-
-        # BASIC INFO ---------------------------------------------------------------------------
-        self.title = format_dict["title"]
-        self.chapter_title = format_dict["chapter_format"]
-
-        # SECTION BREAK -------------------------------------------------------------------------
-        if "sectionbreak_symbol" in format_dict:
-            self.rules["sectionbreak"] = format_dict["sectionbreak_symbol"]
-
-        # STYLES --------------------------------------------------------------------------------
-        if "style_rules" in format_dict:
-            self.styles = format_dict["style_rules"]
-    
+        try:
+            format_dict = json.load(file)
+        except ValueError as error:  # Includes text that is not utf-8
+            raise FormatError("The format file is not valid JSON: " + str(error),
+                              [{"field": None, "message": str(error)}]) from error
+
+        return self.apply_format(format_dict)
+
+    def apply_format(self, format_dict):
+        """
+        Validates the loaded JSON of a format file against the format schema and saves its values. Values of other file
+        types are not used, e.g. a main_file in a LibreOffice format.
+
+        :param dict format_dict: The loaded JSON
+        :raises FormatError: If a value is missing or not valid, with every problem found in its issues
+        :return: Book - This book
+        """
+        issues = format_schema.validate(format_dict, self.version)
+        if issues:
+            raise FormatError("The format file is not valid: " + "; ".join(issue["message"] for issue in issues),
+                              issues)
+
+        file_type = FileType(format_dict["file_type"])
+        for key, value in format_dict.items():
+            field = format_schema.fields.get(key)
+            if field is None or field.attribute is None or not field.is_used_by(file_type):
+                continue
+
+            if field.attribute.startswith("rules."):
+                self.rules[field.attribute[len("rules."):]] = value
+            else:
+                setattr(self, field.attribute, value)
+
+        # COMPILE STYLES AND SECTION BREAK ONCE FOR ALL CHAPTERS
+        try:
+            self.rule_table = RuleTable(self.styles, self.rules.get("sectionbreak"))
+        except ValueError as error:
+            raise FormatError(str(error), [{"field": "style_rules", "message": str(error)}]) from error
+
         return self
 
+    def copy(self):
+        """
+        Copies the book, so a loaded format can be used many times. The containers a book can change are copied, the
+        compiled rule table is shared.
+
+        :return: Book
+        """
+        book_copy = Book.__new__(Book)  # Every slot is set below
+        for name in Book.__slots__:
+            setattr(book_copy, name, getattr(self, name))
+
+        book_copy.rules = dict(self.rules)
+        book_copy.styles = dict(self.styles)
+        book_copy.additional_paths = dict(self.additional_paths)
+        book_copy.works = list(self.works)
+
+        return book_copy
+
     # PYTHON CLASS METHODS ####################################################################
     # TODO: UPDATE METHOD
     def __str__(self):
@@ -127,3 +337,82 @@ class Book:
         output += "\t\t" + str(self.styles) + "\n"
 
         return output
+
+
+# LOADING ##############################################################################################################
+def load_book(format_path):
+    """
+    Loads the book of a format file.
+
+    Only needs the standard library and the style rules, so a format can be checked without loading the html
+    libraries. Formats with CSS selector rules load soupsieve to compile them.
+
+    Each format is parsed and validated once. Later loads give a copy of the cached book while the modified time and
+    size of the file are the same. If they change but the contents hash the same, the cached book is still used.
+
+    :param str format_path: The path of the format JSON file
+    :raises FormatError: If the format does not exist or can't be used
+
+    :return: Book
+    """
+    try:
+        stat = os.stat(format_path)
+    except OSError as error:
+        raise FormatError("The format file can't be opened: " + format_path) from error
+
+    file_key = (stat.st_mtime_ns, stat.st_size)
+    cached = format_cache.get(format_path)
+
+    if cached is None or cached[0] != file_key:
+        try:
+            with open(format_path, "rb") as format_file:
+                data = format_file.read()
+        except OSError as error:
+            raise FormatError("The format file can't be opened: " + format_path) from error
+
+        digest = hashlib.sha256(data).hexdigest()
+        if cached is None or cached[1] != digest:
+            cached = (file_key, digest, Book(0, io.BytesIO(data)))
+        else:  # TOUCHED BUT NOT CHANGED
+            cached = (file_key, digest, cached[2])
+        format_cache[format_path] = cached
+
+    file_book = cached[2].copy()
+
+    if file_book.type == FileType.SERIES:  # The works are found next to the series format
+        file_book.primary_path = os.path.dirname(format_path) or "."
+
+    return file_book
+
+
+# SCHEMA SETUP #########################################################################################################
+# The names of the file types
+file_type_names = [file_type.value for file_type in FileType]
+
+# The name of each JSON type, for the problems
+type_names = {str: "a string", int: "a number", float: "a number", bool: "true or false", list: "a list",
+              dict: "an object"}
+
+# Every value a format file can have
+format_schema = FormatSchema([
+    FormatField("version", int, tuple(FileType)),
+    FormatField("file_type", str, tuple(FileType), "type", check_file_type),
+    FormatField("title", str, tuple(FileType), "title"),
+    FormatField("language", str, (), "language"),
+    FormatField("chapter_format", str, (FileType.LIBREOFFICE, FileType.AO3), "chapter_title"),
+    # LibreOffice
+    FormatField("origin_folder", str, (FileType.LIBREOFFICE,), "primary_path"),
+    FormatField("chapter_files", str, (FileType.LIBREOFFICE,), "file_name"),
+    FormatField("additional_files", dict, (FileType.LIBREOFFICE,), "additional_paths", check_additional_files),
+    # ao3
+    FormatField("main_file", str, (FileType.AO3,), "primary_path"),
+    FormatField("oneshot", bool, (FileType.AO3,), "rules.oneshot"),
+    FormatField("no-links", bool, (FileType.AO3,), "rules.no-links"),
+    # Series
+    FormatField("works", list, (FileType.SERIES,), "works", check_works),
+    # Cleaning
+    FormatField("sectionbreak_symbol", str, (), "rules.sectionbreak"),
+    FormatField("style_rules", dict, (), "styles", check_style_rules),
+    FormatField("parser", str, (), "parser"),
+    FormatField("formatter", str, (), "formatter", check_formatter),
+])
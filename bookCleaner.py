@@ -0,0 +1,854 @@
+"""
+The library interface of HTML Cleaner.
+
+Cleans a book and gives back the xhtml of each part, or saves the parts to the output folder of the book. Nothing is
+printed and nothing exits, problems are raised as a CleanError and progress is reported through an optional callback.
+This lets a book be cleaned from inside another program.
+
+    book = bookCleaner.load_book("format/example-lo.json")
+    for file_name, xhtml in bookCleaner.clean_book(book):
+        ...
+
+The progress callback is called as progress(name, status), see the statuses below.
+"""
+
+# IMPORTS ##############################################################################################################
+from concurrent.futures import ProcessPoolExecutor  # Worker processes for jobs
+import functools
+import html
+from itertools import repeat
+import os
+import re
+import urllib.parse
+
+import epubPackager
+import filePipeline
+import htmlManager
+import memoryGuard
+import runJournal
+import stageTimings
+from book import CleanError, FileType, FormatError, load_book  # FormatError is re-exported for the library interface
+from buildManifest import hash_file
+
+# GLOBAL VARIABLES #####################################################################################################
+# Statuses given to the progress callback with a file name
+completed = "COMPLETED"  # The file was cleaned
+unchanged = "UNCHANGED"  # The file was skipped as unchanged by an incremental build
+resumed = "RESUMED"  # The file was skipped as saved by the earlier run a resumed run carries on from
+failed = "FAILED"  # The file could not be cleaned, given with the error. The rest of the book is still cleaned
+
+# Statuses given to the progress callback with a source path while the parts of a LibreOffice book are found
+missing = "MISSING"  # A chapter number in a gap, or an additional file that does not exist
+stray = "STRAY"  # An html file in the source folder that is not a part of the book
+throttled = "THROTTLED"  # The worker processes went over the memory limit and clean one file at a time
+
+# Status given with the name of a group of LibreOffice parts, CHAPTERS or ADDITIONAL, once the whole group is cleaned.
+# Also given with the format name of each work of a series once the work is cleaned
+group_complete = "COMPLETE"
+
+# The folder the images of a series are saved in, inside the output folder. Parts link to it as images/{name}
+asset_folder = "images"
+
+# Finds the image sources in cleaned xhtml. The xhtml is from soup_to_bytes, so attributes are always double quoted
+image_source_pattern = re.compile(rb'(<img\b[^>]*?\ssrc=")([^"]*)(")')
+
+
+# EXCEPTIONS ###########################################################################################################
+class SourceError(CleanError):
+    """
+    Raised when the source html of a book can't be found or can't be read as its file_type.
+    """
+
+
+class UnsupportedBookError(CleanError):
+    """
+    Raised when the file_type of a book can't be cleaned.
+    """
+
+
+class IncompleteBookError(CleanError):
+    """
+    Raised at the end of a resumable run when some parts failed, the others are saved. See save_book.
+    """
+
+
+# LOADING ##############################################################################################################
+def find_libreOffice_parts(file_book, progress=None):
+    """
+    Finds the html files of a LibreOffice book.
+
+    The source folder is listed once. Files matching the chapter_files pattern are the chapters, sorted by number, and
+    files named in additional_files are the additional parts. Gaps in the chapter numbers and additional files that
+    don't exist are reported as missing, other html files in the folder as stray. Chapters after a gap are still found.
+
+    :param Book file_book: The book details object
+    :param function|None progress: Called as progress(path, status) for each missing or stray file
+    :raises SourceError: If the folder of the book does not exist
+
+    :return: tuple - The lists of chapter (path, number) and additional file (path, name) tuples
+    """
+    try:
+        entries = os.scandir(file_book.primary_path)
+    except (FileNotFoundError, NotADirectoryError) as error:
+        raise SourceError("The source folder does not exist: " + file_book.primary_path) from error
+
+    # MATCH EVERY HTML FILE IN THE FOLDER TO A PART
+    chapter_index = {}
+    additional_index = {}
+    stray_paths = []
+    with entries:
+        for entry in entries:
+            if not entry.name.endswith(".html") or not entry.is_file():
+                continue
+
+            part_path = "{}/{}".format(file_book.primary_path, entry.name)
+            count = find_libreOffice_part(file_book, part_path)
+            if count is None:
+                stray_paths.append(part_path)
+            elif isinstance(count, int):
+                chapter_index[count] = part_path
+            else:
+                additional_index[count] = part_path
+
+    chapters = [(chapter_index[count], count) for count in sorted(chapter_index)]
+    additional = [(additional_index[file_name], file_name) for file_name in file_book.additional_paths
+                  if file_name in additional_index]
+
+    # REPORT GAPS AND STRAY FILES
+    chapter_path = "{}/{}.html".format(file_book.primary_path, file_book.file_name)
+    for count in range(1, max(chapter_index, default=0)):
+        if count not in chapter_index:
+            report(progress, chapter_path.format(count), missing)
+    for file_name in file_book.additional_paths:
+        if file_name not in additional_index:
+            report(progress, "{}/{}.html".format(file_book.primary_path, file_name), missing)
+    for part_path in sorted(stray_paths):
+        report(progress, part_path, stray)
+
+    return chapters, additional
+
+
+def find_ao3_source(file_book):
+    """
+    Finds the html file of an ao3 book.
+
+    :param Book file_book: The book details object
+    :raises SourceError: If the file does not exist
+
+    :return: str - The path of the html file
+    """
+    source_path = file_book.primary_path + ".html"
+    if not os.path.isfile(source_path):
+        raise SourceError("The source file does not exist: " + source_path)
+
+    return source_path
+
+
+def get_source_folder(file_book):
+    """
+    Gets the folder the source html of a book is in.
+
+    :param Book file_book: The book details object
+
+    :return: str - The folder path
+    """
+    if file_book.type == "LibreOffice":
+        return file_book.primary_path
+
+    return os.path.dirname(file_book.primary_path) or "."
+
+
+def find_libreOffice_part(file_book, source_path):
+    """
+    Finds which part of a LibreOffice book a source file is.
+
+    :param Book file_book: The book details object
+    :param str source_path: The path of the html file
+
+    :return: int|str|None - The chapter number or the name of the additional file, None if the file is not a part
+    """
+    file_name = os.path.basename(source_path).removesuffix(".html")
+    if file_name in file_book.additional_paths:
+        return file_name
+
+    prefix, _, suffix = file_book.file_name.partition("{}")
+    chapter_match = re.fullmatch(re.escape(prefix) + "([1-9][0-9]*)" + re.escape(suffix), file_name)
+    if chapter_match is None:
+        return None
+
+    return int(chapter_match.group(1))
+
+
+# CLEANING #############################################################################################################
+def clean_book(file_book, progress=None, stream=False, jobs=1):
+    """
+    Cleans a book in memory without saving any files.
+
+    The parts are cleaned one at a time as they are asked for, or ahead in worker processes when jobs are requested.
+    The names given to the progress callback are the file names, without the output folder. A series also gives the
+    images its works use, named images/{name}, see build_series.
+
+    :param Book file_book: The book details object
+    :param function|None progress: Called as progress(name, status) as each part is cleaned
+    :param bool stream: Read ao3 files one chapter at a time, see htmlManager.build_ao3_stream
+    :param int jobs: The number of worker processes for LibreOffice files or the works of a series
+    :raises SourceError: If the source html can't be found, or an ao3 file is not laid out as an ao3 download
+    :raises UnsupportedBookError: If the file_type of the book can't be cleaned
+
+    :return: Iterator of (file name, xhtml bytes) tuples, one for each part
+    """
+    match file_book.type:
+        case "LibreOffice":
+            chapters, additional = find_libreOffice_parts(file_book, progress)
+
+            # CLEAN ALL PARTS - ONE PROCESS UNLESS JOBS ARE REQUESTED
+            executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+            guard = create_guard(jobs, progress)
+            try:
+                for group_name, parts in (("CHAPTERS", chapters), ("ADDITIONAL", additional)):
+                    results = encode_libreOffice_parts(parts, file_book, executor, guard)
+
+                    for (part_path, count), xhtml in zip(parts, results):
+                        part_name = htmlManager.libreOffice_part_name(file_book, count)
+                        report(progress, part_name, completed)
+                        yield part_name, xhtml
+
+                    report(progress, group_name, group_complete)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+        case "ao3":
+            source_path = find_ao3_source(file_book)
+
+            with open(source_path, "r") as file:
+                if stream:  # ONE CHAPTER AT A TIME
+                    parts = read_ao3_parts(htmlManager.build_ao3_stream(file, file_book), source_path)
+                    yield from encode_parts(parts, file_book, progress)
+                else:
+                    main_soup = htmlManager.parse_html(file, htmlManager.get_parser(file_book.parser))
+                    parts = read_ao3_parts(htmlManager.build_ao3(main_soup, file_book), source_path)
+                    yield from encode_parts(parts, file_book, progress)
+                    main_soup.decompose()  # Release the full work
+        case "Series":
+            for work_name, parts in build_series(file_book, stream, jobs, progress):
+                for part_name, data in parts:
+                    report(progress, part_name, completed)
+                    yield part_name, data
+
+                report(progress, work_name, group_complete)
+        case _:
+            raise UnsupportedBookError("Books of file_type " + str(file_book.type) + " can't be cleaned.")
+
+
+def save_book(file_book, progress=None, stream=False, jobs=1, manifest=None, prefetch=0, journal=None, retries=0):
+    """
+    Cleans a book and saves each part to the output folder of the book.
+
+    The names given to the progress callback are the saved file names, including the output folder.
+
+    With a prefetch LibreOffice files go through filePipeline, which reads the next files and writes the finished ones
+    while others are cleaned.
+
+    With a journal the run is resumable, see runJournal. The parts saved by an earlier run are skipped and reported as
+    resumed, and a part that fails is tried again, then reported as failed while the rest of the book is cleaned. ao3
+    files are read one chapter at a time and the prefetch is not used, so a part is only built if it is not yet saved.
+
+    A series is always cleaned in full, the manifest, the prefetch and the journal are not used for it.
+
+    :param Book file_book: The book details object
+    :param function|None progress: Called as progress(name, status) as each part is saved or skipped
+    :param bool stream: Read ao3 files one chapter at a time, see htmlManager.build_ao3_stream
+    :param int jobs: The number of worker processes for LibreOffice files
+    :param BuildManifest|None manifest: Skip the sources unchanged since the last build and record the new build
+    :param int prefetch: How many LibreOffice files the pipeline can read and clean ahead. 0 does not use the pipeline
+    :param RunJournal|None journal: Record each saved part and skip the parts an earlier run saved
+    :param int retries: How many more times a failed part is tried, with a journal
+    :raises SourceError: If the source html can't be found, or an ao3 file is not laid out as an ao3 download
+    :raises UnsupportedBookError: If the file_type of the book can't be cleaned
+    :raises IncompleteBookError: If parts failed with a journal, once every other part is saved
+
+    :return: list - The names of the saved files, with the resumed ones
+    """
+    saved_files = []
+
+    match file_book.type:
+        case "LibreOffice":
+            chapters, additional = find_libreOffice_parts(file_book, progress)
+
+            # SKIP UNCHANGED PARTS
+            source_hashes = {}
+            if manifest:
+                chapters = skip_unchanged(chapters, file_book, manifest, source_hashes, progress)
+                additional = skip_unchanged(additional, file_book, manifest, source_hashes, progress)
+
+            def record_part(part_path, final_name, status=completed):
+                report(progress, final_name, status)
+                if manifest:
+                    manifest.record(part_path, source_hashes[part_path], [final_name])
+                saved_files.append(final_name)
+
+            # CLEAN ALL PARTS - ONE PROCESS UNLESS JOBS ARE REQUESTED
+            executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+            guard = create_guard(jobs, progress)
+            try:
+                for group_name, parts in (("CHAPTERS", chapters), ("ADDITIONAL", additional)):
+                    if journal is not None:  # CARRY ON FROM AN EARLIER RUN, A FAILED FILE DOES NOT STOP THE OTHERS
+                        resume_libreOffice_parts(parts, file_book, journal, retries, record_part, source_hashes,
+                                                 progress, executor, guard)
+                    elif prefetch > 0:  # READ, CLEAN AND WRITE AT THE SAME TIME
+                        filePipeline.save_libreOffice_parts(parts, file_book, record_part, prefetch, executor, guard)
+                    else:  # REPORT IN ORDER
+                        results = clean_libreOffice_parts(parts, file_book, executor, guard)
+                        for (part_path, count), final_name in zip(parts, results):
+                            record_part(part_path, final_name)
+
+                    report(progress, group_name, group_complete)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+        case "ao3":
+            source_path = find_ao3_source(file_book)
+
+            # SKIP IF UNCHANGED - THE WORK IS ONE FILE
+            source_hash = hash_file(source_path) if manifest or journal else None
+            if manifest and manifest.is_current(source_path, source_hash):
+                for final_name in manifest.get_outputs(source_path):
+                    report(progress, final_name, unchanged)
+            else:
+                with open(source_path, "r") as file:
+                    if journal is not None:  # CARRY ON FROM AN EARLIER RUN, A FAILED PART DOES NOT STOP THE OTHERS
+                        saved_files = resume_ao3_parts(file, file_book, source_path, source_hash, journal, retries,
+                                                       progress)
+                    else:
+                        if stream:  # ONE CHAPTER AT A TIME
+                            parts = htmlManager.build_ao3_stream(file, file_book)
+                        else:
+                            main_soup = htmlManager.parse_html(file, htmlManager.get_parser(file_book.parser))
+                            parts = htmlManager.build_ao3(main_soup, file_book)
+
+                        for part_name, soup in read_ao3_parts(parts, source_path):
+                            final_name = htmlManager.soup_to_file(soup, file_book.output_folder + "/" + part_name,
+                                                                  False, file_book.formatter, file_book.atomic)
+                            report(progress, final_name, completed)
+                            saved_files.append(final_name)
+
+                        if not stream:
+                            main_soup.decompose()  # Release what is left of the full work
+
+                if manifest and not (journal and journal.failed):  # A work with failed parts is built again
+                    manifest.record(source_path, source_hash, saved_files)
+        case "Series":  # ALWAYS BUILT IN FULL
+            for work_name, parts in build_series(file_book, stream, jobs, progress):
+                for part_name, data in parts:
+                    final_name = file_book.output_folder + "/" + part_name
+                    os.makedirs(os.path.dirname(final_name), exist_ok=True)  # The images folder
+                    htmlManager.write_bytes(data, final_name, file_book.atomic)
+
+                    report(progress, final_name, completed)
+                    saved_files.append(final_name)
+
+                report(progress, work_name, group_complete)
+        case _:
+            raise UnsupportedBookError("Books of file_type " + str(file_book.type) + " can't be cleaned.")
+
+    if manifest:
+        manifest.save()
+
+    if journal and journal.failed:
+        raise IncompleteBookError("{} parts failed and the others were saved, resume the run to clean them again: {}"
+                                  .format(len(journal.failed), ", ".join(journal.failed)))
+
+    return saved_files
+
+
+def save_changed(file_book, source_paths, progress=None, stream=False):
+    """
+    Cleans again only the parts of a book made from the changed source files, for the --watch option.
+
+    A LibreOffice file is cleaned on its own. An ao3 work is one file, so the whole work is cleaned again, once it is
+    there. Files that are not part of the book are ignored.
+
+    :param Book file_book: The book details object
+    :param list source_paths: The paths of the source files that changed
+    :param function|None progress: Called as progress(name, status) as each part is saved
+    :param bool stream: Read ao3 files one chapter at a time, see htmlManager.build_ao3_stream
+    :raises UnsupportedBookError: If the file_type of the book can't be cleaned
+
+    :return: list - The names of the saved files
+    """
+    saved_files = []
+
+    match file_book.type:
+        case "LibreOffice":
+            for source_path in source_paths:
+                count = find_libreOffice_part(file_book, source_path)
+                if count is None:
+                    continue
+
+                final_name = htmlManager.clean_libreOffice_file(source_path, file_book, count, False)
+                report(progress, final_name, completed)
+                saved_files.append(final_name)
+        case "ao3":
+            # COMPARED BY NAME - THE SOURCE CAN BE MISSING FOR A MOMENT WHILE AN EDITOR SAVES IT WITH A RENAME
+            source_path = os.path.realpath(file_book.primary_path + ".html")
+            if os.path.exists(source_path) and any(os.path.realpath(path) == source_path for path in source_paths):
+                saved_files = save_book(file_book, progress, stream)
+        case _:
+            raise UnsupportedBookError("Books of file_type " + str(file_book.type) + " can't be cleaned.")
+
+    return saved_files
+
+
+def package_book(file_book, epub_path, progress=None, stream=False, jobs=1, stylesheet=None):
+    """
+    Cleans a book and writes the parts straight into an EPUB file, see epubPackager.
+
+    No loose xhtml files are saved. The names given to the progress callback are the file names, without a folder. The
+    parts are always saved with the minimal formatter, an EPUB is read as XML and named html entities are not defined.
+
+    :param Book file_book: The book details object
+    :param str epub_path: The path of the EPUB file to create
+    :param function|None progress: Called as progress(name, status) as each part is cleaned
+    :param bool stream: Read ao3 files one chapter at a time, see htmlManager.build_ao3_stream
+    :param int jobs: The number of worker processes for LibreOffice files
+    :param str|None stylesheet: The path of a css file to add to the EPUB as styles.css
+    :raises SourceError: If the source html can't be found, or an ao3 file is not laid out as an ao3 download
+    :raises UnsupportedBookError: If the file_type of the book can't be cleaned
+
+    :return: str - The path of the EPUB file
+    """
+    file_book.formatter = "minimal"
+
+    parts = clean_book(file_book, progress, stream, jobs)
+    first_part = next(parts, None)  # Find any problem with the book before creating the EPUB
+
+    with epubPackager.EpubWriter(file_book, epub_path, stylesheet) as epub:
+        for file_name, data in ([first_part] if first_part is not None else []):
+            add_to_epub(epub, file_name, data)
+        for file_name, data in parts:
+            add_to_epub(epub, file_name, data)
+
+    return epub_path
+
+
+# RESUMABLE RUNS #######################################################################################################
+def resume_libreOffice_parts(parts, file_book, journal, retries, saved, source_hashes, progress=None, executor=None,
+                             guard=None):
+    """
+    Cleans and saves a list of LibreOffice html files for a resumable run. The files an earlier run saved are skipped,
+    and a file that fails is tried again in its own call, then reported as failed without stopping the others.
+
+    :param list parts: The (path, chapter number or additional file name) tuples to clean
+    :param Book file_book: The book details object
+    :param RunJournal journal: The journal of the run
+    :param int retries: How many more times a failed file is tried
+    :param function saved: Called as saved(part path, saved file name, status) as each file is saved or resumed
+    :param dict source_hashes: The hash of each path, the missing ones are filled in
+    :param function|None progress: The progress callback
+    :param ProcessPoolExecutor|None executor: The pool to send the files to. None cleans them in this process.
+    :param MemoryGuard|None guard: How many files the pool can clean at once, needed with a pool
+
+    :return: Void
+    """
+    finished = set()
+    for part_path, count in parts:
+        if part_path not in source_hashes:
+            source_hashes[part_path] = hash_file(part_path)
+
+        if journal.is_finished(part_path, source_hashes[part_path],
+                               htmlManager.libreOffice_final_name(file_book, count)):
+            finished.add(part_path)
+
+    remaining = [(part_path, count) for part_path, count in parts if part_path not in finished]
+    arguments = (repeat(htmlManager.clean_libreOffice_file), repeat(retries),
+                 [part_path for part_path, count in remaining], repeat(file_book),
+                 [count for part_path, count in remaining], repeat(False))
+    if executor is None:
+        results = map(runJournal.run_part, *arguments)
+    else:
+        results = memoryGuard.guarded_map(executor, guard, runJournal.run_part, *arguments)
+
+    # REPORTED IN PART ORDER, THE RESUMED FILES BETWEEN THE CLEANED ONES
+    for part_path, count in parts:
+        final_name = htmlManager.libreOffice_final_name(file_book, count)
+        if part_path in finished:
+            saved(part_path, final_name, resumed)
+            continue
+
+        saved_name, error = next(results)
+        if error is None:
+            journal.record(part_path, source_hashes[part_path], saved_name)
+            saved(part_path, saved_name)
+        else:
+            journal.record_failure(part_path, final_name, error)
+            report(progress, final_name + " - " + error, failed)
+
+
+def resume_ao3_parts(file, file_book, source_path, source_hash, journal, retries, progress=None):
+    """
+    Cleans and saves the parts of an ao3 file for a resumable run, one chapter at a time. The parts an earlier run
+    saved are skipped without being built, and a part that fails is built again from its html, then reported as failed
+    without stopping the others. See htmlManager.plan_ao3_stream.
+
+    :param file file: The open html file
+    :param Book file_book: The book details object
+    :param str source_path: The path of the html file
+    :param str source_hash: The hash of the html file
+    :param RunJournal journal: The journal of the run
+    :param int retries: How many more times a failed part is tried
+    :param function|None progress: The progress callback
+
+    :return: list - The names of the saved and resumed files
+    """
+    saved_files = []
+    for part_name, build_part in read_ao3_parts(htmlManager.plan_ao3_stream(file, file_book), source_path):
+        final_name = file_book.output_folder + "/" + part_name
+        if journal.is_finished(source_path, source_hash, final_name):
+            report(progress, final_name, resumed)
+            saved_files.append(final_name)
+            continue
+
+        saved_name, error = runJournal.run_part(save_ao3_part, retries, build_part, final_name, file_book)
+        if error is not None:
+            journal.record_failure(source_path, final_name, error)
+            report(progress, final_name + " - " + error, failed)
+        elif saved_name is not None:  # The afterword can turn out to be empty
+            journal.record(source_path, source_hash, saved_name)
+            report(progress, saved_name, completed)
+            saved_files.append(saved_name)
+
+    return saved_files
+
+
+def read_ao3_parts(parts, source_path):
+    """
+    Gives the parts of an ao3 file as they are built. htmlManager finds each part of a work by the tags of an ao3
+    download, so html laid out any other way fails on a lookup that found nothing. That is raised as a SourceError.
+
+    :param Iterator parts: The parts, from htmlManager.build_ao3, build_ao3_stream or plan_ao3_stream
+    :param str source_path: The path of the html file
+    :raises SourceError: If the html is not laid out as an ao3 download
+
+    :return: Iterator of the parts
+    """
+    try:
+        yield from parts
+    except (AttributeError, TypeError) as error:
+        raise SourceError("The ao3 source html is not laid out as expected: " + source_path) from error
+
+
+def save_ao3_part(build_part, final_name, file_book):
+    """
+    Builds an ao3 part found by htmlManager.plan_ao3_stream and saves it.
+
+    :param function build_part: The build function of the part
+    :param str final_name: The file name to save the part as
+    :param Book file_book: The book details object
+
+    :return: str|None - The saved file name, None if the part turned out to be empty
+    """
+    soup = build_part()
+    if not soup:
+        return None
+
+    final_name = htmlManager.soup_to_file(soup, final_name, False, file_book.formatter, file_book.atomic)
+    soup.decompose()  # Release the finished part
+
+    return final_name
+
+
+# SERIES ###############################################################################################################
+def find_series_works(file_book):
+    """
+    Loads the books of the works of a series. Each work is a LibreOffice or ao3 format file in the folder of the series
+    format, named in its works list.
+
+    :param Book file_book: The book details object of the series
+    :raises SourceError: If the format of a work does not exist
+    :raises FormatError: If the format of a work can't be used
+    :raises UnsupportedBookError: If a work is not a LibreOffice or ao3 book
+
+    :return: list - The Book of each work, in reading order
+    """
+    work_books = []
+    for work_name in file_book.works:
+        work_path = "{}/{}.json".format(file_book.primary_path, work_name)
+        if not os.path.isfile(work_path):
+            raise SourceError("The format of a series work does not exist: " + work_path)
+
+        work_book = load_book(work_path)
+        if work_book.type not in (FileType.LIBREOFFICE, FileType.AO3):
+            raise UnsupportedBookError("A series can only hold LibreOffice and ao3 works: " + work_path)
+
+        # THE SERIES IS ONE BUILD, EVERY WORK IS SAVED THE SAME WAY
+        work_book.parser = file_book.parser
+        work_book.formatter = file_book.formatter
+        work_book.atomic = file_book.atomic
+        work_book.prepass = file_book.prepass
+        work_book.output_folder = file_book.output_folder
+        work_books.append(work_book)
+
+    return work_books
+
+
+def build_series(file_book, stream=False, jobs=1, progress=None):
+    """
+    Cleans the works of a series, a whole work in each worker process when jobs are requested.
+
+    The parts of each work are named with the number of the work first, e.g. 02-1-chapter.xhtml, so the parts of the
+    whole series sort in reading order. Images used by the works are given once, the first time they are found, see
+    collect_assets.
+
+    :param Book file_book: The book details object of the series
+    :param bool stream: Read ao3 files one chapter at a time, see htmlManager.build_ao3_stream
+    :param int jobs: The number of worker processes, each cleans one work at a time
+    :param function|None progress: Called as progress(name, status) if the workers go over the memory limit
+    :raises CleanError: If a work or its source html can't be used
+
+    :return: Iterator of (work name, list of (file name, bytes)) tuples, one for each work in reading order
+    """
+    work_books = find_series_works(file_book)  # Find any problem with a work before cleaning any
+
+    number_width = len(str(len(work_books)))
+    work_numbers = [str(number).zfill(number_width) for number in range(1, len(work_books) + 1)]
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        if executor is None:
+            results = map(clean_series_work, work_books, work_numbers, repeat(stream))
+        else:
+            results = memoryGuard.guarded_map(executor, create_guard(jobs, progress), clean_series_work, work_books,
+                                              work_numbers, repeat(stream))
+
+        found_assets = set()
+        for work_name, (parts, assets) in zip(file_book.works, results):
+            for asset_name, asset_path in assets.items():  # EACH IMAGE ONCE FOR THE WHOLE SERIES
+                if asset_name not in found_assets:
+                    found_assets.add(asset_name)
+                    with open(asset_path, "rb") as asset_file:
+                        parts.append((asset_name, asset_file.read()))
+
+            yield work_name, parts
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def clean_series_work(work_book, work_number, stream=False):
+    """
+    Cleans a work of a series. Only uses the provided arguments so it can be sent to a worker process.
+
+    The parts are put in the reading order of the work, with the additional files marked as front first.
+
+    :param Book work_book: The book details object of the work
+    :param str work_number: The number of the work in the series, added to the start of each part name
+    :param bool stream: Read ao3 files one chapter at a time, see htmlManager.build_ao3_stream
+
+    :return: tuple - The list of (file name, xhtml bytes) of the parts and the dict of image names to source paths
+    """
+    source_folder = get_source_folder(work_book)
+
+    parts = []
+    assets = {}
+    for part_name, xhtml in clean_book(work_book, None, stream):
+        parts.append((work_number + "-" + part_name, collect_assets(xhtml, source_folder, assets)))
+
+    front_names = {work_number + "-" + part["final_name"] + ".xhtml" for part in work_book.additional_paths.values()
+                   if part.get("front")}
+    parts.sort(key=lambda part: part[0] not in front_names)  # Stable, the rest keep their order
+
+    return parts, assets
+
+
+def collect_assets(xhtml, source_folder, assets):
+    """
+    Points the local images of a cleaned part at the shared images folder of the series.
+
+    Each image is named by a hash of its contents, so an image used by many works is only saved once. Links to other
+    sites and images that can't be found are left as they are.
+
+    :param bytes xhtml: The xhtml of the part
+    :param str source_folder: The folder the image sources are relative to
+    :param dict assets: Filled with the image name to the path of its source file
+
+    :return: bytes - The xhtml with the new image sources
+    """
+    def replace_source(source_match):
+        source = html.unescape(source_match.group(2).decode("utf-8"))
+        if urllib.parse.urlsplit(source).scheme or source.startswith("/"):  # Not a local file
+            return source_match.group(0)
+
+        asset_path = os.path.normpath(os.path.join(source_folder, urllib.parse.unquote(source)))
+        if not os.path.isfile(asset_path):
+            return source_match.group(0)
+
+        asset_name = get_asset_name(asset_path)
+        assets[asset_name] = asset_path
+
+        return source_match.group(1) + html.escape(asset_name).encode("utf-8") + source_match.group(3)
+
+    return image_source_pattern.sub(replace_source, xhtml)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_asset_name(asset_path):
+    """
+    Gets the name an image is saved under, from a hash of its contents. Images used many times are only hashed once.
+
+    :param str asset_path: The path of the image
+
+    :return: str - The name, inside the images folder
+    """
+    return asset_folder + "/" + hash_file(asset_path)[:16] + os.path.splitext(asset_path)[1].lower()
+
+
+# HELPER FUNCTIONS #####################################################################################################
+def create_guard(jobs, progress=None):
+    """
+    Creates the memory guard of a pool of worker processes, see memoryGuard. Each time the workers go over the memory
+    limit the total is reported as throttled.
+
+    :param int jobs: The number of worker processes
+    :param function|None progress: The progress callback
+
+    :return: MemoryGuard
+    """
+    def report_throttle(total):
+        report(progress, "{:.0f} MB, over the {:.0f} MB limit".format(total, memoryGuard.memory_limit), throttled)
+
+    return memoryGuard.MemoryGuard(jobs, report_throttle)
+
+
+def report(progress, name, status):
+    """
+    Calls the progress callback if there is one.
+
+    :param function|None progress: The progress callback
+    :param str name: The file or group name
+    :param str status: What happened to it
+
+    :return: Void
+    """
+    if progress is not None:
+        progress(name, status)
+
+
+def add_to_epub(epub, file_name, data):
+    """
+    Adds a part or an image of a book to an EPUB. Images are the files inside the images folder.
+
+    :param EpubWriter epub: The EPUB being written
+    :param str file_name: The file name, as given by clean_book
+    :param bytes data: The xhtml of the part, or the image
+
+    :return: Void
+    """
+    if file_name.startswith(asset_folder + "/"):
+        epub.add_asset(file_name, data)
+    else:
+        epub.add_part(file_name, data)
+
+
+def encode_parts(parts, file_book, progress):
+    """
+    Encodes each built part and reports it as completed.
+
+    :param Iterator parts: The (file name, BeautifulSoup) tuples of the parts
+    :param Book file_book: The book details object
+    :param function|None progress: The progress callback
+
+    :return: Iterator of (file name, xhtml bytes) tuples
+    """
+    for part_name, soup in parts:
+        xhtml = htmlManager.soup_to_bytes(soup, file_book.formatter)
+        stageTimings.finish_document(part_name)
+        report(progress, part_name, completed)
+
+        yield part_name, xhtml
+
+
+def encode_libreOffice_file(part_path, file_book, count):
+    """
+    Cleans a LibreOffice html file and encodes it. Only uses the provided arguments so it can be sent to a worker
+    process.
+
+    :param str part_path: The path of the html file to clean
+    :param Book file_book: The book details object
+    :param int|str count: The chapter number or the name of the additional file
+
+    :return: bytes - The xhtml of the file
+    """
+    soup = htmlManager.build_libreOffice_file(part_path, file_book, count)
+    xhtml = htmlManager.soup_to_bytes(soup, file_book.formatter)
+    stageTimings.finish_document(htmlManager.libreOffice_part_name(file_book, count))
+    soup.decompose()  # Release the finished part
+
+    return xhtml
+
+
+def encode_libreOffice_parts(parts, file_book, executor=None, guard=None):
+    """
+    Cleans and encodes a list of LibreOffice html files, in a process pool if one is provided.
+
+    :param list parts: The (path, chapter number or additional file name) tuples to clean
+    :param Book file_book: The book details object
+    :param ProcessPoolExecutor|None executor: The pool to send the files to. None cleans them in this process.
+    :param MemoryGuard|None guard: How many files the pool can clean at once, needed with a pool, see create_guard
+
+    :return: Iterator of the xhtml bytes, in the same order as the parts
+    """
+    part_paths = [part_path for part_path, count in parts]
+    part_counts = [count for part_path, count in parts]
+
+    if executor is None:
+        return map(encode_libreOffice_file, part_paths, repeat(file_book), part_counts)
+
+    return memoryGuard.guarded_map(executor, guard, encode_libreOffice_file, part_paths, repeat(file_book), part_counts)
+
+
+def clean_libreOffice_parts(parts, file_book, executor=None, guard=None):
+    """
+    Cleans a list of LibreOffice html files, in a process pool if one is provided.
+
+    The files are not reported as they are saved, the returned iterator gives the saved file names in the same order as
+    the provided parts so the caller can report them the same way for both serial and parallel runs.
+
+    :param list parts: The (path, chapter number or additional file name) tuples to clean
+    :param Book file_book: The book details object
+    :param ProcessPoolExecutor|None executor: The pool to send the files to. None cleans them in this process.
+    :param MemoryGuard|None guard: How many files the pool can clean at once, needed with a pool, see create_guard
+
+    :return: Iterator of the saved file names
+    """
+    part_paths = [part_path for part_path, count in parts]
+    part_counts = [count for part_path, count in parts]
+
+    if executor is None:
+        return map(htmlManager.clean_libreOffice_file, part_paths, repeat(file_book), part_counts, repeat(False))
+
+    return memoryGuard.guarded_map(executor, guard, htmlManager.clean_libreOffice_file, part_paths, repeat(file_book),
+                                   part_counts, repeat(False))
+
+
+def skip_unchanged(parts, file_book, manifest, source_hashes, progress=None):
+    """
+    Removes the LibreOffice files that are unchanged since the last build and reports them as unchanged.
+
+    :param list parts: The (path, chapter number or additional file name) tuples
+    :param Book file_book: The book details object
+    :param BuildManifest manifest: The manifest of the last build
+    :param dict source_hashes: Filled with the hash of each path, to record once cleaned
+    :param function|None progress: The progress callback
+
+    :return: list - The parts that need cleaning
+    """
+    changed = []
+    for part_path, count in parts:
+        source_hashes[part_path] = hash_file(part_path)
+
+        if manifest.is_current(part_path, source_hashes[part_path]):
+            report(progress, htmlManager.libreOffice_final_name(file_book, count), unchanged)
+        else:
+            changed.append((part_path, count))
+
+    return changed
@@ -0,0 +1,146 @@
+"""
+Keeps a record of each build so unchanged source files can be skipped on the next run.
+
+The manifest is saved as JSON in the output folder of the book, one for each format. It records the hash of every
+source file and of the files that were saved from it. A source is only skipped when its hash is unchanged and its saved
+files are all still there, unchanged. The whole manifest is thrown away if the tool, the format or the settings it is
+cleaned with change.
+"""
+
+# IMPORTS ##############################################################################################################
+import hashlib
+import json
+import os
+
+# GLOBAL VARIABLES #####################################################################################################
+# The folder of the tool, its python files make up the tool version
+tool_folder = os.path.dirname(os.path.abspath(__file__))
+
+
+# HASHING ##############################################################################################################
+def hash_file(file_path):
+    """
+    Gets the sha256 hash of a file.
+
+    :param str file_path: The path of the file
+
+    :return: str - The hex digest
+    """
+    with open(file_path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def get_tool_version():
+    """
+    Gets the version of the tool, a hash of all its python files. Any change to the code changes the version.
+
+    :return: str - The hex digest
+    """
+    tool_hash = hashlib.sha256()
+    for file_name in sorted(os.listdir(tool_folder)):
+        if file_name.endswith(".py"):
+            tool_hash.update(file_name.encode())
+            tool_hash.update(hash_file(os.path.join(tool_folder, file_name)).encode())
+
+    return tool_hash.hexdigest()
+
+
+def get_format_key(format_path, parser, formatter, prepass):
+    """
+    Gets the key of the format file and the settings it is cleaned with. Any change to them changes the saved files.
+
+    :param str format_path: The path of the format JSON file
+    :param str parser: The parser engine used
+    :param str formatter: The formatter used to save the xhtml, minimal or html
+    :param bool prepass: The LibreOffice junk is removed from the html text before it is parsed
+
+    :return: str
+    """
+    return ":".join((hash_file(format_path), parser, formatter, "prepass" if prepass else "dom"))
+
+
+# MAIN CLASS ###########################################################################################################
+class BuildManifest:
+    """
+    Class to record the source files of a book and the files saved from them.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self, format_name, format_path, parser, output_folder, formatter="minimal", prepass=False):
+        """
+        The init function. Loads the last manifest of the format if it was built with the same tool, format and
+        settings.
+
+        :param str format_name: The name of the format, used to name the manifest
+        :param str format_path: The path of the format JSON file
+        :param str parser: The parser engine used, output can differ between parsers
+        :param str output_folder: The folder the files are saved in, the manifest is saved with them
+        :param str formatter: The formatter used to save the xhtml, minimal or html
+        :param bool prepass: The LibreOffice junk is removed from the html text before it is parsed
+        """
+        self.path: str = os.path.join(output_folder, ".manifest-" + format_name + ".json")
+
+        self.tool: str = get_tool_version()  # The version of the tool
+        self.format: str = get_format_key(format_path, parser, formatter, prepass)  # The format file and its settings
+
+        self.sources: dict = {}  # Source path to {"hash": source hash, "outputs": {saved file: hash}}
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as manifest_file:
+                try:
+                    manifest = json.load(manifest_file)
+                except ValueError:  # Broken manifest - Rebuild everything
+                    manifest = {}
+
+            if manifest.get("tool") == self.tool and manifest.get("format") == self.format:
+                self.sources = manifest.get("sources", {})
+
+    # MANIFEST METHODS #################################################################################################
+    def is_current(self, source_path, source_hash):
+        """
+        Checks if a source file was built from the same contents and its saved files are unchanged.
+
+        :param str source_path: The path of the source file
+        :param str source_hash: The hash of the source file now
+
+        :return: bool
+        """
+        entry = self.sources.get(source_path)
+        if not entry or entry["hash"] != source_hash:
+            return False
+
+        for output, output_hash in entry["outputs"].items():
+            if not os.path.exists(output) or hash_file(output) != output_hash:
+                return False
+
+        return True
+
+    def get_outputs(self, source_path):
+        """
+        Gets the files saved from a source file on its last build.
+
+        :param str source_path: The path of the source file
+
+        :return: list - The saved file names
+        """
+        return list(self.sources.get(source_path, {}).get("outputs", {}))
+
+    def record(self, source_path, source_hash, outputs):
+        """
+        Records the files saved from a source file.
+
+        :param str source_path: The path of the source file
+        :param str source_hash: The hash of the source file that was built
+        :param list outputs: The saved file names
+
+        :return: Void
+        """
+        self.sources[source_path] = {"hash": source_hash, "outputs": {output: hash_file(output) for output in outputs}}
+
+    def save(self):
+        """
+        Saves the manifest to the output folder.
+
+        :return: Void
+        """
+        with open(self.path, "w") as manifest_file:
+            json.dump({"tool": self.tool, "format": self.format, "sources": self.sources}, manifest_file, indent=4)
@@ -1,19 +1,30 @@
 """
 A tool to clean up autogenerated html files into xhtml files for the creation of an epub using Beautiful Soup.
 
-This script manages the logic of loading files.
+This script is the command line wrapper around bookCleaner, which does the cleaning.
+
+bookCleaner and htmlManager load Beautiful Soup, which is most of the start up time. They are imported by the functions
+that clean, so --check and the argument errors never load them.
 """
 
 # IMPORTS ##############################################################################################################
 import argparse  # Command line arguments
-
-from bs4 import BeautifulSoup
+from itertools import repeat
+import fnmatch  # Format name patterns
+import json
+import time
 
 # Custom classes
-import htmlManager
-from book import Book
+import book
+import fragmentCache
+import memoryGuard
+import stageTimings
+from book import CleanError, FileType, FormatError, output_formatters
+from buildManifest import BuildManifest
+from folderWatcher import FolderWatcher
+from runJournal import RunJournal
 
-import os.path
+import os
 
 # CMD LINE ARGS ########################################################################################################
 
@@ -21,67 +32,530 @@ import os.path
 cmd_parser = argparse.ArgumentParser()
 
 # MANAGE ARGUMENTS -----------------------------------------------------------------------------------------------------
-cmd_parser.add_argument("format",
-                        help="The name of the format file to be used. It must be found in the format subfolder.")
-
-# GET CMD LINE ARGS ----------------------------------------------------------------------------------------------------
-cmd_args = cmd_parser.parse_args()  # GET PROVIDED ARGUMENTS
-
-format_name = cmd_args.format  # NAME OF THE FORMAT TO BE USED
-format_path = "format/{}.json".format(format_name)
-
-# PROGRAM SET UP #######################################################################################################
-
-# FORMAT SETUP ---------------------------------------------------------------------------------------------------------
-if os.path.exists(format_path):  # Check if the book format file exists
-    format_file = open(format_path, 'r')
-    thisBook = Book(0, format_file)
-    format_file.close()
-else:  # NO FORMAT FOUND - EXIT
-    print("Error: Format does not exist")
-    exit()
-
-# PROGRAM LOGIC ########################################################################################################
-# MANAGE TYPE OF FORMAT ------------------------------------------------------------------------------------------------
-match thisBook.type:
-    case "LibreOffice":
-        # BUILD CHAPTER PATH
-        chapter_count = 1
-        chapter_path = "{}/{}.html".format(thisBook.primary_path, thisBook.file_name)
-        # LOOP THROUGH ALL CHAPTERS
-        while os.path.exists(chapter_path.format(chapter_count)):
-            file = open(chapter_path.format(chapter_count), "r")
-            file_soup = BeautifulSoup(file, "html.parser")
-
-            htmlManager.clean_libreOffice(file_soup, thisBook, chapter_count)
-
-            file.close()
-
-            chapter_count += 1
-        print("CHAPTERS COMPLETE                                      ")  # WHITESPACE TO CLEAR LINE
-
-        # LOOP THROUGH ALL ADDITIONAL PARTS
-        for file_name in thisBook.additional_paths:
-            additional_path = "{}/{}.html".format(thisBook.primary_path, file_name)
-            if os.path.exists(additional_path):
-                file = open(additional_path, "r")
-                file_soup = BeautifulSoup(file, "html.parser")
-
-                htmlManager.clean_libreOffice(file_soup, thisBook, file_name)
-
-                file.close()
-        print("ADDITIONAL COMPLETE                                    ")  # WHITESPACE TO CLEAR LINE
-    case "ao3":
-        # OPEN FILES
-        file = open(thisBook.primary_path + ".html", "r")
-        file_soup = BeautifulSoup(file, "html.parser")
-
-        htmlManager.clean_ao3(file_soup, thisBook)
-
-        file.close()
-    case "series":
-        pass
-
-# PRINT SHOW END OF PROJECT - WHITESPACE TO CLEAR PREVIOUS LETTERS
-print("ALL COMPLETE                                   ")
+cmd_parser.add_argument("format", nargs="*",
+                        help="The name of the format file to be used. It must be found in the format subfolder. "
+                             "More than one name, or a pattern such as 'example-*', cleans the books as a batch.")
+cmd_parser.add_argument("--all", action="store_true",
+                        help="Clean every format in the format subfolder as a batch.")
+cmd_parser.add_argument("--check", action="store_true",
+                        help="Only load and check the format files, and the formats of the works of a series. Nothing "
+                             "is cleaned.")
+cmd_parser.add_argument("--summary",
+                        help="Save a JSON summary of a batch, with the timings and failures of each book, to this "
+                             "file.")
+cmd_parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="The number of worker processes. Cleans LibreOffice files in parallel, or whole books in "
+                             "a batch. Defaults to 1.")
+cmd_parser.add_argument("--memory-limit", type=float,
+                        help="The memory limit in MB of this process and its worker processes together. Over it the "
+                             "workers clean one file or book at a time until the memory falls back under it.")
+cmd_parser.add_argument("--parser",
+                        help="The parser engine for the source html, e.g. lxml or html.parser. Overrides the format "
+                             "file. Defaults to auto, the fastest installed parser.")
+cmd_parser.add_argument("--formatter", choices=output_formatters,
+                        help="How text is escaped in the saved xhtml. minimal only escapes &, < and >, html also uses "
+                             "named entities. Overrides the format file. Defaults to minimal.")
+cmd_parser.add_argument("--atomic", action="store_true",
+                        help="Save each file through a temporary file and a rename, so no file is left half written.")
+cmd_parser.add_argument("--stream", action="store_true",
+                        help="Clean ao3 files while they are read, keeping one chapter in memory at a time.")
+cmd_parser.add_argument("--prepass", action="store_true",
+                        help="Remove LibreOffice font, center and span tags, align attributes and lone &nbsp; from the "
+                             "html text before it is parsed. The cleaned files are the same.")
+cmd_parser.add_argument("--prefetch", type=int, default=0,
+                        help="Read up to this many LibreOffice files ahead and write the cleaned files in the "
+                             "background, so file reads and writes overlap the cleaning. Defaults to 0, one file at a "
+                             "time.")
+cmd_parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Skip source files that have not changed since the last incremental build.")
+cmd_parser.add_argument("--resume", action="store_true",
+                        help="Keep a journal of the saved parts in the output folder and carry on from the journal of "
+                             "an earlier run that stopped partway. A part that fails is tried again, then skipped so "
+                             "the rest of the book is still cleaned. Files are saved atomically.")
+cmd_parser.add_argument("--retries", type=int, default=1,
+                        help="How many more times --resume tries a part that fails. Defaults to 1.")
+cmd_parser.add_argument("--watch", action="store_true",
+                        help="After cleaning the book keep watching its source folder, and clean each changed file "
+                             "again as soon as it is saved. Stop with Ctrl+C.")
+cmd_parser.add_argument("--fragment-cache",
+                        help="A folder to keep cleaned ao3 fragments in, such as the byline, tag list and notes, so "
+                             "fragments repeated across works are not built again.")
+cmd_parser.add_argument("--fragment-cache-size", type=float, default=64,
+                        help="The size limit of the fragment cache in MB, the least recently used fragments are "
+                             "removed past it. Defaults to 64.")
+cmd_parser.add_argument("--timings",
+                        help="Save the time and node count of each stage of each document to this file. A .csv path "
+                             "saves CSV, anything else JSON.")
+cmd_parser.add_argument("--profile",
+                        help="Save a cProfile dump of the whole run to this file, to read with pstats.")
+cmd_parser.add_argument("--epub", action="store_true",
+                        help="Save the book as an EPUB file, {format}.epub, instead of separate xhtml files.")
+cmd_parser.add_argument("--stylesheet",
+                        help="A css file to add to the EPUB as the styles.css the xhtml files link to.")
+
+
+# GLOBAL VARIABLES #####################################################################################################
+# The folder of the format files
+format_folder = "format"
+
+# The folder the cleaned files are saved in. Each book in a batch gets its own folder inside it
+final_folder = "final"
+
+
+# FORMAT HELPERS #######################################################################################################
+def find_formats(names, all_formats=False):
+    """
+    Gets the format names to clean from the command line names.
+
+    Names with a pattern (*, ? or [) are matched against the format folder, other names are used as they are.
+
+    :param list names: The format names or patterns
+    :param bool all_formats: Use every format in the format folder
+
+    :return: list - The format names
+    """
+    available = sorted(file_name[:-len(".json")] for file_name in os.listdir(format_folder)
+                       if file_name.endswith(".json"))
+
+    if all_formats:
+        return available
+
+    format_names = []
+    for name in names:
+        if any(character in name for character in "*?["):
+            format_names.extend(match for match in available if fnmatch.fnmatch(match, name))
+        else:
+            format_names.append(name)
+
+    return list(dict.fromkeys(format_names))  # Remove repeats, keep order
+
+
+def load_book(format_name):
+    """
+    Loads the book of a format file in the format folder.
+
+    :param str format_name: The name of the format, without the .json
+    :raises FormatError: If the format does not exist or can't be used
+
+    :return: Book
+    """
+    format_path = "{}/{}.json".format(format_folder, format_name)
+
+    if not os.path.exists(format_path):  # Check if the book format file exists
+        raise FormatError("Error: Format does not exist")
+
+    return book.load_book(format_path)
+
+
+def check_format(format_name):
+    """
+    Loads the book of a format file, and the formats of its works if it is a series, without cleaning anything.
+
+    :param str format_name: The name of the format, without the .json
+    :raises FormatError: If the format or the format of a work can't be used
+
+    :return: Book
+    """
+    thisBook = load_book(format_name)
+
+    if thisBook.type == FileType.SERIES:
+        for work_name in thisBook.works:
+            work_path = "{}/{}.json".format(thisBook.primary_path, work_name)
+            if not os.path.isfile(work_path):
+                raise FormatError("The format of a series work does not exist: " + work_path)
+
+            work_book = book.load_book(work_path)
+            if work_book.type == FileType.SERIES:
+                raise FormatError("A series can only hold LibreOffice and ao3 works: " + work_name)
+
+    return thisBook
+
+
+def print_status(name, status):
+    """
+    Prints the progress of a book, the progress callback given to bookCleaner.
+
+    :param str name: The file or group name
+    :param str status: What happened to it, see bookCleaner
+
+    :return: Void
+    """
+    import bookCleaner
+    import htmlManager
+
+    if status == bookCleaner.group_complete:
+        print((name + " " + status).ljust(55))  # WHITESPACE TO CLEAR LINE
+    elif status in (bookCleaner.missing, bookCleaner.stray, bookCleaner.throttled,
+                    bookCleaner.failed):  # KEEP WARNINGS ON THEIR OWN LINE
+        print((status + ": " + name).ljust(55))
+    else:
+        htmlManager.print_progress(name, status)
+
+
+# PROGRAM ##############################################################################################################
+def setup_book(format_name, cmd_args, output_folder=final_folder, show_progress=True):
+    """
+    Loads the book of a format file and applies the command line options to it.
+
+    :param str format_name: The name of the format, without the .json
+    :param argparse.Namespace cmd_args: The command line arguments
+    :param str output_folder: The folder to save the cleaned files in, created if needed
+    :param bool show_progress: Print a line if the requested parser is not installed
+    :raises FormatError: If the format does not exist or can't be used
+
+    :return: Book
+    """
+    import htmlManager
+
+    # FORMAT SETUP -----------------------------------------------------------------------------------------------------
+    thisBook = load_book(format_name)
+    thisBook.output_folder = output_folder
+    os.makedirs(output_folder, exist_ok=True)
+
+    # PARSER SETUP -----------------------------------------------------------------------------------------------------
+    if cmd_args.parser:  # Command line overrides the format file
+        thisBook.parser = cmd_args.parser
+
+    parser = htmlManager.get_parser(thisBook.parser)
+    if show_progress and thisBook.parser not in ("auto", parser):  # Requested parser not installed
+        print("Parser " + thisBook.parser + " is not available, using " + parser)
+    thisBook.parser = parser
+
+    # OUTPUT SETUP -----------------------------------------------------------------------------------------------------
+    if cmd_args.formatter:  # Command line overrides the format file
+        thisBook.formatter = cmd_args.formatter
+    thisBook.atomic = cmd_args.atomic or cmd_args.resume  # A resumed run trusts every saved file to be whole
+    thisBook.prepass = cmd_args.prepass
+
+    return thisBook
+
+
+def clean_format(format_name, cmd_args, output_folder=final_folder, jobs=1, show_progress=True):
+    """
+    Cleans the book of a format file.
+
+    :param str format_name: The name of the format, without the .json
+    :param argparse.Namespace cmd_args: The command line arguments
+    :param str output_folder: The folder to save the cleaned files in
+    :param int jobs: The number of worker processes for LibreOffice files
+    :param bool show_progress: Print progress as files are saved
+    :raises CleanError: If the format or its source html can't be used
+
+    :return: list - The names of the saved files
+    """
+    import bookCleaner
+
+    thisBook = setup_book(format_name, cmd_args, output_folder, show_progress)
+
+    # EPUB - EVERY PART IS WRITTEN STRAIGHT INTO THE PACKAGE
+    if cmd_args.epub:
+        epub_path = bookCleaner.package_book(thisBook, output_folder + "/" + format_name + ".epub",
+                                             print_status if show_progress else None, cmd_args.stream, jobs,
+                                             cmd_args.stylesheet)
+        return [epub_path]
+
+    # BUILD MANIFEST - ONLY FOR INCREMENTAL BUILDS
+    manifest = None
+    if cmd_args.incremental:
+        manifest = BuildManifest(format_name, "{}/{}.json".format(format_folder, format_name), thisBook.parser,
+                                 output_folder, thisBook.formatter, thisBook.prepass)
+
+    # CLEAN AND SAVE ---------------------------------------------------------------------------------------------------
+    if not cmd_args.resume or thisBook.type == FileType.SERIES:  # A series is always cleaned in full
+        return bookCleaner.save_book(thisBook, print_status if show_progress else None, cmd_args.stream, jobs, manifest,
+                                     cmd_args.prefetch)
+
+    # RESUMABLE - THE JOURNAL IS REMOVED ONCE EVERY PART IS SAVED
+    with RunJournal(format_name, "{}/{}.json".format(format_folder, format_name), thisBook.parser, output_folder,
+                    thisBook.formatter, thisBook.prepass) as journal:
+        return bookCleaner.save_book(thisBook, print_status if show_progress else None, cmd_args.stream, jobs, manifest,
+                                     cmd_args.prefetch, journal, cmd_args.retries)
+
+
+def watch_format(format_name, cmd_args):
+    """
+    Cleans a book, then keeps watching its source folder and cleans each source file again as it changes.
+
+    The book, its rules and the parser are set up once and kept for every change. Runs until stopped with Ctrl+C.
+
+    :param str format_name: The name of the format, without the .json
+    :param argparse.Namespace cmd_args: The command line arguments
+    :raises CleanError: If the format or its source html can't be used
+
+    :return: Void
+    """
+    import bookCleaner
+
+    thisBook = setup_book(format_name, cmd_args)
+    if thisBook.type == FileType.SERIES:
+        raise bookCleaner.UnsupportedBookError("--watch can't be used with a series, watch each work on its own.")
+
+    # START WATCHING BEFORE THE FIRST CLEAN SO NO CHANGE IS MISSED
+    watcher = FolderWatcher(bookCleaner.get_source_folder(thisBook))
+    bookCleaner.save_book(thisBook, print_status, cmd_args.stream, cmd_args.jobs, None, cmd_args.prefetch)
+    print(("WATCHING " + watcher.folder + " - Ctrl+C to stop").ljust(55))
+
+    try:
+        for changed in watcher.watch():
+            save_watched(thisBook, changed, cmd_args.stream)
+    except KeyboardInterrupt:
+        print("WATCH STOPPED".ljust(55))
+
+
+def save_watched(file_book, changed, stream=False):
+    """
+    Cleans the changed source files of a watched book. A file that can't be cleaned, e.g. broken html or removed since
+    it changed, is printed as FAILED and the watch carries on.
+
+    :param Book file_book: The book details object
+    :param list changed: The paths of the source files that changed
+    :param bool stream: Read ao3 files one chapter at a time
+
+    :return: list - The names of the saved files
+    """
+    import bookCleaner
+
+    start = time.perf_counter()
+    saved_files = []
+    for source_path in changed:
+        try:
+            saved_files += bookCleaner.save_changed(file_book, [source_path], print_status, stream)
+        except Exception as error:
+            print_status("{} - {}: {}".format(source_path, type(error).__name__, error), bookCleaner.failed)
+
+    if saved_files:
+        print("UPDATED {} files in {:.2f}s".format(len(saved_files), time.perf_counter() - start).ljust(55))
+
+    return saved_files
+
+
+# BATCH ################################################################################################################
+def clean_batch_book(format_name, cmd_args):
+    """
+    Cleans one book of a batch into its own folder. Any error is recorded instead of stopping the batch.
+
+    :param str format_name: The name of the format, without the .json
+    :param argparse.Namespace cmd_args: The command line arguments
+
+    :return: dict - The result of the book, its name, status, seconds, saved files and error
+    """
+    result = {"format": format_name, "status": "COMPLETE", "seconds": 0.0, "files": 0, "error": None}
+
+    cache = fragmentCache.active_cache
+    cache_start = cache.get_stats() if cache else None
+
+    start = time.perf_counter()
+    try:
+        output_folder = final_folder + "/" + format_name
+        result["files"] = len(clean_format(format_name, cmd_args, output_folder, show_progress=False))
+    except Exception as error:  # ONE BAD BOOK MUST NOT STOP THE BATCH
+        result["status"] = "FAILED"
+        result["error"] = "{}: {}".format(type(error).__name__, error)
+        if isinstance(error, FormatError):  # Each problem of the format, for the JSON summary
+            result["issues"] = error.issues
+    result["seconds"] = time.perf_counter() - start
+
+    if cache:  # The counts of this book, the cache can be shared by the books of a worker process
+        cache_end = cache.get_stats()
+        result["cache"] = {counter: cache_end[counter] - cache_start[counter] for counter in ("hits", "misses")}
+
+    return result
+
+
+def clean_batch(format_names, cmd_args):
+    """
+    Cleans many books in one run, one at a time or across worker processes when jobs are requested.
+
+    Each book is saved in its own folder inside the final folder. A line is printed as each book finishes.
+
+    :param list format_names: The names of the formats to clean
+    :param argparse.Namespace cmd_args: The command line arguments
+
+    :return: list - The result of every book, see clean_batch_book
+    """
+    from concurrent.futures import ProcessPoolExecutor  # Worker processes for --jobs
+
+    results = []
+
+    def print_throttle(total):
+        print("THROTTLED: {:.0f} MB, over the {:.0f} MB limit".format(total, memoryGuard.memory_limit))
+
+    executor = ProcessPoolExecutor(max_workers=cmd_args.jobs) if cmd_args.jobs > 1 else None
+    try:
+        if executor is None:
+            book_results = map(clean_batch_book, format_names, repeat(cmd_args))
+        else:
+            guard = memoryGuard.MemoryGuard(cmd_args.jobs, print_throttle)
+            book_results = memoryGuard.guarded_map(executor, guard, clean_batch_book, format_names, repeat(cmd_args))
+
+        for result in book_results:
+            if result["error"]:
+                print("FAILED: {} - {}".format(result["format"], result["error"]))
+            else:
+                print("COMPLETED: {} - {} files in {:.2f}s".format(result["format"], result["files"],
+                                                                   result["seconds"]))
+            results.append(result)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return results
+
+
+def print_batch_summary(results, seconds):
+    """
+    Prints the summary of a batch.
+
+    :param list results: The result of every book, see clean_batch_book
+    :param float seconds: The time the whole batch took
+
+    :return: Void
+    """
+    failed = [result for result in results if result["error"]]
+
+    print("BATCH SUMMARY")
+    for result in results:
+        print("\t{:<30} {:<9} {:>5} files {:>8.2f}s".format(result["format"], result["status"], result["files"],
+                                                             result["seconds"]))
+    print("{} books, {} completed, {} failed in {:.2f}s".format(len(results), len(results) - len(failed),
+                                                                len(failed), seconds))
+
+    if any("cache" in result for result in results):
+        print("FRAGMENT CACHE: {} hits, {} misses".format(sum(result["cache"]["hits"] for result in results),
+                                                          sum(result["cache"]["misses"] for result in results)))
+
+
+def check_formats(format_names):
+    """
+    Checks the format files and prints a line for each.
+
+    :param list format_names: The names of the formats to check
+
+    :return: bool - True if every format can be used
+    """
+    valid = True
+    for format_name in format_names:
+        try:
+            thisBook = check_format(format_name)
+        except CleanError as error:
+            print("INVALID: {} - {}".format(format_name, str(error).replace("\n", " ")))
+            valid = False
+        else:
+            print("VALID: {} - {} book, {}".format(format_name, thisBook.type, thisBook.title))
+
+    return valid
+
+
+def run_books(format_names, is_batch, cmd_args):
+    """
+    Cleans the books, as a batch or a single book.
+
+    :param list format_names: The names of the formats to clean
+    :param bool is_batch: Clean the books as a batch
+    :param argparse.Namespace cmd_args: The command line arguments
+
+    :return: Void
+    """
+    # BATCH OF BOOKS ---------------------------------------------------------------------------------------------------
+    if is_batch:
+        start = time.perf_counter()
+        results = clean_batch(format_names, cmd_args)
+        seconds = time.perf_counter() - start
+
+        print_batch_summary(results, seconds)
+        if cmd_args.summary:
+            with open(cmd_args.summary, "w") as summary_file:
+                json.dump({"seconds": seconds, "books": results}, summary_file, indent=4)
+        if any(result["error"] for result in results):
+            exit(1)
+        return
+
+    # SINGLE BOOK ------------------------------------------------------------------------------------------------------
+    try:
+        if cmd_args.watch:
+            watch_format(format_names[0], cmd_args)
+            return
+
+        clean_format(format_names[0], cmd_args, jobs=cmd_args.jobs)
+    except CleanError as error:  # NO VALID FORMAT OR SOURCE, OR FAILED PARTS - EXIT
+        print(error)
+        exit(1)
+
+    # PRINT SHOW END OF PROJECT - WHITESPACE TO CLEAR PREVIOUS LETTERS
+    print("ALL COMPLETE                                   ")
+
+
+def main():
+    """
+    Runs the command line program.
+
+    :return: Void
+    """
+    # GET CMD LINE ARGS ------------------------------------------------------------------------------------------------
+    cmd_args = cmd_parser.parse_args()  # GET PROVIDED ARGUMENTS
+
+    if not cmd_args.format and not cmd_args.all:
+        cmd_parser.error("a format name or --all is required")
+
+    format_names = find_formats(cmd_args.format, cmd_args.all)  # NAMES OF THE FORMATS TO BE USED
+    is_batch = cmd_args.all or len(cmd_args.format) > 1 or format_names != cmd_args.format
+
+    if cmd_args.watch and (is_batch or cmd_args.epub):
+        cmd_parser.error("--watch cleans a single book into separate files, it can't be used with a batch or --epub")
+    if cmd_args.resume and (cmd_args.watch or cmd_args.epub):
+        cmd_parser.error("--resume carries on saving separate files, it can't be used with --watch or --epub")
+    if cmd_args.epub and cmd_args.formatter not in (None, "minimal"):
+        cmd_parser.error("--epub saves XML, where named html entities are not defined, use the minimal formatter")
+
+    # CHECK ONLY - NOTHING IS CLEANED ----------------------------------------------------------------------------------
+    if cmd_args.check:
+        if not check_formats(format_names):
+            exit(1)
+        return
+
+    # INSTRUMENTATION - ONLY THIS PROCESS IS MEASURED ------------------------------------------------------------------
+    if (cmd_args.timings or cmd_args.profile) and cmd_args.jobs > 1:
+        print("--timings and --profile run in a single process, ignoring --jobs")
+        cmd_args.jobs = 1
+    if cmd_args.timings and cmd_args.prefetch > 0:
+        print("--timings times one file at a time, ignoring --prefetch")
+        cmd_args.prefetch = 0
+    if cmd_args.resume and cmd_args.prefetch > 0:
+        print("--resume saves one file at a time, ignoring --prefetch")
+        cmd_args.prefetch = 0
+
+    if cmd_args.timings:
+        stageTimings.start_recording()
+
+    memoryGuard.memory_limit = cmd_args.memory_limit
+
+    if cmd_args.fragment_cache:
+        fragmentCache.start_cache(cmd_args.fragment_cache, int(cmd_args.fragment_cache_size * 1024 * 1024))
+
+    profiler = None
+    if cmd_args.profile:
+        import cProfile  # --profile
+
+        profiler = cProfile.Profile()
+    if profiler:
+        profiler.enable()
+
+    try:
+        run_books(format_names, is_batch, cmd_args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cmd_args.profile)
+
+        recorder = stageTimings.stop_recording()
+        if recorder:
+            recorder.save(cmd_args.timings)
+
+        cache = fragmentCache.stop_cache()
+        if cache and not is_batch:  # A batch prints the counts of its books in the summary
+            print("FRAGMENT CACHE: {hits} hits, {misses} misses, {evictions} evicted, {fragments} stored".format(
+                **cache.get_stats()))
+
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Packages the cleaned parts of a book straight into an EPUB file.
+
+Each part is written into the zip as soon as it is cleaned, so the xhtml is never saved as a loose file and read back.
+The package document (OPF) and the navigation document are written last, from the parts that were added.
+
+The layout of the EPUB:
+    mimetype
+    META-INF/container.xml
+    OEBPS/content.opf
+    OEBPS/nav.xhtml
+    OEBPS/styles.css - The parts link to ../styles.css
+    OEBPS/text/ - The parts, and the images of a series in OEBPS/text/images/
+"""
+
+# IMPORTS ##############################################################################################################
+from html import escape, unescape
+import mimetypes
+import re
+import time
+import uuid
+import zipfile
+
+# GLOBAL VARIABLES #####################################################################################################
+# The folder inside the EPUB that holds the package
+package_folder = "OEBPS"
+
+# The container file, points reading systems to the package document
+container_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+    <rootfiles>
+        <rootfile full-path="{}/content.opf" media-type="application/oebps-package+xml"/>
+    </rootfiles>
+</container>
+""".format(package_folder)
+
+# The package document, filled with the metadata, manifest items and spine items
+package_opf = """<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="{language}">
+    <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+        <dc:identifier id="book-id">{identifier}</dc:identifier>
+        <dc:title>{title}</dc:title>
+        <dc:language>{language}</dc:language>
+        <meta property="dcterms:modified">{modified}</meta>
+    </metadata>
+    <manifest>
+        <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+        <item id="styles" href="styles.css" media-type="text/css"/>
+{items}
+    </manifest>
+    <spine>
+{itemrefs}
+    </spine>
+</package>
+"""
+
+# The navigation document, filled with the table of contents
+nav_xhtml = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="{language}" \
+lang="{language}">
+<head>
+<meta charset="utf-8"/>
+<title>{title}</title>
+</head>
+<body>
+<nav epub:type="toc" role="doc-toc" id="toc">
+<h1>{title}</h1>
+<ol>
+{entries}
+</ol>
+</nav>
+</body>
+</html>
+"""
+
+# Finds the title of a cleaned part
+title_pattern = re.compile(rb"<title>(.*?)</title>", re.DOTALL)
+
+
+# MAIN CLASS ###########################################################################################################
+class EpubWriter:
+    """
+    Class to write the cleaned parts of a book into an EPUB file as they are cleaned.
+
+    Can be used as a context manager, the EPUB is finished when the block ends without an error.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self, file_book, epub_path, stylesheet=None):
+        """
+        The init function. Creates the EPUB and writes the files that come before the parts.
+
+        :param Book file_book: The book details object, used for the metadata and the reading order
+        :param str epub_path: The path of the EPUB file to create
+        :param str|None stylesheet: The path of a css file to add as styles.css. An empty one is added if None
+        """
+        self.book = file_book
+        self.epub_path: str = epub_path
+
+        self.parts: list = []  # (file name, title) of every added part, in the order they were added
+        self.assets: list = []  # (file name, media type) of every added image
+
+        self.epub = zipfile.ZipFile(epub_path, "w", zipfile.ZIP_DEFLATED)
+
+        # MIMETYPE MUST BE FIRST AND NOT COMPRESSED
+        self.epub.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        self.epub.writestr("META-INF/container.xml", container_xml)
+
+        if stylesheet:
+            self.epub.write(stylesheet, package_folder + "/styles.css")
+        else:
+            self.epub.writestr(package_folder + "/styles.css", "")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:  # Don't finish a broken EPUB
+            self.epub.close()
+
+    # WRITING METHODS ##################################################################################################
+    def add_part(self, file_name, xhtml):
+        """
+        Writes a cleaned part into the EPUB.
+
+        :param str file_name: The file name of the part, without a folder
+        :param bytes xhtml: The xhtml of the part
+
+        :return: Void
+        """
+        self.epub.writestr(package_folder + "/text/" + file_name, xhtml)
+        self.parts.append((file_name, self.get_title(xhtml)))
+
+    def add_asset(self, file_name, data):
+        """
+        Writes an image used by the parts into the EPUB, next to the parts so their links stay the same.
+
+        :param str file_name: The file name of the image, inside its folder, e.g. images/{name}.png
+        :param bytes data: The image
+
+        :return: Void
+        """
+        self.epub.writestr(package_folder + "/text/" + file_name, data)
+        self.assets.append((file_name, mimetypes.guess_type(file_name)[0] or "application/octet-stream"))
+
+    def close(self):
+        """
+        Writes the package and navigation documents then closes the EPUB.
+
+        :return: Void
+        """
+        parts = self.get_reading_order()
+        language = escape(self.book.language)
+
+        # NAVIGATION DOCUMENT
+        entries = "\n".join('<li><a href="text/{}">{}</a></li>'.format(escape(file_name), escape(title))
+                            for file_name, title in parts)
+        self.epub.writestr(package_folder + "/nav.xhtml",
+                           nav_xhtml.format(language=language, title=escape(self.book.title), entries=entries))
+
+        # PACKAGE DOCUMENT
+        items = "\n".join('        <item id="part-{}" href="text/{}" media-type="application/xhtml+xml"/>'
+                          .format(count, escape(file_name)) for count, (file_name, title) in enumerate(parts))
+        items += "".join('\n        <item id="asset-{}" href="text/{}" media-type="{}"/>'
+                         .format(count, escape(file_name), media_type)
+                         for count, (file_name, media_type) in enumerate(self.assets))
+        itemrefs = "\n".join('        <itemref idref="part-{}"/>'.format(count) for count in range(len(parts)))
+
+        self.epub.writestr(package_folder + "/content.opf", package_opf.format(
+            identifier="urn:uuid:" + str(uuid.uuid5(uuid.NAMESPACE_URL, self.book.title)),
+            title=escape(self.book.title), language=language,
+            modified=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            items=items, itemrefs=itemrefs))
+
+        self.epub.close()
+
+    # HELPER METHODS ###################################################################################################
+    def get_title(self, xhtml):
+        """
+        Gets the title of a part for the table of contents, from its <title> without the book title.
+
+        :param bytes xhtml: The xhtml of the part
+
+        :return: str
+        """
+        title_match = title_pattern.search(xhtml)
+        if not title_match:
+            return self.book.title
+
+        title = unescape(title_match.group(1).decode("utf-8"))  # The title is still escaped from the xhtml
+
+        return title.removeprefix(self.book.title + " | ")  # LibreOffice parts have the book title first
+
+    def get_reading_order(self):
+        """
+        Gets the parts in reading order. Additional files marked as front come before everything else.
+
+        :return: list - The (file name, title) of each part
+        """
+        front_names = {part["final_name"] + ".xhtml" for part in self.book.additional_paths.values()
+                       if part.get("front")}
+
+        return ([part for part in self.parts if part[0] in front_names]
+                + [part for part in self.parts if part[0] not in front_names])
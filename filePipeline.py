@@ -0,0 +1,194 @@
+"""
+Cleans LibreOffice files in a pipeline that keeps reading, cleaning and writing going at the same time.
+
+The files of a LibreOffice book are otherwise read, cleaned and written one after the other, so the cleaning waits on
+every read and write. On slow or network storage that wait adds up. The pipeline has three stages joined by bounded
+queues:
+    * read - The next files are read ahead, up to the prefetch limit
+    * clean - Each read file is parsed, cleaned and encoded, in this thread or in the worker processes
+    * write - The encoded xhtml is written in the background while the next files are cleaned
+
+The queues are bounded so a fast stage can only get the prefetch limit ahead of a slow one, and memory stays bounded.
+With a memory guard the worker processes clean one file at a time while they are over the memory limit, see memoryGuard.
+Files are written and reported in the same order as they are given.
+"""
+
+# IMPORTS ##############################################################################################################
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import htmlManager
+import memoryGuard
+
+# GLOBAL VARIABLES #####################################################################################################
+# Threads for the file reads and writes. Reads and writes release the GIL so they run alongside the cleaning
+io_workers = 2
+
+
+# PIPELINE #############################################################################################################
+def save_libreOffice_parts(parts, file_book, saved=None, prefetch=4, executor=None, guard=None):
+    """
+    Cleans and saves a list of LibreOffice html files through the pipeline.
+
+    :param list parts: The (path, chapter number or additional file name) tuples to clean
+    :param Book file_book: The book details object
+    :param function|None saved: Called as saved(part path, saved file name) as each file is saved, in order
+    :param int prefetch: How many files can be read ahead of the cleaning and cleaned ahead of the writing
+    :param Executor|None executor: The pool to clean the files in. None cleans them in this thread.
+    :param MemoryGuard|None guard: How many files the pool can clean at once. None only uses the prefetch limit
+
+    :return: list - The names of the saved files, in the same order as the parts
+    """
+    return asyncio.run(run_pipeline(parts, file_book, saved, max(prefetch, 1), executor, guard))
+
+
+async def run_pipeline(parts, file_book, saved, prefetch, executor, guard=None):
+    """
+    Runs the read, clean and write stages until every part is saved. If a stage fails the others are stopped.
+
+    :param list parts: The (path, chapter number or additional file name) tuples to clean
+    :param Book file_book: The book details object
+    :param function|None saved: Called as saved(part path, saved file name) as each file is saved
+    :param int prefetch: The size of the queues between the stages
+    :param Executor|None executor: The pool to clean the files in. None cleans them in this thread.
+    :param MemoryGuard|None guard: How many files the pool can clean at once. None only uses the prefetch limit
+
+    :return: list - The names of the saved files
+    """
+    read_queue = asyncio.Queue(maxsize=prefetch)  # (path, count, markup) of the read files
+    write_queue = asyncio.Queue(maxsize=prefetch)  # (path, count, future of the xhtml) of the files being cleaned
+    saved_files = []
+
+    io_executor = ThreadPoolExecutor(max_workers=io_workers)
+
+    stages = [asyncio.create_task(read_parts(parts, read_queue, io_executor)),
+              asyncio.create_task(clean_parts(read_queue, write_queue, file_book, executor, guard)),
+              asyncio.create_task(write_parts(write_queue, file_book, saved, saved_files, io_executor))]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:  # Stop the other stages if one failed
+            stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+
+        io_executor.shutdown()
+
+    return saved_files
+
+
+async def read_parts(parts, read_queue, io_executor):
+    """
+    The read stage. Reads each file and queues its markup, waiting while the queue is full.
+
+    :param list parts: The (path, chapter number or additional file name) tuples to read
+    :param asyncio.Queue read_queue: The queue to the clean stage, ended with None
+    :param Executor io_executor: The threads to read in
+
+    :return: Void
+    """
+    loop = asyncio.get_running_loop()
+    for part_path, count in parts:
+        markup = await loop.run_in_executor(io_executor, htmlManager.read_html, part_path)
+        await read_queue.put((part_path, count, markup))
+
+    await read_queue.put(None)
+
+
+async def clean_parts(read_queue, write_queue, file_book, clean_executor, guard=None):
+    """
+    The clean stage. Sends each read file to the executor and queues the future of its xhtml for the write stage.
+
+    The futures are queued in order without waiting for them, so with worker processes many files are cleaned at once,
+    as many as the write queue holds and the guard allows. Without worker processes the files are cleaned in this
+    thread, which holds up the event loop but not the reads and writes already running in their threads.
+
+    :param asyncio.Queue read_queue: The queue from the read stage
+    :param asyncio.Queue write_queue: The queue to the write stage, ended with None
+    :param Book file_book: The book details object
+    :param Executor|None clean_executor: The pool to clean in. None cleans in this thread
+    :param MemoryGuard|None guard: How many files the pool can clean at once
+
+    :return: Void
+    """
+    loop = asyncio.get_running_loop()
+    running = deque()  # The futures of the files sent to the pool, oldest first
+    while (item := await read_queue.get()) is not None:
+        part_path, count, markup = item
+        if clean_executor is None:
+            xhtml = loop.create_future()
+            xhtml.set_result(encode_libreOffice_markup(markup, file_book, count))
+        elif guard is None:
+            xhtml = loop.run_in_executor(clean_executor, encode_libreOffice_markup, markup, file_book, count)
+        else:
+            while running and (running[0].done() or len(running) >= guard.get_window()):
+                await asyncio.wait([running.popleft()])
+            xhtml = asyncio.ensure_future(clean_in_worker(clean_executor, guard, markup, file_book, count))
+            running.append(xhtml)
+        await write_queue.put((part_path, count, xhtml))
+
+    await write_queue.put(None)
+
+
+async def write_parts(write_queue, file_book, saved, saved_files, io_executor):
+    """
+    The write stage. Waits for the xhtml of each file in order and writes it.
+
+    :param asyncio.Queue write_queue: The queue from the clean stage
+    :param Book file_book: The book details object
+    :param function|None saved: Called as saved(part path, saved file name) as each file is saved
+    :param list saved_files: Filled with the names of the saved files
+    :param Executor io_executor: The threads to write in
+
+    :return: Void
+    """
+    loop = asyncio.get_running_loop()
+    while (item := await write_queue.get()) is not None:
+        part_path, count, xhtml = item
+
+        final_name = htmlManager.libreOffice_final_name(file_book, count)
+        await loop.run_in_executor(io_executor, htmlManager.write_bytes, await xhtml, final_name, file_book.atomic)
+
+        saved_files.append(final_name)
+        if saved is not None:
+            saved(part_path, final_name)
+
+
+# HELPER FUNCTIONS #####################################################################################################
+async def clean_in_worker(clean_executor, guard, markup, file_book, count):
+    """
+    Cleans the html of a LibreOffice file in a worker process and records the memory of the worker.
+
+    :param Executor clean_executor: The pool to clean in
+    :param MemoryGuard guard: The guard of the pool
+    :param str markup: The html of the file
+    :param Book file_book: The book details object
+    :param int|str count: The chapter number or the name of the additional file
+
+    :return: bytes - The xhtml of the file
+    """
+    loop = asyncio.get_running_loop()
+    xhtml, process_id, memory = await loop.run_in_executor(clean_executor, memoryGuard.measure_call,
+                                                           encode_libreOffice_markup, markup, file_book, count)
+    guard.record(process_id, memory)
+
+    return xhtml
+
+
+def encode_libreOffice_markup(markup, file_book, count):
+    """
+    Cleans the html of a LibreOffice file and encodes it. Only uses the provided arguments so it can be sent to a
+    worker process.
+
+    :param str markup: The html of the file
+    :param Book file_book: The book details object
+    :param int|str count: The chapter number or the name of the additional file
+
+    :return: bytes - The xhtml of the file
+    """
+    file_soup = htmlManager.parse_libreOffice_markup(markup, file_book)
+    soup = htmlManager.build_libreOffice(file_soup, file_book, count)
+    xhtml = htmlManager.soup_to_bytes(soup, file_book.formatter)
+    soup.decompose()  # Release the finished part
+
+    return xhtml
@@ -0,0 +1,97 @@
+"""
+Watches a folder for html files that are added or changed, for the --watch option.
+
+The folder is polled, so nothing outside the standard library is needed and it works the same on every platform and on
+network storage. A file is only reported once it has settled, when its size and modified time are the same on two polls
+in a row, so a file that is still being exported is not cleaned half written.
+"""
+
+# IMPORTS ##############################################################################################################
+import os
+import time
+
+# GLOBAL VARIABLES #####################################################################################################
+# The seconds between polls. A change is reported within two polls of the file settling
+poll_interval = 0.25
+
+
+# MAIN CLASS ###########################################################################################################
+class FolderWatcher:
+    """
+    Class to find the files of a folder that changed since the last poll.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self, folder, extension=".html"):
+        """
+        The init function. Records the files of the folder as they are now, only later changes are reported.
+
+        :param str folder: The folder to watch
+        :param str extension: Only files ending with this are watched
+        """
+        self.folder: str = folder
+        self.extension: str = extension
+
+        self.files: dict = self.scan()  # Path to (modified time, size) of each reported file
+        self.pending: dict = {}  # Path to (modified time, size) of each changed file that has not settled
+
+    # WATCH METHODS ####################################################################################################
+    def scan(self):
+        """
+        Gets the modified time and size of every watched file in the folder.
+
+        :return: dict - Path to (modified time in ns, size)
+        """
+        files = {}
+        try:
+            entries = os.scandir(self.folder)
+        except FileNotFoundError:  # The folder can be removed and created again by an export
+            return files
+
+        with entries:
+            for entry in entries:
+                if entry.name.endswith(self.extension) and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+        return files
+
+    def poll(self):
+        """
+        Finds the files added or changed since the last poll that have now settled. Removed files are forgotten.
+
+        :return: list - The paths of the settled files, sorted
+        """
+        current = self.scan()
+
+        changed = []
+        for path, stat in current.items():
+            if self.files.get(path) == stat:  # Unchanged, or changed back
+                self.pending.pop(path, None)
+            elif self.pending.get(path) == stat:  # The same as the last poll - SETTLED
+                del self.pending[path]
+                self.files[path] = stat
+                changed.append(path)
+            else:  # Still being written
+                self.pending[path] = stat
+
+        for path in set(self.files).difference(current):
+            del self.files[path]
+        for path in set(self.pending).difference(current):
+            del self.pending[path]
+
+        return sorted(changed)
+
+    def watch(self, interval=poll_interval):
+        """
+        Polls the folder until stopped, with KeyboardInterrupt or by closing the iterator.
+
+        :param float interval: The seconds between polls
+
+        :return: Iterator of lists of the changed paths, one list for each poll that found changes
+        """
+        while True:
+            time.sleep(interval)
+
+            changed = self.poll()
+            if changed:
+                yield changed
@@ -0,0 +1,191 @@
+"""
+Keeps cleaned ao3 fragments on disk so the same fragment is not built twice, for the --fragment-cache option.
+
+Works by the same author repeat the same fragments: the byline, most of the tag list and boilerplate notes. Each
+fragment is stored under a hash of its source html, the book rules that change it and the version of the tool. When the
+same fragment is met again, in this run or a later one, the cleaned xhtml is spliced in from the cache.
+
+The cache is a folder of small files, one for each fragment. It is kept under a size limit by removing the least
+recently used fragments. A fragment is marked as used by touching its file, so the order survives between runs.
+"""
+
+# IMPORTS ##############################################################################################################
+from collections import OrderedDict
+import hashlib
+import os
+
+from buildManifest import get_tool_version
+
+# GLOBAL VARIABLES #####################################################################################################
+# The active cache, None when fragments are not cached
+active_cache = None
+
+# The default size limit of the cache folder
+default_max_bytes = 64 * 1024 * 1024
+
+
+# MAIN CLASS ###########################################################################################################
+class FragmentCache:
+    """
+    Class to store and look up cleaned fragments in a size bounded folder, least recently used first out.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self, folder, max_bytes=default_max_bytes):
+        """
+        The init function. Indexes the fragments already in the folder, oldest use first.
+
+        :param str folder: The folder of the cache, created if needed
+        :param int max_bytes: The size limit of the stored fragments
+        """
+        self.folder: str = folder
+        self.max_bytes: int = max_bytes
+        self.version: str = get_tool_version()  # Fragments from other versions of the tool are never found
+
+        self.entries: OrderedDict = OrderedDict()  # Key to fragment size, least recently used first
+        self.size: int = 0  # Total size of the stored fragments
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+        os.makedirs(folder, exist_ok=True)
+
+        fragments = []
+        for shard in os.scandir(folder):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".xhtml"):
+                        stat = entry.stat()
+                        fragments.append((stat.st_mtime_ns, entry.name[:-len(".xhtml")], stat.st_size))
+
+        for used, key, size in sorted(fragments):
+            self.entries[key] = size
+            self.size += size
+
+        self.evict()
+
+    # CACHE METHODS ####################################################################################################
+    def get_key(self, *parts):
+        """
+        Gets the key of a fragment from everything its cleaned xhtml depends on.
+
+        :param str parts: The source html of the fragment, its kind and the rules that change it
+
+        :return: str - The hex digest
+        """
+        key_hash = hashlib.sha256(self.version.encode())
+        for part in parts:
+            key_hash.update(b"\0" + str(part).encode())
+
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        """
+        Gets a stored fragment and marks it as the most recently used. Counts a hit or a miss.
+
+        :param str key: The key of the fragment, see get_key
+
+        :return: str|None - The cleaned xhtml, None if it is not stored
+        """
+        if key in self.entries:
+            path = self.get_path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    fragment = file.read()
+                os.utime(path)
+            except FileNotFoundError:  # Removed by another run sharing the folder
+                self.size -= self.entries.pop(key)
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+        self.misses += 1
+        return None
+
+    def put(self, key, fragment):
+        """
+        Stores a fragment, then removes the least recently used fragments while the cache is over its limit.
+
+        :param str key: The key of the fragment, see get_key
+        :param str fragment: The cleaned xhtml
+
+        :return: Void
+        """
+        data = fragment.encode("utf-8")
+        path = self.get_path(key)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)  # Another run never reads a half written fragment
+
+        self.size += len(data) - self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used fragments until the cache is within its limit.
+
+        :return: Void
+        """
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+
+    # HELPER METHODS ###################################################################################################
+    def get_path(self, key):
+        """
+        Gets the file of a fragment. Fragments are split into folders by the start of their key.
+
+        :param str key: The key of the fragment
+
+        :return: str - The file path
+        """
+        return os.path.join(self.folder, key[:2], key + ".xhtml")
+
+    def get_stats(self):
+        """
+        Gets the counters of the cache.
+
+        :return: dict - The hits, misses, evictions, stored fragments and their size in bytes
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "fragments": len(self.entries), "bytes": self.size}
+
+
+# CACHE CONTROL ########################################################################################################
+def start_cache(folder, max_bytes=default_max_bytes):
+    """
+    Starts caching fragments in a folder.
+
+    :param str folder: The folder of the cache
+    :param int max_bytes: The size limit of the stored fragments
+
+    :return: FragmentCache - The active cache
+    """
+    global active_cache
+    active_cache = FragmentCache(folder, max_bytes)
+
+    return active_cache
+
+
+def stop_cache():
+    """
+    Stops caching fragments.
+
+    :return: FragmentCache|None - The cache that was active
+    """
+    global active_cache
+    cache = active_cache
+    active_cache = None
+
+    return cache
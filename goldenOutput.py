@@ -0,0 +1,359 @@
+"""
+Checks the cleaned xhtml of a fixture corpus against stored golden files, so a change to the cleaning that must not
+change the output can be proven not to.
+
+The corpus is kept in the golden folder:
+    * golden/format - The format files of the fixtures
+    * golden/source - Their source html, the paths in the formats are relative to the golden folder
+    * golden/expected - The expected output of each format, one {part name}.golden file for each part
+
+The fixtures cover a LibreOffice book with section breaks, style rules and every kind of junk tag, multi-chapter and
+oneshot ao3 works with and without no-links, and a series of them. Every fixture is cleaned in each way that must give
+the same files, with every installed parser:
+    * clean - bookCleaner.clean_book in memory, through the build_* functions
+    * save - bookCleaner.save_book, saved through clean_libreOffice_file and soup_to_file like a normal run
+    * stream - ao3 works read one chapter at a time, see htmlManager.build_ao3_stream
+    * prepass - LibreOffice files with the junk removed before they are parsed, see markupPrepass
+    * fragments - ao3 works cleaned twice through the same fragment cache, the second run splices the cached fragments
+    * html - Saved with the html formatter, named entities instead of characters
+    * resume - Saved by a resumable run with a journal, one part at a time, see runJournal
+
+The xhtml is canonicalized before it is compared: one tag, text or comment on each line, attributes sorted, runs of
+whitespace made one space and whitespace between tags dropped. Entities are read, so the minimal and html formatters
+give the same canonical text. A non-breaking space is written as &#160; so it stays visible, and a space at the end of
+a line as &#32; so an editor can't strip it from a golden file.
+
+The runs are spread over worker processes. Formats are loaded through book.load_book, which keeps each parsed format
+for the next run in the same worker.
+
+Run with:
+    python3 goldenOutput.py
+    python3 goldenOutput.py ao3-oneshot lo-sections --jobs 4
+    python3 goldenOutput.py --update
+"""
+
+# IMPORTS ##############################################################################################################
+import argparse  # Command line arguments
+from concurrent.futures import ProcessPoolExecutor  # Runs across worker processes
+import difflib
+import hashlib
+import html
+from html.parser import HTMLParser
+import os
+import re
+import tempfile
+import time
+
+from bs4.builder import builder_registry
+
+import bookCleaner
+import fragmentCache
+import htmlManager
+from book import FileType, load_book
+from runJournal import RunJournal
+
+# GLOBAL VARIABLES #####################################################################################################
+# The folder of the corpus, the fixtures are cleaned from inside it
+golden_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+# The ways each file type is cleaned, every one must give the golden files
+file_type_modes = {
+    FileType.LIBREOFFICE: ("clean", "save", "prepass", "html", "resume"),
+    FileType.AO3: ("clean", "save", "stream", "fragments", "html", "resume"),
+    FileType.SERIES: ("clean", "save", "html"),
+}
+
+# The mode and parser that record the golden files with --update, the first installed parser is used
+record_mode = "clean"
+
+# Whitespace that is collapsed, not \s which also matches the non-breaking space
+whitespace_pattern = re.compile(r"[ \t\n\r\f]+")
+
+
+# CANONICAL XHTML ######################################################################################################
+class Canonicalizer(HTMLParser):
+    """
+    Class to write xhtml as canonical text, one node on each line. See canonicalize.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self):
+        """
+        The init function.
+        """
+        super().__init__(convert_charrefs=True)
+        self.lines: list = []
+
+    # PARSER METHODS ###################################################################################################
+    def handle_starttag(self, tag, attrs):
+        self.lines.append("<" + tag + "".join(" {}=\"{}\"".format(name, escape_text(value or ""))
+                                              for name, value in sorted(attrs)) + ">")
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)  # <br/> and <br> are the same tag
+
+    def handle_endtag(self, tag):
+        self.lines.append("</" + tag + ">")
+
+    def handle_data(self, data):
+        text = whitespace_pattern.sub(" ", data)
+        if text.strip(" "):
+            text = escape_text(text)
+            self.lines.append(text[:-1] + "&#32;" if text.endswith(" ") else text)
+
+    def handle_comment(self, data):
+        self.lines.append("<!--" + whitespace_pattern.sub(" ", data) + "-->")
+
+    def handle_decl(self, decl):
+        self.lines.append("<!" + whitespace_pattern.sub(" ", decl) + ">")
+
+
+def canonicalize(data):
+    """
+    Gets the canonical text of a cleaned part. Images and other files that are not xhtml are given by their hash.
+
+    :param bytes data: The saved file
+
+    :return: str
+    """
+    try:
+        markup = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return "sha256 " + hashlib.sha256(data).hexdigest() + "\n"
+
+    canonicalizer = Canonicalizer()
+    canonicalizer.feed(markup)
+    canonicalizer.close()
+
+    return "\n".join(canonicalizer.lines) + "\n"
+
+
+def escape_text(text):
+    """
+    Escapes text for the canonical form, writing non-breaking spaces as a character reference.
+
+    :param str text: The text
+
+    :return: str
+    """
+    return html.escape(text).replace("\xa0", "&#160;")
+
+
+# FIXTURE RUNS #########################################################################################################
+def find_fixtures(names=None):
+    """
+    Finds the format files of the fixtures.
+
+    :param list|None names: The formats to use, None for all of them
+
+    :return: list - The format names, sorted
+    """
+    all_names = sorted(file_name[:-len(".json")] for file_name in os.listdir(os.path.join(golden_folder, "format"))
+                       if file_name.endswith(".json"))
+    if not names:
+        return all_names
+
+    for name in names:
+        if name not in all_names:
+            raise ValueError("No fixture format named " + name)
+
+    return names
+
+
+def find_parsers():
+    """
+    Gets the installed parser engines.
+
+    :return: list - The parser names, in the order of htmlManager.parser_engines
+    """
+    return [parser for parser in htmlManager.parser_engines if builder_registry.lookup(parser)]
+
+
+def run_fixture(format_name, mode, parser):
+    """
+    Cleans a fixture one way and canonicalizes its parts. Only uses the provided arguments so it can be sent to a worker
+    process, the working folder must be the golden folder.
+
+    :param str format_name: The name of the fixture format
+    :param str mode: How to clean it, see file_type_modes
+    :param str parser: The parser engine
+
+    :return: dict - The part name to its canonical text, in the order the parts were given
+    """
+    file_book = load_book(os.path.join("format", format_name + ".json"))
+    file_book.parser = parser
+    file_book.prepass = mode == "prepass"
+    if mode == "html":
+        file_book.formatter = "html"
+    stream = mode == "stream"
+
+    if mode == "save" or mode == "resume":
+        with tempfile.TemporaryDirectory() as output_folder:
+            file_book.output_folder = output_folder
+            if mode == "save":
+                saved_files = bookCleaner.save_book(file_book)
+            else:
+                with RunJournal(format_name, os.path.join("format", format_name + ".json"), parser, output_folder,
+                                file_book.formatter, file_book.prepass) as journal:
+                    saved_files = bookCleaner.save_book(file_book, journal=journal)
+
+            parts = {}
+            for final_name in saved_files:
+                with open(final_name, "rb") as file:
+                    parts[final_name[len(output_folder) + 1:]] = canonicalize(file.read())
+            return parts
+
+    if mode == "fragments":
+        with tempfile.TemporaryDirectory() as cache_folder:
+            fragmentCache.start_cache(cache_folder)
+            try:
+                for part in bookCleaner.clean_book(file_book.copy()):  # FILL THE CACHE
+                    pass
+                parts = bookCleaner.clean_book(file_book)
+                return {part_name: canonicalize(data) for part_name, data in parts}
+            finally:
+                fragmentCache.stop_cache()
+
+    return {part_name: canonicalize(data) for part_name, data in bookCleaner.clean_book(file_book, stream=stream)}
+
+
+# GOLDEN FILES #########################################################################################################
+def read_goldens(format_name):
+    """
+    Reads the golden files of a fixture.
+
+    :param str format_name: The name of the fixture format
+
+    :return: dict - The part name to its canonical text, empty if there are none
+    """
+    expected_folder = os.path.join(golden_folder, "expected", format_name)
+    goldens = {}
+    for folder, sub_folders, file_names in os.walk(expected_folder):
+        for file_name in file_names:
+            if file_name.endswith(".golden"):
+                path = os.path.join(folder, file_name)
+                part_name = os.path.relpath(path, expected_folder)[:-len(".golden")].replace(os.sep, "/")
+                with open(path, "r", encoding="utf-8") as file:
+                    goldens[part_name] = file.read()
+
+    return goldens
+
+
+def write_goldens(format_name, parts):
+    """
+    Replaces the golden files of a fixture.
+
+    :param str format_name: The name of the fixture format
+    :param dict parts: The part name to its canonical text
+
+    :return: Void
+    """
+    expected_folder = os.path.join(golden_folder, "expected", format_name)
+    for part_name in read_goldens(format_name):
+        if part_name not in parts:  # A part that is no longer made
+            os.remove(os.path.join(expected_folder, part_name + ".golden"))
+
+    for part_name, text in parts.items():
+        path = os.path.join(expected_folder, part_name + ".golden")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8", newline="\n") as file:
+            file.write(text)
+
+
+def compare_parts(goldens, parts, diff_lines):
+    """
+    Compares the parts of a run with the golden files.
+
+    :param dict goldens: The part name to its golden canonical text
+    :param dict parts: The part name to the canonical text of the run
+    :param int diff_lines: The most lines of each diff to give
+
+    :return: list - A problem for each part that is missing, extra or changed, empty if the parts are the same
+    """
+    problems = []
+    for part_name in goldens.keys() - parts.keys():
+        problems.append("missing " + part_name)
+    for part_name in parts.keys() - goldens.keys():
+        problems.append("not in the goldens " + part_name)
+
+    for part_name in goldens.keys() & parts.keys():
+        if goldens[part_name] != parts[part_name]:
+            diff = list(difflib.unified_diff(goldens[part_name].splitlines(), parts[part_name].splitlines(),
+                                             part_name + ".golden", part_name, lineterm=""))
+            if len(diff) > diff_lines:
+                diff = diff[:diff_lines] + ["... {} more lines".format(len(diff) - diff_lines)]
+            problems.append("changed " + part_name + "\n" + "\n".join(diff))
+
+    return sorted(problems)
+
+
+# CMD LINE #############################################################################################################
+########################################################################################################################
+
+def main():
+    """
+    Runs every fixture in every mode and compares them with the golden files.
+
+    :return: Void
+    """
+    cmd_parser = argparse.ArgumentParser()
+    cmd_parser.add_argument("format", nargs="*", help="The fixture formats to check. Defaults to all of them.")
+    cmd_parser.add_argument("--update", action="store_true",
+                            help="Record the golden files again from the clean mode, then check the other modes "
+                                 "against them.")
+    cmd_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                            help="The number of worker processes. Defaults to the CPU count.")
+    cmd_parser.add_argument("--diff-lines", type=int, default=40, help="The most lines of each diff to print.")
+    cmd_args = cmd_parser.parse_args()
+
+    start = time.perf_counter()
+    os.chdir(golden_folder)  # The source paths of the fixtures are relative to it
+
+    format_names = find_fixtures(cmd_args.format)
+    parsers = find_parsers()
+
+    runs = []
+    for format_name in format_names:
+        for mode in file_type_modes[load_book(os.path.join("format", format_name + ".json")).type]:
+            runs.extend((format_name, mode, parser) for parser in parsers)
+
+    executor = ProcessPoolExecutor(max_workers=cmd_args.jobs) if cmd_args.jobs > 1 else None
+    try:
+        run_arguments = list(zip(*runs))
+        if executor is None:
+            results = list(map(run_fixture, *run_arguments))
+        else:
+            results = list(executor.map(run_fixture, *run_arguments))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # RECORD - FROM THE FIRST PARSER IN THE RECORD MODE
+    if cmd_args.update:
+        for format_name in format_names:
+            write_goldens(format_name, results[runs.index((format_name, record_mode, parsers[0]))])
+            print("RECORDED: " + format_name)
+
+    # CHECK
+    goldens = {format_name: read_goldens(format_name) for format_name in format_names}
+    failed = 0
+    for (format_name, mode, parser), parts in zip(runs, results):
+        if not goldens[format_name]:
+            problems = ["no golden files, record them with --update"]
+        else:
+            problems = compare_parts(goldens[format_name], parts, cmd_args.diff_lines)
+
+        if problems:
+            failed += 1
+            print("FAILED: {} {} {}".format(format_name, mode, parser))
+            for problem in problems:
+                print("\t" + problem.replace("\n", "\n\t"))
+
+    print("{} runs of {} fixtures, {} passed, {} failed in {:.2f}s".format(
+        len(runs), len(format_names), len(runs) - failed, failed, time.perf_counter() - start))
+
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
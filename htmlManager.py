@@ -6,10 +6,19 @@ Functions to clean the html and save the soup to file.
 """
 
 # IMPORTS ##############################################################################################################
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import BeautifulSoup, NavigableString, Tag
 from bs4 import Comment
+from bs4.builder import builder_registry
 
-from book import Book
+import copy
+import functools
+import os
+
+import ao3Splitter
+import fragmentCache
+import markupPrepass
+import stageTimings
+from styleRules import RuleTable
 # GLOBAL VARIABLES #####################################################################################################
 # Namespace dictionary, Manages all namespaces for consistency
 namespace_dict = {
@@ -17,14 +26,88 @@ namespace_dict = {
     "xmlns:epub": "http://www.idpf.org/2007/ops"
 }
 
-# Global book value for the module - None when nothing is provided
-format_book: Book | None = None
+# Parser engines in the order "auto" picks them, C-backed first. html.parser is always installed
+parser_engines = ["lxml", "html.parser"]
+
+# Skeleton soups built by build_base_xhtml, one for each (epub:type, role). Copied by create_base_xhtml
+skeleton_templates = {}
+
+# The rule table used when no rules are given, only the junk is cleaned
+empty_rule_table = RuleTable()
+
+# An empty soup used to create new tags. The tags can be added to any soup
+tag_factory = BeautifulSoup("", "html.parser")
 
 
 # BOOK FORMAT LOGIC ####################################################################################################
 ########################################################################################################################
 
-def clean_libreOffice(file_soup, file_book, count):
+def clean_libreOffice_file(file_path, file_book, count, show_progress=True):
+    """
+    Builds the xhtml of a LibreOffice html file with build_libreOffice_file and saves it.
+
+    Only uses the provided arguments so it can be sent to a worker process.
+
+    :param str file_path: The path of the html file to clean
+    :param Book file_book: The book details object
+    :param int|str count: The chapter number or the name of the additional file
+    :param bool show_progress: Print the completed line once the file is saved
+
+    :return: str - The name of the saved file
+    """
+    soup = build_libreOffice_file(file_path, file_book, count)
+    file_name = soup_to_file(soup, libreOffice_final_name(file_book, count), show_progress, file_book.formatter,
+                             file_book.atomic)
+    soup.decompose()  # Release the finished part now, not at the next garbage collection
+
+    return file_name
+
+
+def build_libreOffice_file(file_path, file_book, count):
+    """
+    Opens and parses a LibreOffice html file then builds its xhtml with build_libreOffice.
+
+    :param str file_path: The path of the html file to clean
+    :param Book file_book: The book details object
+    :param int|str count: The chapter number or the name of the additional file
+
+    :return: BeautifulSoup
+    """
+    file_soup = parse_libreOffice_markup(read_html(file_path), file_book)
+
+    return build_libreOffice(file_soup, file_book, count)
+
+
+def parse_libreOffice_markup(markup, file_book):
+    """
+    Parses the html of a LibreOffice file. With the prepass option the junk is removed from the text first, the
+    cleaned file is the same.
+
+    :param str markup: The html of the file
+    :param Book file_book: The book details object
+
+    :return: BeautifulSoup
+    """
+    if file_book.prepass:
+        markup = markupPrepass.prepass_markup(markup, file_book.rule_table)
+
+    return parse_html(markup, get_parser(file_book.parser))
+
+
+def read_html(file_path):
+    """
+    Reads the html of a source file.
+
+    :param str file_path: The path of the html file
+
+    :return: str - The html
+    """
+    with open(file_path, "r") as file:
+        return file.read()
+
+
+@stageTimings.timed_stage("build")
+def build_libreOffice(file_soup, file_book, count):
     """
     The method to create valid xhtml from a provided soup generated from LibreOffice html
 
@@ -32,16 +115,12 @@ def clean_libreOffice(file_soup, file_book, count):
         * If int, chapter file
         * If str, additional file
 
-    :param BeautifulSoup file_soup: The soup generated from the html file
+    :param BeautifulSoup file_soup: The soup generated from the html file, its body is moved out and the rest released
     :param Book file_book: The book details object
     :param int|str count: The chapter number or the name of the additional file
 
-    :return: Void
+    :return: BeautifulSoup
     """
-    # SET GLOBAL BOOK
-    global format_book
-    format_book = file_book
-
     # INITIAL HTML SET UP ----------------------------------------------------------------------------------------------
     epub_roles = {"epub:type": "chapter", "role": "doc-chapter"}
 
@@ -55,64 +134,80 @@ def clean_libreOffice(file_soup, file_book, count):
     # MANAGE CONTENTS --------------------------------------------------------------------------------------------------
     soup.section.append(file_soup.body)
     soup.section.body.unwrap()  # Remove additional body tag
+    file_soup.decompose()  # Release the head, styles and metadata left in the source, the body has been moved
 
-    # MANAGE STYLING ---------------------------------------------------------------------------------------------------
-    # add dictionary styles
-    for tag_type in file_book.styles:
-        # configure tags to be searchable, change style class, clear all attributes.
-        for styled_tag in soup.find_all(tag_type):
-            styled_tag["class"] = file_book.styles[tag_type]
-
-    # ADD SECTION BREAKS
-    # MUST BE HR FOR ACCESSIBILITY - ANY IMAGES MUST BE DONE IN CSS AS BACKGROUND IMAGE
-    for linebreak in soup.find_all("p", string=file_book.rules["sectionbreak"]):
-        # Create hr tag
-        linebreak_tag = soup.new_tag("hr")
-        # add css file
-        linebreak_tag["class"] = "linebreak"
-
-        # replace placeholder symbol with new tag
-        linebreak.replace_with(linebreak_tag)
-
-    # REMOVE JUNK TO SIMPLIFY -------------------------------------------------------------------
-    # LibreOffice adds these tags for small things that don't always make sense. Especially with
+    # CLEAN CONTENTS ---------------------------------------------------------------------------------------------------
+    # Styles, section breaks, the final clean and <pre> comments are all applied in one walk through the soup.
+    # SECTION BREAKS MUST BE HR FOR ACCESSIBILITY - ANY IMAGES MUST BE DONE IN CSS AS BACKGROUND IMAGE
+    # LibreOffice adds junk tags for small things that don't always make sense. Especially with
     # cut and paste. Add manually after cleaning if specific effect needed.
-    final_clean(soup)
+    # <pre> tags are turned into comments - POV image adjustments
+    clean_tree(soup, file_book.rule_table, True)
+
+    return soup
 
-    # ADDITIONAL ADJUSTMENTS --------------------------------------------------------------------
-    # Add other things here - POV image adjustments
-    for tag in soup.find_all("pre"):
-        comment = Comment(tag.string)
 
-        tag.replace_with(comment)
+def libreOffice_part_name(file_book, count):
+    """
+    Gets the file name of a LibreOffice part, without the output folder.
+
+    :param Book file_book: The book details object
+    :param int|str count: The chapter number or the name of the additional file
 
+    :return: str
+    """
     if type(count) is str:
-        soup_to_file(soup, "final/" + file_book.additional_paths[count]["final_name"] + ".xhtml")
-    else:
-        soup_to_file(soup, "final/" + str(count) + "-chapter.xhtml")
+        return file_book.additional_paths[count]["final_name"] + ".xhtml"
 
+    return str(count) + "-chapter.xhtml"
 
-def clean_ao3(main_soup, file_book):
+
+def libreOffice_final_name(file_book, count):
     """
-    A function to clean a generated html file from Archive of Our Own (https://archiveofourown.org/)
+    Gets the name a LibreOffice file is saved under.
 
-    :param BeautifulSoup main_soup: The soup made from the generated html.
     :param Book file_book: The book details object
-    :return: Void
+    :param int|str count: The chapter number or the name of the additional file
+
+    :return: str
+    """
+    return file_book.output_folder + "/" + libreOffice_part_name(file_book, count)
+
+
+def ao3_part_name(part_count, part_type):
+    """
+    Gets the file name of an ao3 part, without the output folder.
+
+    :param int part_count: The number of the part
+    :param str part_type: The type of the part, preface, chapter or afterword
+
+    :return: str
+    """
+    return str(part_count) + "-" + part_type + ".xhtml"
+
+
+def build_ao3(main_soup, file_book):
     """
-    # SET GLOBAL BOOK
-    global format_book
-    format_book = file_book
+    Builds the parts of a generated html file from Archive of Our Own (https://archiveofourown.org/)
+
+    The source of each part is released from main_soup once the part is built, so the memory used falls as the parts
+    are given out. Each soup is released once the next part is asked for, it must not be kept.
 
+    :param BeautifulSoup main_soup: The soup made from the generated html.
+    :param Book file_book: The book details object
+    :return: Iterator of (file name, BeautifulSoup) tuples, one for each part
+    """
     # CREATE FILES -----------------------------------------------------------------------------------------------------
     part_count = 0  # counter for the chapter - used for naming files
 
     # CREATE FOREWORD/PREFACE
-    soup = build_preface(main_soup, "ao3")
+    soup = build_preface(main_soup, file_book, "ao3")
 
     final_clean(soup)
 
-    soup_to_file(soup, "final/" + str(part_count) + "-preface.xhtml")
+    yield ao3_part_name(part_count, "preface"), soup
+    soup.decompose()  # Release the finished preface
+    release_tag(main_soup.find("div", id="preface"))  # Release the rest of its source
     part_count += 1
 
     # CHAPTERS ---------------------------------------------------------------------------------------------------------
@@ -123,13 +218,15 @@ def clean_ao3(main_soup, file_book):
 
         final_clean(soup)
 
-        soup_to_file(soup, "final/" + str(part_count) + "-chapter.xhtml")
+        yield ao3_part_name(part_count, "chapter"), soup
+        soup.decompose()  # Release the finished chapter, with its text
         part_count += 1
     else:
         # IF NOT ONESHOT HAS MULTIPLE CHAPTERS
         chapter_contents = main_soup.find("div", id="chapters").find_all("div", class_="userstuff")  # Get Chapters
         # loop through all chapter contents
         for chapter_text in chapter_contents:
+            front_note = chapter_text.find_previous_sibling("div", class_="meta group")  # Found before the text moves
             soup = build_chapter(chapter_text, "ao3")
             # If there is no soup then build failed, skipped
             if not soup:
@@ -137,28 +234,123 @@ def clean_ao3(main_soup, file_book):
 
             final_clean(soup)
 
-            soup_to_file(soup, "final/" + str(part_count) + "-chapter.xhtml")
+            yield ao3_part_name(part_count, "chapter"), soup
+            soup.decompose()  # Release the finished chapter, with its text
             part_count += 1
 
+            # RELEASE THE NOTES OF THE CHAPTERS BEFORE THIS ONE. The notes of this chapter are kept, the next chapter
+            # looks back to them if it has no notes of its own
+            for processed in front_note.find_previous_siblings():
+                processed.decompose()
+
     # AFTERWORD --------------------------------------------------------------------------------------------------------
     afterword_search = main_soup.find("div", id="afterword").find("div", id="endnotes")  # Look for a valid afterword
     if afterword_search:  # If there is an afterword
         soup = build_afterword(afterword_search, "ao3")
         final_clean(soup)
 
-        soup_to_file(soup, "final/" + str(part_count) + "-afterword.xhtml")
+        yield ao3_part_name(part_count, "afterword"), soup
+        soup.decompose()  # Release the finished afterword
+
+
+def build_ao3_stream(file, file_book):
+    """
+    Builds the parts of a generated html file from Archive of Our Own while it is read, instead of from a soup of the
+    full work.
+
+    Builds the same parts as build_ao3. The file is split into its parts with ao3Splitter and each chapter is built from
+    a small soup of its front meta group, its text and the tag after it (end notes), so only one chapter is held in
+    memory at a time. Each soup is released once the next part is asked for, it must not be kept.
+
+    :param file file: The open html file
+    :param Book file_book: The book details object
+    :return: Iterator of (file name, BeautifulSoup) tuples, one for each part
+    """
+    for part_name, build_part in plan_ao3_stream(file, file_book):
+        soup = build_part()
+        if soup:  # The afterword can turn out to be empty
+            yield part_name, soup
+            soup.decompose()  # Release the finished part
+
+
+def plan_ao3_stream(file, file_book):
+    """
+    Splits a generated html file from Archive of Our Own into its parts while it is read, giving each part with the
+    function to build it, see build_ao3_stream.
 
+    Each build function only uses the html of its own part, so a part can be skipped without being parsed or built
+    again after it fails. A build function gives the cleaned soup, or None for an afterword without end notes.
+
+    :param file file: The open html file
+    :param Book file_book: The book details object
+    :return: Iterator of (file name, build function) tuples, one for each part
+    """
+    parser = get_parser(file_book.parser)
+
+    # CREATE FILES -----------------------------------------------------------------------------------------------------
+    part_count = 0  # counter for the chapter - used for naming files
+
+    previous_part = None  # html of the last part inside chapters - the oneshot title
+    front_note = None  # html of the last meta group - the chapter title and notes
+    waiting_chapter = None  # (front note, text) html of a chapter waiting on the part after it
+    oneshot_found = False
+
+    for part_type, tag_name, classes, html in ao3Splitter.split_ao3(file):
+        # FINISH THE WAITING CHAPTER - ANY PART AFTER IT IS ITS POSSIBLE END NOTE
+        if waiting_chapter:
+            if waiting_chapter[0]:  # Without a front note the build fails, skipped
+                yield ao3_part_name(part_count, "chapter"), functools.partial(
+                    build_stream_part, build_stream_chapter, waiting_chapter[0], waiting_chapter[1],
+                    html if part_type == "chapters" else None, parser)
+                part_count += 1
+            waiting_chapter = None
+
+        match part_type:
+            case "preface":
+                # CREATE FOREWORD/PREFACE
+                yield ao3_part_name(part_count, "preface"), functools.partial(build_stream_part, build_stream_preface,
+                                                                               html, file_book, parser)
+                part_count += 1
+            case "chapters":
+                is_text = tag_name == "div" and "userstuff" in classes
+
+                if file_book.rules["oneshot"]:
+                    # ONESHOT ONLY HAS ONE CHAPTER
+                    if is_text and not oneshot_found:
+                        oneshot_found = True
+                        yield ao3_part_name(part_count, "chapter"), functools.partial(
+                            build_stream_part, build_stream_oneshot, previous_part, html, parser)
+                        part_count += 1
+                    previous_part = html
+                else:
+                    # IF NOT ONESHOT HAS MULTIPLE CHAPTERS
+                    if tag_name == "div" and " ".join(classes) == "meta group":
+                        front_note = html
+                    if is_text:
+                        waiting_chapter = (front_note, html)
+            case "afterword":
+                # AFTERWORD
+                yield ao3_part_name(part_count, "afterword"), functools.partial(build_stream_part,
+                                                                                 build_stream_afterword, html, parser)
+
+    # LAST CHAPTER WITH NOTHING AFTER IT
+    if waiting_chapter and waiting_chapter[0]:
+        yield ao3_part_name(part_count, "chapter"), functools.partial(
+            build_stream_part, build_stream_chapter, waiting_chapter[0], waiting_chapter[1], None, parser)
 
 
 # FILE PART MANAGEMENT FUNCTIONS #######################################################################################
 ########################################################################################################################
 
 # Pulls a preface from a soup
-def build_preface(file_soup, format_type):
+
+@stageTimings.timed_stage("build")
+def build_preface(file_soup, file_book, format_type):
     """
     Builds a preface into a separate file from an ao3 soup.
 
     :param BeautifulSoup file_soup: The full ao3 soup. Needs to have access to full file.
+    :param Book file_book: The book details object, used for the link rules
     :param str format_type: NOT IMPLEMENTED
     :return: BeautifulSoup
     """
@@ -180,16 +372,18 @@ def build_preface(file_soup, format_type):
     soup.h1.string = file_soup.find("h1").string
 
     # AUTHOR
-    soup.find("p", class_="byline").string = "by "  # Start string
-    soup.find("p", class_="byline").append(
-        set_link(file_soup.find("div", class_="byline").a))  # Append author name to byline after checking links
+    byline = soup.find("p", class_="byline")
+    byline.string = "by "  # Start string
+    author_link = file_soup.find("div", class_="byline").a
+    splice_fragment(byline, ("byline", author_link, file_book.rules["no-links"]),  # Append author name to byline
+                    lambda: byline.append(set_link(author_link, file_book)))  # after checking links
 
     # WORK LINK
     work_link = file_soup.find("p", class_="message").find_all("a")
     soup.find("p", class_="link").string = "Posted originally on the "  # Start the link line
-    soup.find("p", class_="link").append(set_link(work_link[0]))  # Add first link - Archive of Our Own
+    soup.find("p", class_="link").append(set_link(work_link[0], file_book))  # Add first link - Archive of Our Own
     soup.find("p", class_="link").append(" at ")  # bridge links
-    soup.find("p", class_="link").append(set_link(work_link[1]))  # Add specific work link
+    soup.find("p", class_="link").append(set_link(work_link[1], file_book))  # Add specific work link
     soup.find("p", class_="link").append(".")  # end line
 
     # TAG LIST ---------------------------------------------------------------------------------------------------------
@@ -197,9 +391,8 @@ def build_preface(file_soup, format_type):
         if tag.name == "dt":  # If description element title
             soup.dl.append(tag)
         if tag.name == "dd":  # If description element description
-            for a in tag.find_all("a"):
-                a.replace_with(set_link(a))  # Check all links in dd
-            soup.dl.append(tag)
+            splice_fragment(soup.dl, ("dd", tag, file_book.rules["no-links"]),
+                            functools.partial(build_description, tag, soup.dl, file_book), tag)
 
     # SUMMARY AND NOTES ----------------------------------------------------------------------------------
     # SUMMARY, ALL WORKS HAVE ONE
@@ -218,6 +411,7 @@ def build_preface(file_soup, format_type):
     return soup
 
 
+@stageTimings.timed_stage("build")
 def build_oneshot(file_soup, format_type):
     """
     Builds an ao3 oneshot.
@@ -247,6 +441,7 @@ def build_oneshot(file_soup, format_type):
     return soup
 
 
+@stageTimings.timed_stage("build")
 def build_chapter(file_soup, format_type):
     """
     Builds an individual chapter and returns new Soup that with just the chapter.
@@ -299,6 +494,7 @@ def build_chapter(file_soup, format_type):
     return soup
 
 
+@stageTimings.timed_stage("build")
 def build_afterword(file_soup, format_type):
     """
     Builds the afterword into a separate file from an ao3 soup.
@@ -317,17 +513,178 @@ def build_afterword(file_soup, format_type):
     return soup
 
 
+def build_stream_part(build, *args):
+    """
+    Builds a part found by plan_ao3_stream and gives it its final clean.
+
+    :param function build: The build_stream_* function of the part
+    :param args: The html of the part and the other arguments of the build function
+    :return: BeautifulSoup | None
+    """
+    soup = build(*args)
+    if soup:
+        final_clean(soup)
+
+    return soup
+
+
+def build_stream_preface(preface, file_book, parser):
+    """
+    Builds the preface from its html found by plan_ao3_stream.
+
+    :param str preface: The html of the <div id="preface">
+    :param Book file_book: The book details object, used for the link rules
+    :param str parser: The parser to use
+    :return: BeautifulSoup
+    """
+    preface_soup = parse_html(preface, parser)
+    soup = build_preface(preface_soup, file_book, "ao3")
+    preface_soup.decompose()  # Release the preface source
+
+    return soup
+
+
+def build_stream_oneshot(title, chapter_text, parser):
+    """
+    Builds a oneshot from the html of its title and text found by plan_ao3_stream.
+
+    :param str|None title: The html of the part before the text, the oneshot title
+    :param str chapter_text: The html of the <div class="userstuff">
+    :param str parser: The parser to use
+    :return: BeautifulSoup
+    """
+    parts_soup, chapter_tags = parse_stream_parts([title, chapter_text], parser)
+    soup = build_oneshot(chapter_tags[-1], "ao3")
+    parts_soup.decompose()  # Release the title left behind
+
+    return soup
+
+
+def build_stream_afterword(afterword, parser):
+    """
+    Builds the afterword from its html found by plan_ao3_stream.
+
+    :param str afterword: The html of the <div id="afterword">
+    :param str parser: The parser to use
+    :return: BeautifulSoup | None - None if there are no end notes
+    """
+    afterword_soup = parse_html(afterword, parser)
+    afterword_search = afterword_soup.find("div", id="endnotes")  # Look for a valid afterword
+    soup = build_afterword(afterword_search, "ao3") if afterword_search else None
+    afterword_soup.decompose()  # Release the afterword source
+
+    return soup
+
+
+@stageTimings.timed_stage("build")
+def build_stream_chapter(front_note, chapter_text, end_note, parser):
+    """
+    Builds a chapter from the html of its parts found by plan_ao3_stream.
+
+    The parts are parsed together so build_chapter finds the notes as siblings of the text, as in the full soup.
+
+    :param str|None front_note: The html of the meta group before the chapter
+    :param str chapter_text: The html of the <div class="userstuff">
+    :param str|None end_note: The html of the tag after the chapter
+    :param str parser: The parser to use
+    :return: BeautifulSoup | None
+    """
+    parts_soup, chapter_tags = parse_stream_parts([front_note, chapter_text, end_note], parser)
+
+    soup = build_chapter(chapter_tags[1 if front_note else 0], "ao3")
+    parts_soup.decompose()  # Release the notes left behind
+
+    return soup
+
+
 # HELPER FUNCTIONS #####################################################################################################
 ########################################################################################################################
 
+def release_tag(tag):
+    """
+    Decomposes a tag of a source soup once it has been built, if it was found.
+
+    :param Tag|None tag: The tag to release
+    :return: Void
+    """
+    if tag is not None:
+        tag.decompose()
+
+
+def parse_stream_parts(parts, parser):
+    """
+    Parses the html of neighbouring ao3 parts into a single soup so they stay siblings.
+
+    :param list parts: The html of each part, None parts are skipped
+    :param str parser: The parser to use
+    :return: tuple - The soup and a list of the top level tag of each part
+    """
+    soup = parse_html("<div>" + "".join(part for part in parts if part) + "</div>", parser)
+
+    return soup, soup.div.find_all(recursive=False)
+
+
+@stageTimings.timed_stage("parse")
+def parse_html(markup, parser):
+    """
+    Parses html into a soup.
+
+    :param str|file markup: The html or an open html file
+    :param str parser: The name of the parser to give Beautiful Soup
+
+    :return: BeautifulSoup
+    """
+    return BeautifulSoup(markup, parser)
+
+
+def get_parser(engine="auto"):
+    """
+    Gets the Beautiful Soup parser to use for an engine, falling back to html.parser if it is not installed.
+
+    :param str engine: The name of the parser (e.g. "lxml"), or "auto" for the first installed of parser_engines
+
+    :return: str - The name of the parser to give Beautiful Soup
+    """
+    if engine == "auto":
+        for parser in parser_engines:
+            if builder_registry.lookup(parser):
+                return parser
+
+    if builder_registry.lookup(engine):
+        return engine
+
+    return "html.parser"  # FALLBACK - ALWAYS INSTALLED
+
+
 def create_base_xhtml(epub_roles, title):
     """
     Creates a basic xhtml file skeleton for content to be added into.
 
+    The skeleton is only built once for each set of epub roles, every document after that gets a copy of it.
+
     :param dict epub_roles: A dictionary that contains information about the documents accessibility properties.
         Dictionary requires both a 'epub:type' and a 'role' (aria-role).
     :param str title: The string to be placed in the <title> tag
 
+    :return: BeautifulSoup
+    """
+    template_key = (epub_roles["epub:type"], epub_roles["role"])
+    if template_key not in skeleton_templates:
+        skeleton_templates[template_key] = build_base_xhtml(epub_roles)
+
+    soup = copy.copy(skeleton_templates[template_key])  # A deep copy, nothing is shared with the template
+    soup.title.string = title
+
+    return soup  # Return prepared soup
+
+
+def build_base_xhtml(epub_roles):
+    """
+    Builds a basic xhtml file skeleton with an empty <title>. Used as the template for create_base_xhtml.
+
+    :param dict epub_roles: A dictionary that contains information about the documents accessibility properties.
+        Dictionary requires both a 'epub:type' and a 'role' (aria-role).
+
     :return: BeautifulSoup
     """
     # CREATE NEW XHTML FILE --------------------------------------------------------------------------------------------
@@ -344,7 +701,6 @@ def create_base_xhtml(epub_roles, title):
     soup.html.head.meta["charset"] = "utf-8"
 
     soup.html.head.append(soup.new_tag("title"))  # Create title tag, leave empty
-    soup.find("title").string = title
 
     soup.html.head.append(
         soup.new_tag("link", attrs={"rel": "stylesheet", "type": "text/css", "href": "../styles.css"}))
@@ -356,44 +712,96 @@ def create_base_xhtml(epub_roles, title):
     soup.body.section["epub:type"] = epub_roles["epub:type"]
     soup.body.section["role"] = epub_roles["role"]
 
-    return soup  # Return prepared soup
+    return soup
 
 
-def soup_to_file(soup, file_name):
+@stageTimings.timed_stage("serialize", "argument")
+def soup_to_bytes(soup, formatter="minimal"):
+    """
+    Serializes a soup to xhtml once, as it is saved to file.
+
+    :param BeautifulSoup soup: The soup to be encoded
+    :param str formatter: How text is escaped, see book.output_formatters
+
+    :return: bytes - The UTF-8 encoded xhtml
+    """
+    return soup.encode("utf-8", formatter=formatter)
+
+
+def soup_to_file(soup, file_name, show_progress=True, formatter="minimal", atomic=False):
     """
     Saves a soup to a .xhtml file
 
+    The soup is serialized once and the UTF-8 bytes written through a buffered binary file. An atomic save writes a
+    temporary file next to the final file and renames it over the final file, so a file is never left half written.
+
     :param BeautifulSoup soup: The soup to be saved to file
     :param str file_name: The file name to save the soup under. The .xhtml is added in function.
+    :param bool show_progress: Print the completed line once the file is saved
+    :param str formatter: How text is escaped, see book.output_formatters
+    :param bool atomic: Save through a temporary file and a rename
+
+    :return: str - The name of the saved file
+    """
+    write_bytes(soup_to_bytes(soup, formatter), file_name, atomic)
+    stageTimings.finish_document(file_name)
+
+    if show_progress:
+        print_progress(file_name)
+
+    return file_name
+
+
+@stageTimings.timed_stage("write", None)
+def write_bytes(xhtml, file_name, atomic=False):
+    """
+    Writes xhtml to a file.
+
+    :param bytes xhtml: The encoded xhtml
+    :param str file_name: The file name to save the xhtml under
+    :param bool atomic: Write a temporary file and rename it over the file
 
     :return: Void
     """
-    output = open(file_name, "w")
+    write_name = file_name + ".tmp" if atomic else file_name
+    try:
+        with open(write_name, "wb") as output:
+            output.write(xhtml)
 
-    # ENCODE TO HTML INCASE THERE IS AN ISSUE
-    soup.encode(formatter="html")
-    output.write(str(soup))
+        if atomic:
+            os.replace(write_name, file_name)
+    except BaseException:
+        if atomic and os.path.exists(write_name):  # Don't leave the temporary file behind
+            os.remove(write_name)
+        raise
 
-    output.close()
 
-    print("COMPLETED: " + file_name + "                      ", end='\r')  # Add whitespace to clear line
+def print_progress(file_name, status="COMPLETED"):
+    """
+    Prints the progress line for a file. Overwrites the previous line.
 
+    :param str file_name: The name of the file
+    :param str status: What happened to the file, COMPLETED when saved
 
-def set_link(tag):
+    :return: Void
+    """
+    print(status + ": " + file_name + "                      ", end='\r')  # Add whitespace to clear line
+
+
+def set_link(tag, file_book):
     """
     A helper function to manage the no_links option.
 
     When given a <a> tag, check the NO_LINKS rule and remove link if true
 
     :param BeautifulSoup tag: The <a> ref that is being inserted
+    :param Book file_book: The book details object with the no-links rule
     :return: BeautifulSoup
     """
-    if format_book.rules["no-links"]:
-        soup = BeautifulSoup("", "html.parser")
-
+    if file_book.rules["no-links"]:
         string_data = tag.string  # Get the string value of the old tag
 
-        new_tag = soup.new_tag("i")  # Create replacement string
+        new_tag = tag_factory.new_tag("i")  # Create replacement string
         new_tag.string = string_data
 
         return new_tag  # Return tag with link removed
@@ -412,26 +820,180 @@ def create_summary(title, summary_text, summary_div):
     :param Tag summary_div: The new location for the summary
     :return: Void
     """
-    soup = BeautifulSoup("", "html.parser")  # Create a soup
+    splice_fragment(summary_div, ("summary", title, summary_text),
+                    functools.partial(build_summary, title, summary_text, summary_div), summary_text)
+
+
+def build_summary(title, summary_text, summary_div):
+    """
+    Builds a summary into its div, see create_summary.
 
-    summary_div.append(soup.new_tag("h2"))  # Add a title
+    :param str title: The title of the summary
+    :param Tag summary_text: The original summary text from file
+    :param Tag summary_div: The new location for the summary
+    :return: Void
+    """
+    summary_div.append(tag_factory.new_tag("h2"))  # Add a title
     summary_div.h2.string = title
     summary_div.append(summary_text)  # Add the text
     summary_div.blockquote.unwrap()  # Remove blockquote
 
 
+def build_description(tag, description_list, file_book):
+    """
+    Adds a <dd> of the ao3 tag list to the new description list, after checking its links.
+
+    :param Tag tag: The <dd> from the file
+    :param Tag description_list: The new <dl>
+    :param Book file_book: The book details object with the no-links rule
+    :return: Void
+    """
+    for a in tag.find_all("a"):
+        a.replace_with(set_link(a, file_book))  # Check all links in dd
+    description_list.append(tag)
+
+
+def splice_fragment(container, key_parts, build, moved=None):
+    """
+    Fills a container with a fragment from the fragment cache, or builds it and stores it when it is not cached.
+
+    Without an active cache the fragment is always built.
+
+    :param Tag container: The tag the fragment is added to the end of
+    :param tuple key_parts: Everything the fragment depends on, its kind, source tags and rules. See FragmentCache
+    :param function build: Called with no arguments to add the fragment to the container
+    :param Tag|None moved: A source tag the build moves into the container. Taken out of the source on a cache hit too,
+        so the source is left the same either way
+    :return: Void
+    """
+    cache = fragmentCache.active_cache
+    if cache is None:
+        build()
+        return
+
+    key = cache.get_key(*key_parts)
+    fragment = cache.get(key)
+    if fragment is not None:  # SPLICE IN A COPY OF THE CACHED NODES
+        for node in parse_fragment(fragment):
+            container.append(copy.copy(node))
+        if moved is not None:
+            moved.extract()
+        return
+
+    start = len(container.contents)
+    build()
+    cache.put(key, "".join(str(node) for node in container.contents[start:]))
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_fragment(fragment):
+    """
+    Parses a cached fragment into template nodes, kept so a fragment met often is only parsed once. The nodes must be
+    copied before they are used.
+
+    :param str fragment: The cleaned xhtml of the fragment
+    :return: tuple - The top level nodes of the fragment
+    """
+    return tuple(BeautifulSoup(fragment, "html.parser").contents)
+
+
 def final_clean(soup):
     """
     Do a final clean of the soup to remove any quirks
 
+    Gives the same result as clear_span, clear_font, clear_lone_nbsp then remove_dissallowed_attributes in a single
+    walk through the soup.
+
     :param BeautifulSoup soup: The soup being clean
     """
-    clear_span(soup)
-    clear_font(soup)
+    clean_tree(soup)
 
-    clear_lone_nbsp(soup)
 
-    remove_dissallowed_attributes(soup)
+@stageTimings.timed_stage("clean", "argument")
+def clean_tree(soup, rule_table=None, pre_comments=False):
+    """
+    Cleans a soup by visiting every node once, instead of a find_all for every rule.
+
+    The rules are applied in the same order the separate passes used, so the output does not change:
+        * style_rules classes are added to matching tags
+        * <p> tags with only the section break symbol are replaced with <hr class="linebreak">
+        * <span> without a class, <font> and <center> are unwrapped
+        * align attributes and lone &nbsp; strings are removed
+        * <pre> tags are replaced with a comment of their text, after their contents are cleaned
+
+    Edits soup in place
+
+    :param BeautifulSoup soup: The soup to clean
+    :param RuleTable|None rule_table: The compiled style rules and section break of the book. None for neither
+    :param bool pre_comments: Replace <pre> tags with comments
+
+    :return: Void
+    """
+    if rule_table is None:
+        rule_table = empty_rule_table
+
+    clean_contents(soup, soup, rule_table, pre_comments)
+
+
+def clean_contents(soup, parent, rule_table, pre_comments):
+    """
+    Applies the clean_tree rules to the contents of a tag, then to their contents.
+
+    Unwrapped tags leave their contents in their place, which are visited next. The tags being walked are kept on a
+    stack instead of a call for each level, so deeply nested html can't reach the recursion limit.
+
+    :param BeautifulSoup soup: The soup being cleaned, used to create new tags
+    :param Tag parent: The tag whose contents are cleaned
+    :param RuleTable rule_table: The compiled style rules and section break of the book
+    :param bool pre_comments: Replace <pre> tags with comments
+
+    :return: Void
+    """
+    stack = [[parent, 0]]  # Each tag being walked and the index of the next of its contents
+    while stack:
+        frame = stack[-1]
+        tag, index = frame
+
+        # END OF A TAG
+        if index >= len(tag.contents):
+            stack.pop()
+            if stack:  # The contents of the parent are all cleaned, it is left as it is
+                # PRE TO COMMENT
+                if pre_comments and tag.name == "pre":
+                    tag.replace_with(Comment(tag.string))
+                stack[-1][1] += 1
+            continue
+
+        data = tag.contents[index]
+
+        # STRINGS
+        if not isinstance(data, Tag):
+            if data == "&nbsp;":  # LONE NBSP
+                data.decompose()
+            else:
+                frame[1] += 1
+            continue
+
+        # JUNK TAGS
+        if data.name == "font" or data.name == "center" or (data.name == "span" and "class" not in data):
+            data.unwrap()
+            continue
+
+        # STYLES AND ATTRIBUTES
+        css_class = rule_table.get_class(data)
+        if css_class is not None:
+            data["class"] = css_class
+        if data.has_attr("align"):
+            del data["align"]  # Remove align tag
+
+        # SECTION BREAKS AND OTHER TEXT REPLACEMENTS
+        replacement = rule_table.get_replacement(data)
+        if replacement is not None:
+            data.replace_with(soup.new_tag(replacement[0], attrs=dict(replacement[1])))
+            frame[1] += 1
+            continue
+
+        stack.append([data, 0])  # Its contents are cleaned next
 
 
 def remove_dissallowed_attributes(soup):
@@ -0,0 +1,328 @@
+"""
+Removes the trivial LibreOffice junk from the html text before it is parsed, for the --prepass option.
+
+Most of what clean_tree does to a LibreOffice file is mechanical: unwrapping <font>, <center> and <span> without a
+class, removing align attributes and removing lone &nbsp; strings. Done on the soup, every junk tag is parsed into a
+node, visited and unwrapped. The pre-pass reads the body of the file as a stream of tags and text and drops the junk
+before the soup is built, so the parser and clean_tree are given a smaller tree.
+
+The cleaned files must be the same with or without the pre-pass, so it only rewrites what it can prove clean_tree would
+have done the same way:
+    * The body must be well-formed, every end tag closing the last open tag, so the tags are nested the way the parser
+      will nest them
+    * Junk <font> and <span> tags may only hold inline tags, and <center> may only be inside block tags, so the parser
+      never closes a tag because of a junk tag
+    * The style rules must not look at junk tags, align attributes or pseudo-classes, as the rules are matched against
+      the source of the tags after the one being cleaned
+    * Text is only joined across dropped tags when neither side is only whitespace, as the parser makes a string of
+      only whitespace a single newline or space
+    * A <span> is dropped whatever its attributes, clean_tree keeps it only when the text class is one of its contents,
+      and those are kept as they are
+    * A <p> is kept as it is when dropping its junk would change whether it is a section break
+    * The contents of a <pre> are kept as they are, their text becomes a comment
+Anything else and the file is parsed as it is.
+"""
+
+# IMPORTS ##############################################################################################################
+import html
+import re
+
+import stageTimings
+
+# GLOBAL VARIABLES #####################################################################################################
+# A comment, a declaration or processing instruction, or a start or end tag with its attributes
+token_pattern = re.compile(r"<!--.*?-->|<[!?][^>]*>|<(/?)([A-Za-z][^\s/>]*)((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>",
+                           re.DOTALL)
+
+# An attribute of a start tag, the name is the first group
+attribute_pattern = re.compile(r"([^\s\"'>/=]+)(?:\s*=\s*(?:\"[^\"]*\"|'[^']*'|[^\s\"'>]+))?")
+
+# The start of the body
+body_pattern = re.compile(r"<body(?=[\s/>])", re.IGNORECASE)
+
+# A < in text that the parser could read as the start of a tag
+stray_tag_pattern = re.compile(r"<[A-Za-z/!?]")
+
+# The end of a text that would become a character reference if the next text was joined to it
+open_reference_pattern = re.compile(r"(&[#A-Za-z0-9]*|\r)$")
+
+# Words in a style rule that mean it could match differently once the junk is gone
+unsafe_rule_pattern = re.compile(r":|\b(font|center|span|align)\b", re.IGNORECASE)
+
+# Tags without contents or an end tag
+void_tags = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track",
+             "wbr"}
+
+# Tags whose contents are not read as tags
+raw_text_tags = {"script", "style", "textarea", "title", "xmp", "iframe", "noembed", "noframes", "noscript",
+                 "plaintext"}
+
+# Tags a junk tag can hold without the parser closing anything
+inline_tags = {"a", "abbr", "b", "bdi", "bdo", "big", "br", "cite", "code", "dfn", "em", "font", "i", "img", "kbd",
+               "mark", "q", "s", "samp", "small", "span", "strike", "strong", "sub", "sup", "time", "tt", "u", "var",
+               "wbr"}
+
+# Tags a <center> can be inside without the parser closing them
+block_tags = {"body", "div", "center", "blockquote", "td", "th", "li", "dd", "section", "article", "aside", "header",
+              "footer", "main", "nav", "form", "fieldset", "figure", "details"}
+
+
+# ERRORS ###############################################################################################################
+class UnsafeMarkupError(Exception):
+    """
+    Raised when the pre-pass can't prove a rewrite is safe, the markup is then parsed as it is.
+    """
+    pass
+
+
+# PRE-PASS #############################################################################################################
+def can_prepass(rule_table):
+    """
+    Checks that the style rules of a book can't match differently once the junk is removed.
+
+    :param RuleTable rule_table: The compiled style rules and section break of the book
+
+    :return: bool
+    """
+    if any(unsafe_rule_pattern.search(name) for name in rule_table.tag_classes):
+        return False
+
+    return not any(unsafe_rule_pattern.search(compiled.pattern)
+                   for selectors in rule_table.selector_classes.values() for compiled, css_class in selectors)
+
+
+@stageTimings.timed_stage("prepass", None)
+def prepass_markup(markup, rule_table):
+    """
+    Removes the junk tags, align attributes and lone &nbsp; strings from the body of a LibreOffice file.
+
+    :param str markup: The html of the file
+    :param RuleTable rule_table: The compiled style rules and section break of the book
+
+    :return: str - The rewritten html, or the html as it is if it can't be rewritten safely
+    """
+    body_match = body_pattern.search(markup)
+    if body_match is None or not can_prepass(rule_table):
+        return markup
+
+    try:
+        body = rewrite_body(markup, body_match.start(), rule_table.text_replacements)
+    except UnsafeMarkupError:
+        return markup
+
+    return markup[:body_match.start()] + body
+
+
+def rewrite_body(markup, start, replacements):
+    """
+    Rewrites the markup from the start of the body.
+
+    :param str markup: The html of the file
+    :param int start: The position of the body start tag
+    :param dict replacements: The text of a <p> to the tag replacing it, from the rule table
+    :raises UnsafeMarkupError: If the body can't be rewritten safely
+
+    :return: str - The rewritten markup from the body on
+    """
+    output = []
+    stack = []  # (name, dropped) of each open tag
+    junk_depth = 0  # Open <font> and <span> junk tags, only inline tags can be inside them
+    pre_depth = 0  # Open <pre> tags, their contents are kept as they are
+    paragraph = None  # (output length, markup start, events) of the open <p> while it is checked for replacements
+    last_text = None  # The last text in the output if nothing but dropped tokens came after it
+    position = start
+
+    for match in token_pattern.finditer(markup, start):
+        # TEXT BEFORE THE TOKEN
+        if match.start() > position:
+            text = markup[position:match.start()]
+            if "<" in text and stray_tag_pattern.search(text):
+                raise UnsafeMarkupError("Text that could be a tag")
+            if stack and stack[-1] == ("span", True) and html.unescape(text) == "class":
+                raise UnsafeMarkupError("A <span> holding the text class is kept by clean_tree")
+
+            if not pre_depth and "nbsp" in text and html.unescape(text) == "&nbsp;":  # LONE NBSP
+                if paragraph is not None:
+                    paragraph[2].append(("text", text, True))
+            else:
+                if last_text is not None and (open_reference_pattern.search(last_text) or is_blank(last_text) or
+                                              is_blank(text)):
+                    raise UnsafeMarkupError("Joined text would change")
+                if paragraph is not None:
+                    paragraph[2].append(("text", text, False))
+                output.append(text)
+                last_text = text
+        position = match.end()
+
+        closing, name, attributes = match.groups()
+
+        # COMMENTS AND DECLARATIONS
+        if name is None:
+            if paragraph is not None:
+                paragraph[2].append(("other", match.group(0)[4:-3], False))
+            output.append(match.group(0))
+            last_text = None
+            continue
+
+        name = name.lower()
+
+        # END TAGS
+        if closing:
+            if not stack or stack[-1][0] != name:
+                raise UnsafeMarkupError("Unbalanced end tag </" + name + ">")
+            dropped = stack.pop()[1]
+
+            if name == "body":
+                output.append(markup[match.start():])
+                return "".join(output)
+
+            if paragraph is not None and name != "p":
+                paragraph[2].append(("end", name, dropped))
+            if dropped:
+                if name != "center":
+                    junk_depth -= 1
+                continue
+
+            output.append(match.group(0))
+            last_text = None
+
+            if name == "pre":
+                pre_depth -= 1
+            elif name == "p" and paragraph is not None:
+                paragraph = finish_paragraph(markup, match.end(), output, paragraph, replacements)
+            continue
+
+        # START TAGS
+        if attributes.endswith("/") and name not in void_tags:
+            raise UnsafeMarkupError("Self closing <" + name + ">")
+        if name in raw_text_tags or (junk_depth and name not in inline_tags):
+            raise UnsafeMarkupError("<" + name + "> can't be rewritten here")
+        if name == "center" and any(open_name not in block_tags for open_name, dropped in stack):
+            raise UnsafeMarkupError("<center> inside an inline tag")
+
+        # clean_tree unwraps every <span> unless the text class is one of its contents, as Tag.__contains__ looks at
+        # the contents and not the attributes
+        dropped = not pre_depth and name in ("font", "center", "span")
+
+        if name == "p" and replacements:
+            if paragraph is not None:
+                raise UnsafeMarkupError("<p> inside a <p>")
+            paragraph = (len(output), match.start(), [])
+        elif paragraph is not None:
+            paragraph[2].append(("void" if name in void_tags else "start", name, dropped))
+
+        if name not in void_tags:
+            stack.append((name, dropped))
+        if dropped:
+            if name != "center":  # A block tag, it can hold other blocks
+                junk_depth += 1
+            continue
+
+        if name == "pre":
+            pre_depth += 1
+        elif "align" in attributes.lower():
+            attributes = attribute_pattern.sub(drop_align, attributes)
+        output.append("<" + match.group(2) + attributes + ">")
+        last_text = None
+
+    raise UnsafeMarkupError("No end of the body")
+
+
+# HELPER FUNCTIONS #####################################################################################################
+def is_blank(text):
+    """
+    Checks if text is only whitespace. The parser makes a string of only whitespace a single newline or space, so it
+    can't be joined to the text around it.
+
+    :param str text: The text, as it is in the markup
+
+    :return: bool
+    """
+    return not html.unescape(text).strip()
+
+
+def drop_align(attribute):
+    """
+    Removes an align attribute, for attribute_pattern.sub.
+
+    :param re.Match attribute: The attribute
+
+    :return: str - The attribute, or nothing if it is align
+    """
+    return "" if attribute.group(1).lower() == "align" else attribute.group(0)
+
+
+def finish_paragraph(markup, end, output, paragraph, replacements):
+    """
+    Puts the source of a <p> back in the output if dropping its junk changed whether it is replaced.
+
+    :param str markup: The html of the file
+    :param int end: The end of the </p> tag
+    :param list output: The rewritten markup so far, edited in place
+    :param tuple paragraph: The (output length, markup start, events) of the <p>
+    :param dict replacements: The text of a <p> to the tag replacing it
+
+    :return: None - There is no open <p>
+    """
+    output_start, markup_start, events = paragraph
+
+    if any(event[2] for event in events):
+        source_string = get_string(events)
+        rewritten_string = get_string(join_text([event for event in events if not event[2]]))
+        if replacements.get(source_string) != replacements.get(rewritten_string):
+            del output[output_start:]
+            output.append(markup[markup_start:end])
+
+    return None
+
+
+def join_text(events):
+    """
+    Joins text events that are next to each other, as the parser joins text with nothing between it.
+
+    :param list events: The (kind, value, dropped) events
+
+    :return: list - The events
+    """
+    joined = []
+    for event in events:
+        if event[0] == "text" and joined and joined[-1][0] == "text":
+            joined[-1] = ("text", joined[-1][1] + event[1], False)
+        else:
+            joined.append(event)
+
+    return joined
+
+
+def get_string(events):
+    """
+    Gets what Tag.string gives for a tag with these contents: the text of its only child, through any tags that only
+    hold one child.
+
+    :param list events: The (kind, value, dropped) events of the contents of the tag
+
+    :return: str|None - None if the tag does not have exactly one child
+    """
+    while True:
+        children = 0
+        depth = 0
+        for kind, value, dropped in events:
+            if depth == 0:
+                children += 1
+            if kind == "start":
+                depth += 1
+            elif kind == "end":
+                depth -= 1
+
+        if children != 1:
+            return None
+
+        kind, value, dropped = events[0]
+        if kind == "text":
+            return html.unescape(value)
+        if kind == "other":
+            return value
+        if kind == "void":
+            return None
+
+        events = events[1:-1]  # The contents of the only child
@@ -0,0 +1,134 @@
+"""
+Bounds the memory of the worker processes, for the --jobs and --memory-limit options.
+
+Files sent to the worker processes are submitted a few at a time instead of all at once, so finished files waiting to
+be saved or packaged never pile up. Each worker reports its resident memory with every finished file. When the memory
+of this process and the workers together is over the limit, only one file is cleaned at a time until it falls back
+under the limit, so a large batch slows down instead of running out of memory.
+"""
+
+# IMPORTS ##############################################################################################################
+from collections import deque
+import os
+
+import stageTimings
+
+# GLOBAL VARIABLES #####################################################################################################
+# The limit in MB of the memory of this process and its workers together. None never throttles
+memory_limit = None
+
+# The calls each worker can have running or waiting while the memory is under the limit
+calls_per_worker = 2
+
+
+# MAIN CLASS ###########################################################################################################
+class MemoryGuard:
+    """
+    Class to follow the memory of the worker processes and decide how many calls can run at once.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self, workers, throttled=None, limit=None):
+        """
+        The init function.
+
+        :param int workers: The number of worker processes
+        :param function|None throttled: Called as throttled(total MB) each time the memory goes over the limit
+        :param float|None limit: The limit in MB. None uses memory_limit
+        """
+        self.workers: int = workers
+        self.throttled = throttled
+        self.limit: float | None = memory_limit if limit is None else limit
+
+        self.worker_memory: dict = {}  # Process id to the last memory in MB it reported
+        self.is_throttled: bool = False
+        self.throttle_count: int = 0  # How many times the memory went over the limit
+
+    # GUARD METHODS ####################################################################################################
+    def record(self, process_id, memory):
+        """
+        Records the memory a worker reported with a finished call.
+
+        :param int process_id: The process id of the worker
+        :param float|None memory: The resident memory of the worker in MB, None if it can't be measured
+
+        :return: Void
+        """
+        if memory is not None:
+            self.worker_memory[process_id] = memory
+
+    def get_total(self):
+        """
+        Gets the memory of this process and the last reported memory of each worker.
+
+        :return: float - The total in MB, 0 where the memory can't be measured
+        """
+        return (stageTimings.get_rss() or 0) + sum(self.worker_memory.values())
+
+    def get_window(self):
+        """
+        Gets how many calls can be running or waiting now. Reports the start of each throttle.
+
+        :return: int
+        """
+        over_limit = self.limit is not None and self.get_total() > self.limit
+        if over_limit and not self.is_throttled:
+            self.throttle_count += 1
+            if self.throttled is not None:
+                self.throttled(self.get_total())
+        self.is_throttled = over_limit
+
+        return 1 if over_limit else self.workers * calls_per_worker
+
+
+# WORKER FUNCTIONS #####################################################################################################
+def measure_call(function, *args):
+    """
+    Calls a function in a worker process and gives back the memory of the worker with the result.
+
+    :param function function: The function to call, it must be importable by the worker
+    :param args: The arguments of the function
+
+    :return: tuple - The (result, process id, resident memory in MB or None)
+    """
+    return function(*args), os.getpid(), stageTimings.get_rss()
+
+
+def guarded_map(executor, guard, function, *iterables):
+    """
+    Maps a function over the arguments in the worker processes, like executor.map, with only as many calls running or
+    waiting at once as the guard allows.
+
+    :param Executor executor: The worker processes
+    :param MemoryGuard guard: The guard of the workers
+    :param function function: The function to call, it must be importable by the workers
+    :param iterables: The arguments of each call, as for map
+
+    :return: Iterator of the results, in the same order as the arguments
+    """
+    pending = deque()
+    try:
+        for arguments in zip(*iterables):
+            while pending and len(pending) >= guard.get_window():
+                yield get_result(pending.popleft(), guard)
+            pending.append(executor.submit(measure_call, function, *arguments))
+
+        while pending:
+            yield get_result(pending.popleft(), guard)
+    finally:
+        for future in pending:  # Stopped early or failed
+            future.cancel()
+
+
+def get_result(future, guard):
+    """
+    Waits for a call sent by guarded_map and records the memory of its worker.
+
+    :param Future future: The call
+    :param MemoryGuard guard: The guard of the workers
+
+    :return: The result of the call
+    """
+    result, process_id, memory = future.result()
+    guard.record(process_id, memory)
+
+    return result
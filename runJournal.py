@@ -0,0 +1,179 @@
+"""
+Records each part of a book as it is saved so a run that stops partway can carry on where it stopped, for the --resume
+option.
+
+The journal is a file of JSON lines in the output folder of the book, one for each format. The first line records the
+tool, the format, the parser, the formatter and the prepass setting, a journal from another version of any of them is
+thrown away. Every other line is a saved part, with the hash of its source and of the saved file, or a part that failed.
+A line is written and flushed once its part is saved, so a run killed at any point leaves a journal of the parts it
+finished. A last line cut off by the kill is skipped.
+
+A part is only skipped by the next run if its source is unchanged and its saved file is still there, unchanged. When a
+run ends with every part saved the journal is removed.
+"""
+
+# IMPORTS ##############################################################################################################
+import json
+import os
+
+from buildManifest import get_format_key, get_tool_version, hash_file
+
+
+# MAIN CLASS ###########################################################################################################
+class RunJournal:
+    """
+    Class to record the saved parts of a run and find the parts an earlier run already saved.
+
+    Can be used as a context manager, the journal is removed when the block ends without an error or a failed part.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self, format_name, format_path, parser, output_folder, formatter="minimal", prepass=False,
+                 resume=True):
+        """
+        The init function. Loads the journal of an earlier run of the format and starts a new one.
+
+        :param str format_name: The name of the format, used to name the journal
+        :param str format_path: The path of the format JSON file
+        :param str parser: The parser engine used, output can differ between parsers
+        :param str output_folder: The folder the files are saved in, the journal is saved with them
+        :param str formatter: The formatter used to save the xhtml, minimal or html
+        :param bool prepass: The LibreOffice junk is removed from the html text before it is parsed
+        :param bool resume: Carry on from the journal of an earlier run. False starts again from nothing
+        """
+        self.path: str = os.path.join(output_folder, ".journal-" + format_name + ".jsonl")
+        self.header: dict = {"tool": get_tool_version(),
+                             "format": get_format_key(format_path, parser, formatter, prepass)}
+
+        self.finished: dict = {}  # Saved file to {"source": source path, "source_hash": hash, "hash": saved file hash}
+        self.failed: dict = {}  # Saved file to the error, in this run
+
+        if resume and os.path.exists(self.path):
+            self.load()
+
+        # REWRITE THE JOURNAL WITH ONLY THE PARTS THAT ARE KEPT
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.write(self.header)
+        for final_name, entry in self.finished.items():
+            self.write(dict(entry, part=final_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None and not self.failed)
+
+    # JOURNAL METHODS ##################################################################################################
+    def load(self):
+        """
+        Loads the saved parts of the journal of an earlier run, if it was made by the same tool, format and settings.
+
+        :return: Void
+        """
+        with open(self.path, "r", encoding="utf-8") as journal_file:
+            lines = journal_file.read().splitlines()
+
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:  # Cut off when the run was killed
+                continue
+
+        if not entries or entries[0] != self.header:
+            return
+
+        for entry in entries[1:]:
+            if "hash" in entry:
+                self.finished[entry["part"]] = {"source": entry["source"], "source_hash": entry["source_hash"],
+                                                "hash": entry["hash"]}
+
+    def is_finished(self, source_path, source_hash, final_name):
+        """
+        Checks if an earlier run saved a part from the same source, and the saved file is unchanged.
+
+        :param str source_path: The path of the source html of the part
+        :param str source_hash: The hash of the source html
+        :param str final_name: The file the part is saved as
+
+        :return: bool
+        """
+        entry = self.finished.get(final_name)
+        if entry is None or entry["source"] != source_path or entry["source_hash"] != source_hash:
+            return False
+
+        return os.path.exists(final_name) and hash_file(final_name) == entry["hash"]
+
+    def record(self, source_path, source_hash, final_name):
+        """
+        Records a saved part.
+
+        :param str source_path: The path of the source html of the part
+        :param str source_hash: The hash of the source html
+        :param str final_name: The saved file
+
+        :return: Void
+        """
+        self.finished[final_name] = {"source": source_path, "source_hash": source_hash, "hash": hash_file(final_name)}
+        self.failed.pop(final_name, None)
+        self.write(dict(self.finished[final_name], part=final_name))
+
+    def record_failure(self, source_path, final_name, error):
+        """
+        Records a part that could not be saved, it is cleaned again by the next run.
+
+        :param str source_path: The path of the source html of the part
+        :param str final_name: The file the part would be saved as
+        :param str error: What went wrong
+
+        :return: Void
+        """
+        self.failed[final_name] = error
+        self.write({"source": source_path, "part": final_name, "error": error})
+
+    def close(self, complete=False):
+        """
+        Closes the journal.
+
+        :param bool complete: Every part was saved, the journal is removed
+
+        :return: Void
+        """
+        self.file.close()
+        if complete:
+            os.remove(self.path)
+
+    # HELPER METHODS ###################################################################################################
+    def write(self, entry):
+        """
+        Writes a line to the journal and flushes it, so it is kept if the run is killed.
+
+        :param dict entry: The line
+
+        :return: Void
+        """
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+
+# PART RETRIES #########################################################################################################
+def run_part(function, retries, *args):
+    """
+    Calls the function that saves a part, again up to retries more times if it fails, so one bad part does not stop the
+    others. Only uses the provided arguments so it can be sent to a worker process.
+
+    Only errors are caught, Ctrl+C still stops the run.
+
+    :param function function: The function to call
+    :param int retries: How many more times to call it after it fails
+    :param args: The arguments of the function
+
+    :return: tuple - The (result, None), or (None, the last error as text) if every call failed
+    """
+    error_text = None
+    for attempt in range(retries + 1):
+        try:
+            return function(*args), None
+        except Exception as error:
+            error_text = "{}: {}".format(type(error).__name__, error)
+
+    return None, error_text
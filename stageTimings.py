@@ -0,0 +1,224 @@
+"""
+Records the time spent in each stage of cleaning, for the --timings option.
+
+Stages are the functions wrapped with timed_stage:
+    * parse - Source html into a soup
+    * build - A part of the book built into its xhtml soup
+    * clean - The clean_tree walk of a soup
+    * serialize - A soup encoded to xhtml
+    * write - The xhtml written to file
+
+While no recorder is started the wrapper only checks a global before calling the function, so the stages stay wrapped
+at no real cost. Stages can nest, the time of a build includes the clean and any parse inside it.
+
+Stages are held until a document is finished with finish_document, then recorded under the name of that document. A
+stage shared by many documents, such as parsing a full ao3 work, goes to the first document finished after it.
+
+The resident memory of the process is recorded as each document is finished, with the peak of the whole run, so the
+memory held while a book is cleaned can be followed document by document.
+"""
+
+# IMPORTS ##############################################################################################################
+import csv
+import functools
+import json
+import os
+import sys
+import time
+
+try:  # Peak RSS, not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+# GLOBAL VARIABLES #####################################################################################################
+# The active recorder, None when timings are not being recorded
+recorder = None
+
+
+# MAIN CLASS ###########################################################################################################
+class StageRecorder:
+    """
+    Class to collect the stage timings of each document.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self):
+        """
+        The init function.
+        """
+        self.documents: list = []  # {"document": name, "stages": [stage dicts]} of each finished document
+        self.pending: list = []  # Stages recorded since the last finished document
+
+    # RECORDING METHODS ################################################################################################
+    def add_stage(self, stage, seconds, nodes):
+        """
+        Records a stage of the document being cleaned.
+
+        :param str stage: The name of the stage
+        :param float seconds: The wall time of the stage
+        :param int nodes: The number of nodes in the soup of the stage
+
+        :return: Void
+        """
+        self.pending.append({"stage": stage, "seconds": seconds, "nodes": nodes})
+
+    def finish_document(self, name):
+        """
+        Records the held stages under a finished document.
+
+        :param str name: The name of the document
+
+        :return: Void
+        """
+        self.documents.append({"document": name, "stages": self.pending, "rss_mb": get_rss()})
+        self.pending = []
+
+    # REPORT METHODS ###################################################################################################
+    def get_totals(self):
+        """
+        Gets the total time and number of calls of each stage over all documents.
+
+        :return: dict - Stage name to {"calls", "seconds"}
+        """
+        totals = {}
+        for document in self.documents:
+            for stage in document["stages"]:
+                total = totals.setdefault(stage["stage"], {"calls": 0, "seconds": 0.0})
+                total["calls"] += 1
+                total["seconds"] += stage["seconds"]
+
+        return totals
+
+    def save(self, report_path):
+        """
+        Saves the report. A .csv path saves one row for each stage of each document, anything else saves JSON with the
+        totals of each stage.
+
+        :param str report_path: The path of the report file
+
+        :return: Void
+        """
+        if report_path.lower().endswith(".csv"):
+            with open(report_path, "w", newline="") as report_file:
+                writer = csv.writer(report_file)
+                writer.writerow(["document", "stage", "seconds", "nodes", "rss_mb"])
+                for document in self.documents:
+                    for stage in document["stages"]:
+                        writer.writerow([document["document"], stage["stage"], stage["seconds"], stage["nodes"],
+                                         document["rss_mb"]])
+        else:
+            with open(report_path, "w") as report_file:
+                json.dump({"totals": self.get_totals(), "peak_rss_mb": get_peak_rss(), "documents": self.documents},
+                          report_file, indent=4)
+
+
+# RECORDING ############################################################################################################
+def start_recording():
+    """
+    Starts recording the stages.
+
+    :return: StageRecorder - The new recorder
+    """
+    global recorder
+    recorder = StageRecorder()
+
+    return recorder
+
+
+def stop_recording():
+    """
+    Stops recording the stages.
+
+    :return: StageRecorder|None - The recorder that was active
+    """
+    global recorder
+    finished, recorder = recorder, None
+
+    return finished
+
+
+def finish_document(name):
+    """
+    Records the held stages under a finished document, if recording.
+
+    :param str name: The name of the document
+
+    :return: Void
+    """
+    if recorder is not None:
+        recorder.finish_document(name)
+
+
+def get_rss():
+    """
+    Gets the resident memory of this process now.
+
+    :return: float|None - The memory in MB, None where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_peak_rss():
+    """
+    Gets the peak resident memory of this process.
+
+    :return: float|None - The peak in MB, None where the resource module is not available
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # macOS gives bytes
+        return peak / 1024 / 1024
+
+    return peak / 1024  # Linux gives KB
+
+
+def count_nodes(element):
+    """
+    Counts the nodes of a soup or tag.
+
+    :param Tag|None element: The soup or tag
+
+    :return: int
+    """
+    if element is None:
+        return 0
+
+    return sum(1 for node in element.descendants)
+
+
+def timed_stage(stage, nodes_from="result"):
+    """
+    A decorator that records each call of a function as a stage while recording.
+
+    :param str stage: The name of the stage
+    :param str|None nodes_from: Count the nodes of the "result" or of the first "argument", None counts nothing
+
+    :return: function - The decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if recorder is None:  # NOT RECORDING - NO COST BUT THIS CHECK
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            seconds = time.perf_counter() - start
+
+            if nodes_from is None:
+                nodes = 0
+            else:
+                nodes = count_nodes(result if nodes_from == "result" else args[0])
+
+            recorder.add_stage(stage, seconds, nodes)
+            return result
+
+        return wrapper
+
+    return decorator
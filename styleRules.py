@@ -0,0 +1,163 @@
+"""
+Compiles the style_rules and section break of a book into a table that clean_tree applies in its single walk.
+
+The table is built once for each book and used for every chapter:
+    * Tag name rules - {"h1": "chapHeading"} - are a dict lookup on the tag name
+    * CSS selector rules - {"div.notes > p": "note"} - are compiled once and kept by the tag name at the end of the
+      selector, so a tag is only matched against the selectors that can match its name
+    * Text replacements - <p> tags with only the section break symbol - are a dict lookup on the text of the tag
+
+Selectors are matched while the tree is being cleaned, against the tags before them as they have been cleaned and the
+tags after them as they were in the source.
+"""
+
+# IMPORTS ##############################################################################################################
+import re
+
+# GLOBAL VARIABLES #####################################################################################################
+# A style rule key that is only a tag name
+tag_name_pattern = re.compile(r"[A-Za-z][A-Za-z0-9-]*")
+
+# The bucket of selectors that can match any tag name
+any_tag = "*"
+
+
+# MAIN CLASS ###########################################################################################################
+class RuleTable:
+    """
+    Class to hold the compiled style rules and text replacements of a book.
+    """
+    # CONSTRUCTORS #####################################################################################################
+    def __init__(self, styles=None, sectionbreak=None):
+        """
+        The init function. Compiles the rules.
+
+        :param dict|None styles: The style rules, a tag name or CSS selector to the css class
+        :param str|None sectionbreak: The section break symbol. None for no section breaks
+        :raises ValueError: If a selector is not valid
+        """
+        self.tag_classes: dict = {}  # Tag name to css class
+        self.selector_classes: dict = {}  # Tag name or any_tag to a list of (compiled selector, css class)
+        self.text_replacements: dict = {}  # Text of a <p> to the (tag name, attributes) that replaces it
+
+        for rule, css_class in (styles or {}).items():
+            if tag_name_pattern.fullmatch(rule):
+                self.tag_classes[rule] = css_class
+            else:
+                self.add_selector(rule, css_class)
+
+        if sectionbreak is not None:
+            # SECTION BREAKS MUST BE HR FOR ACCESSIBILITY - ANY IMAGES MUST BE DONE IN CSS AS BACKGROUND IMAGE
+            self.text_replacements[sectionbreak] = ("hr", {"class": "linebreak"})
+
+    def add_selector(self, selector, css_class):
+        """
+        Compiles a CSS selector rule and adds it to the bucket of each tag name it can end on.
+
+        :param str selector: The CSS selector, may be a list of selectors
+        :param str css_class: The css class given to matching tags
+        :raises ValueError: If the selector is not valid
+
+        :return: Void
+        """
+        import soupsieve  # CSS selectors, installed with Beautiful Soup. Loaded here as it loads Beautiful Soup
+
+        for part in split_selector_list(selector):
+            try:
+                compiled = soupsieve.compile(part)
+            except soupsieve.SelectorSyntaxError as error:
+                raise ValueError("Invalid style rule selector '" + selector + "': " + str(error)) from error
+
+            self.selector_classes.setdefault(get_selector_tag(part), []).append((compiled, css_class))
+
+    # LOOKUP METHODS ###################################################################################################
+    def get_class(self, tag):
+        """
+        Gets the css class a tag is given. Selector rules are applied after tag name rules, the last match wins.
+
+        :param Tag tag: The tag
+
+        :return: str|None - None if no rule matches
+        """
+        css_class = self.tag_classes.get(tag.name)
+
+        if self.selector_classes:
+            for bucket in (tag.name, any_tag):
+                for compiled, selector_class in self.selector_classes.get(bucket, ()):
+                    if compiled.match(tag):
+                        css_class = selector_class
+
+        return css_class
+
+    def get_replacement(self, tag):
+        """
+        Gets the tag that replaces a <p>, from the text replacements.
+
+        :param Tag tag: The tag
+
+        :return: tuple|None - The (tag name, attributes) of the replacement, None to keep the tag
+        """
+        if tag.name != "p" or not self.text_replacements:
+            return None
+
+        return self.text_replacements.get(tag.string)
+
+
+# HELPER FUNCTIONS #####################################################################################################
+def split_selector_list(selector):
+    """
+    Splits a selector list on its top level commas, commas inside brackets or quotes are kept.
+
+    :param str selector: The selector list
+
+    :return: list - The selectors
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for index, character in enumerate(selector):
+        if quote:
+            if character == quote:
+                quote = None
+        elif character in "\"'":
+            quote = character
+        elif character in "([":
+            depth += 1
+        elif character in ")]":
+            depth -= 1
+        elif character == "," and depth == 0:
+            parts.append(selector[start:index].strip())
+            start = index + 1
+    parts.append(selector[start:].strip())
+
+    return parts
+
+
+def get_selector_tag(selector):
+    """
+    Gets the tag name a selector ends on, the only tags it can match.
+
+    :param str selector: A single selector, not a list
+
+    :return: str - The tag name, or any_tag if it can match any tag
+    """
+    # FIND THE LAST COMPOUND SELECTOR - AFTER THE LAST TOP LEVEL COMBINATOR
+    depth = 0
+    quote = None
+    start = 0
+    for index, character in enumerate(selector):
+        if quote:
+            if character == quote:
+                quote = None
+        elif character in "\"'":
+            quote = character
+        elif character in "([":
+            depth += 1
+        elif character in ")]":
+            depth -= 1
+        elif character in " >+~" and depth == 0:
+            start = index + 1
+
+    tag_match = tag_name_pattern.match(selector[start:])
+    return tag_match.group(0).lower() if tag_match else any_tag